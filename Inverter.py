@@ -12,47 +12,33 @@
 # Input numbers should all be integers.
 
 
-import os, datetime, argparse, shutil
+import os, argparse, shutil
 import numpy as np
 from osgeo import gdal
 import processingCommon as pc
+import instrumentation as ins
 
 
 scriptName = "Inverter.py"
 
 
-def main():
+def Invert(inRast, outRast, theLog):
 
-    parser = argparse.ArgumentParser(description='Inverts a raster surface through the z axis about its mid-range point.')
-    parser.add_argument('INPUTRAST', help='Full path to the input GeoTiff surface file.')
-    parser.add_argument('OUTPUTRAST', help='Full path to the output GeoTiff surface file to create.')
-    args = parser.parse_args()
-    inRast  = args.INPUTRAST
-    outRast = args.OUTPUTRAST
+    """Inverts inRast about its mid-range point into outRast as an integer GeoTiff of the smallest type holding its range and NoData, logging to theLog."""
 
-    gdal.UseExceptions()
     NoDataVal = -99999
 
-    # Set up log file and working directory.
-    outPathDir, outFile = os.path.split(outRast)
-    outFileNoExt = os.path.splitext(outFile)[0]
-    theLog = os.path.join(outPathDir, outFileNoExt + "_log.txt")
-
-    # Note and print start time
-    startTime = datetime.datetime.now()
-    pc.printandlog("\nStarting {} at ".format(scriptName) + str(datetime.datetime.now()), theLog)
-
-    pc.printandlog("Input file:  {}".format(inRast), theLog)
-    pc.printandlog("Output file: {}".format(outRast), theLog)
-
-    # Read input raster, get statistics on it.
+    # Read input raster, get exact statistics on it with a first pass
+    # through its blocks.
     ds = gdal.Open(inRast)
     b = ds.GetRasterBand(1) # Assume only 1 band.
-    b.ComputeStatistics(False)
-    mdata = b.GetMetadata() # Returns a dictionary with values for "STATISTICS_X" where X can be
-                            # one of MEAN, MINIMUM, MAXIMUM, STDDEV. Values are given as strings.
-    terrMin = float(mdata["STATISTICS_MINIMUM"]) # Given as float
-    terrMax = float(mdata["STATISTICS_MAXIMUM"]) # Given as float
+    inNoData = b.GetNoDataValue()
+    terrMin, terrMax = pc.BandMinMax(b, [NoDataVal])
+    if terrMin is None:
+        pc.printandlog("Input raster holds nothing but NoData, nothing to invert.", theLog)
+        return
+    terrMin = float(terrMin)
+    terrMax = float(terrMax)
     # Test to see whether these are whole-number integer values.
     if terrMin.is_integer() and terrMax.is_integer():
         pass
@@ -61,69 +47,75 @@ def main():
     xSize = b.XSize
     ySize = b.YSize
     totalPixels = xSize * ySize
-    rMin = mdata["STATISTICS_MINIMUM"]
-    rMax = mdata["STATISTICS_MAXIMUM"]
-    rng = float(rMax) - float(rMin)
+    rng = terrMax - terrMin
     halfrng = rng / 2.0
-    fulcrum = float(rMin) + halfrng
+    fulcrum = terrMin + halfrng
     pc.printandlog("Raster size is {:,} by {:,} = {:,} total pixels.".format(xSize, ySize, totalPixels), theLog)
     pc.printandlog("Raster Statistics", theLog)
-    pc.printandlog("Min ............. " + rMin, theLog)
-    pc.printandlog("Max ............. " + rMax, theLog)
+    pc.printandlog("Min ............. " + str(terrMin), theLog)
+    pc.printandlog("Max ............. " + str(terrMax), theLog)
     pc.printandlog("Range ........... " + str(rng), theLog)
     pc.printandlog("Fulcrum point at  " + str(fulcrum), theLog)
 
-    # Getting geotransform and projection information.
-    geoTrans = ds.GetGeoTransform()
-    wktProjection = ds.GetProjection()
-
-    # Reading to numpy array.
-    bArr = gdal.Band.ReadAsArray(b) # probably as dtype=int16
-    bArr32 = bArr.astype("Int32") # Ensure 32-bit signed integer array.
-    bArr32copy = np.copy(bArr32)
+    # Reflecting about the fulcrum maps the range onto itself, so the output
+    # type need only hold the input's range and NoData.
+    dataType = pc.SmallestDataType(min(np.floor(terrMin), NoDataVal), np.ceil(terrMax))
+    dataset = pc.CreateOutput(outRast, xSize, ySize, 1, dataType, ds, NoDataVal)
+    oBand = dataset.GetRasterBand(1)
 
     pc.printandlog("Inverting, please wait...", theLog)
 
-    # Inversion.
-    for x in np.nditer(bArr32copy, op_flags=["readwrite"]):
+    # Inversion, a block at a time. Reflecting x about the fulcrum gives
+    # 2 * fulcrum - x, which is truncated to an integer as before. NoData cells,
+    # whichever NoData value the input used, are written as the output's.
+    nonIntegers = 0
+    windows = list(pc.StripWindows(b))
+    with ins.Stage("invert", theLog, pixels=totalPixels), ins.Progress(len(windows), "Strips") as progress:
+        for window in windows:
+            strip = b.ReadAsArray(*window)
+            noData = pc.NoDataMask(strip, [NoDataVal, inNoData]) # Before the cast, so a fractional NoData tag still matches.
+            bArr32 = strip.astype("int32") # Ensure 32-bit signed integer array.
+            inverted = 2.0 * fulcrum - bArr32
+            nonIntegers += np.count_nonzero((inverted != np.trunc(inverted)) & ~noData)
+            bArr32 = np.where(noData, NoDataVal, np.trunc(inverted)).astype("int32")
+            oBand.WriteArray(bArr32, window[0], window[1])
+            progress.update()
+    if nonIntegers > 0:
+        pc.printandlog("error maybe, {:,} inverted values weren't integers and were truncated".format(nonIntegers), theLog) # should be ints
 
-        if x != NoDataVal: # We want to leave the NoData cells unchanged.
+    pc.printandlog("Numpy calculations complete." ,theLog)
+    pc.FinishOutput(dataset) # Finally writes raster to disk.
 
-            px = float(x)
+def main():
 
-            if px > fulcrum:
-                diff = px - fulcrum
-                newVal = fulcrum - diff
-                intTrue = newVal.is_integer()
-                if intTrue == False:
-                    print("error maybe, newVal is " + str(newVal)) # should be an int
-                x[...] = np.int32(int(newVal))
+    parser = argparse.ArgumentParser(description='Inverts a raster surface through the z axis about its mid-range point.')
+    parser.add_argument('INPUTRAST', help='Full path to the input GeoTiff surface file.')
+    parser.add_argument('OUTPUTRAST', help='Full path to the output GeoTiff surface file to create.')
+    pc.AddOutputArguments(parser)
+    ins.AddInstrumentationArguments(parser)
+    args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+    inRast  = args.INPUTRAST
+    outRast = args.OUTPUTRAST
 
-            if px < fulcrum:
-                diff = fulcrum - px
-                newVal = fulcrum + diff
-                intTrue = newVal.is_integer()
-                if intTrue == False:
-                    print("error maybe, newVal is " + str(newVal)) # should be an int
-                x[...] = np.int32(int(newVal))
+    gdal.UseExceptions()
 
-            # if px == fulcrum, we simply leave it unchanged.
+    # Set up log file and working directory.
+    outPathDir, outFile = os.path.split(outRast)
+    outFileNoExt = os.path.splitext(outFile)[0]
+    theLog = os.path.join(outPathDir, outFileNoExt + "_log.txt")
 
-    pc.printandlog("Numpy calculations complete." ,theLog)
-    dst_filename = outRast
-    driver = gdal.GetDriverByName('GTiff')
-    dataset = driver.Create(dst_filename, xSize, ySize, 1, gdal.GDT_Int32)
-    dataset.SetGeoTransform(geoTrans)
-    dataset.SetProjection(wktProjection)
-    oBand = dataset.GetRasterBand(1)
-    oBand.SetNoDataValue(NoDataVal)
-    oBand.WriteArray(bArr32copy)
-    dataset.FlushCache() # Finally writes raster to disk.
-
-    endTime = datetime.datetime.now()
-    totalTime = endTime - startTime
-    pc.printandlog("Output written to " + dst_filename, theLog)
-    pc.printandlog("Total elapsed time: " + str(totalTime) + "\n", theLog)
+    # Note and print start time; the stage logs the total time at the end.
+    pc.printandlog("\nStarting {} at ".format(scriptName) + ins.Timestamp(), theLog)
+
+    pc.printandlog("Input file:  {}".format(inRast), theLog)
+    pc.printandlog("Output file: {}".format(outRast), theLog)
+
+    with ins.Stage(scriptName, theLog):
+        Invert(inRast, outRast, theLog)
+
+    pc.printandlog("Output written to " + outRast, theLog)
 
 
 
@@ -11,33 +11,211 @@
 
 # Calculating local entropy using the method built into scikit-image.
 # IMPORTANT: The method only ingests unsigned 8 or 16 bit integer pixel types. May
-# need to convert input rasters into uint16!
+# need to convert input rasters into uint16! The histogram engine
+# (histogramEntropy.py) quantizes elevations instead, and has no such limit.
 
 scriptName = "LocalEntropy.py"
 
-import datetime, argparse, os, sys
+import argparse, os
 from osgeo import gdal
 import numpy as np
 import processingCommon as pc
+import instrumentation as ins
 from skimage.filters.rank import entropy
 from skimage.morphology import disk
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import histogramEntropy as he
+import rasterCache as rc
+import mosaic
 
 
+@functools.lru_cache(maxsize=None)
+def DiskFootprint(radius):
 
+    """scikit-image's disk structuring element of the given radius, made once per radius and shared by every later call in the process, so don't modify it."""
+
+    return disk(radius)
+
+def EntropyStack(block, radii):
+
+    """scikit-image's local entropy of one block of the input raster over a disk of each of radii, casting the block to uint16 for it only once. Returns a list of entropy arrays. With numba and several radii the disks are slid over the block together, in one pass of histogramEntropy's sliding histograms with a bin for every distinct value, which gives scikit-image's entropies to rounding. Otherwise scikit-image runs once per radius, which is then the quicker."""
+
+    block_u16 = block.astype(np.uint16) # unsigned 16 bit integer - possibly bad with some input rasters.
+    if he.haveNumba and len(radii) > 1:
+        values, bins = np.unique(block_u16, return_inverse=True)
+        return list(he.SlidingEntropyStack(bins.reshape(block_u16.shape).astype(np.int32), radii, len(values)))
+    return [entropy(block_u16, DiskFootprint(radius)) for radius in radii]
+
+def EntropyTiles(inBand, windows, halo, workers, entropyFn):
+
+    """Calculates local entropy with entropyFn(block) over each of windows of inBand, read with a halo pixels on every side, on a pool of threads. Yields each window with the core of every array entropyFn returned for it, in order, as they finish."""
+
+    def paddedBlocks():
+        # Read in this thread only, as GDAL handles aren't thread safe.
+        for window in windows:
+            padded, core = pc.PadWindow(window, halo, inBand.XSize, inBand.YSize)
+            yield (inBand.ReadAsArray(*padded),)
+
+    with ThreadPoolExecutor(workers) as executor:
+        results = pc.BoundedMap(executor, entropyFn, paddedBlocks(), 2 * workers)
+        for window, ents in zip(windows, results):
+            padded, core = pc.PadWindow(window, halo, inBand.XSize, inBand.YSize)
+            yield window, [ent[core] for ent in ents]
+
+def TiledEntropy(inBand, outBands, halo, tileSize, workers, entropyFn):
+
+    """Calculates local entropy with entropyFn(block), which returns one array per band of outBands, tile by tile on a pool of threads. Each finished tile is streamed into outBands so the whole entropy arrays never exist at once. Tiles are read with a halo of the largest disk radius and only their cores are kept. Both engines ignore pixels off the raster edge, so the result is the same as calculating entropy on the whole array in one go: identical with scikit-image, and to within float rounding with the histogram engine, whose running sums start afresh in each tile."""
+
+    windows = list(pc.TileWindows(inBand.XSize, inBand.YSize, tileSize))
+    with ins.Progress(len(windows), "Tiles") as progress:
+        for window, ents in EntropyTiles(inBand, windows, halo, workers, entropyFn):
+            for oBand, ent in zip(outBands, ents):
+                oBand.WriteArray(ent, window[0], window[1])
+            progress.update()
+
+def MosaicEntropy(source, outDirs, nBands, dataType, halo, workers, entropyFn, theLog):
+
+    """Calculates local entropy over a mosaic.Mosaic tile by tile on a pool of threads, like TiledEntropy, but with the source's own tiles as the windows. Each is written out as a matching tile in each of outDirs, nBands bands to each, and a VRT of them is made in each directory. Only the tiles overlapping a tile and its halo are read for it, so there are no seams. Returns the VRT paths."""
+
+    outPaths = []
+    for outDir in outDirs:
+        os.makedirs(outDir, exist_ok=True)
+        outPaths.append(mosaic.OutputTilePaths(source, outDir))
+    windows = source.TileWindows()
+    with ins.Progress(len(windows), "Tiles") as progress:
+        for n, (window, ents) in enumerate(EntropyTiles(source, windows, halo, workers, entropyFn)):
+            for nOut, paths in enumerate(outPaths):
+                out_ds = mosaic.CreateTileOutput(source, n, paths[n], nBands, dataType, noData=None)
+                for nBand in range(nBands):
+                    oBand = out_ds.GetRasterBand(nBand + 1)
+                    oBand.WriteArray(ents[nOut * nBands + nBand])
+                    oBand.ComputeStatistics(True)
+                pc.FinishOutput(out_ds)
+            progress.update()
+    mosaic.ReportOpens(source, theLog)
+    return [mosaic.BuildOutputVRT(outDir, paths) for outDir, paths in zip(outDirs, outPaths)]
+
+def RadiusOutputPath(outIMAGE, diskRadius):
+
+    """Output path for one radius's layer when layers are written to separate files."""
+
+    outFileNoExt, outExt = os.path.splitext(outIMAGE)
+    return "{}_r{}{}".format(outFileNoExt, diskRadius, outExt)
+
+
+def EntropyOutputPaths(outIMAGE, diskRadii, separate):
+
+    """Paths CalculateEntropy writes to: outIMAGE, or one file per radius if separate."""
+
+    if separate and len(diskRadii) > 1:
+        return [RadiusOutputPath(outIMAGE, r) for r in diskRadii]
+    return [outIMAGE]
+
+def CalculateEntropy(inIMAGE, outIMAGE, diskRadii, theLog, tileSize=None, workers=1, engine="skimage", bins=256, quantization="fixed", breaks=None, separate=False, cache=None, vrtTiles=False):
+
+    """Calculates local entropy of inIMAGE over disks of each of diskRadii and writes it to outIMAGE, logging to theLog. The other arguments are as for the command line options, and cache is an optional rasterCache.CacheSettings. If inIMAGE is a mosaic of tiles (a directory of them, or a VRT of them with vrtTiles True, see mosaic.IsMosaic), outIMAGE is a directory for matching output tiles, tileSize and cache don't apply, and the paths returned are those of VRTs of the tiles. Returns the paths written to."""
+
+    isMosaic = mosaic.IsMosaic(inIMAGE, vrtTiles)
+    if isMosaic:
+        outIMAGE = os.path.normpath(outIMAGE)
+    dst_filenames = EntropyOutputPaths(outIMAGE, diskRadii, separate)
+    if cache is not None and not isMosaic:
+        # Tiling and threads don't change the result, so they aren't part of the
+        # key. The output profile and overviews change the files, so are.
+        params = {"radii": diskRadii, "engine": engine, "bins": bins, "quantization": quantization, "breaks": breaks, "separate": separate, "output": dict(pc.Current(pc.outputSettings))}
+        rc.CachedRun(cache, "entropy", [inIMAGE], params, dst_filenames, lambda: CalculateEntropy(inIMAGE, outIMAGE, diskRadii, theLog, tileSize, workers, engine, bins, quantization, breaks, separate))
+        return dst_filenames
+
+    # Open data. A mosaic of tiles reads like a band, see mosaic.py.
+    if isMosaic:
+        b = mosaic.Mosaic(inIMAGE, vrtTiles)
+        pc.printandlog("Mosaic of {} tiles, {} by {} pixels.".format(len(b.tiles), b.XSize, b.YSize), theLog)
+    else:
+        ds = gdal.Open(inIMAGE)
+        b = ds.GetRasterBand(1) # Assuming only 1 band.
+
+    # Entropy is written as whole bits, and can be no more than log2 of the
+    # number of pixels in the largest disk, so the output type only has to
+    # hold that. No pixel is ever NoData, so none is set.
+    maxEntropy = int(np.ceil(np.log2(max(DiskFootprint(r).sum() for r in diskRadii))))
+    dataType = pc.SmallestDataType(0, maxEntropy)
+    # One band per radius unless each gets its own file.
+    nBands = 1 if len(dst_filenames) > 1 else len(diskRadii)
+
+    if engine == "histogram":
+        inNoData = b.GetNoDataValue()
+        breaks = he.BandBreaks(b, bins, quantization, breaks, inNoData)
+        pc.printandlog("Histogram engine with {} {} bins{}.".format(len(breaks) + 1, quantization, "" if he.haveNumba else " (numba not found, using NumPy)"), theLog)
+        entropyFn = functools.partial(he.HistogramEntropyStack, radii=diskRadii, breaks=breaks, noData=inNoData)
+    else:
+        entropyFn = functools.partial(EntropyStack, radii=diskRadii) # TODO: change to square? Or later work to disk?
+
+    if isMosaic:
+        # Written as tiles into output directories, found again through the
+        # VRTs made of them.
+        pc.printandlog("Calculating local entropy tile by tile on {} threads. Please wait, this make take a while...".format(workers), theLog)
+        with ins.Stage("entropy ({} engine)".format(engine), theLog, pixels=b.XSize * b.YSize * len(diskRadii)):
+            dst_filenames = MosaicEntropy(b, dst_filenames, nBands, dataType, max(diskRadii), workers, entropyFn, theLog)
+        for dst_filename in dst_filenames:
+            pc.printandlog("Written out to: " + dst_filename, theLog)
+        return dst_filenames
+
+    # Writing to file with tranform info.
+    out_dss = []
+    oBands = []
+    for dst_filename in dst_filenames:
+        out_ds = pc.CreateOutput(dst_filename, b.XSize, b.YSize, nBands, dataType, ds, noData=None)
+        for nBand in range(1, nBands + 1):
+            oBands.append(out_ds.GetRasterBand(nBand))
+        out_dss.append(out_ds)
+
+    # Calc entropy on disk-shaped kernel of given size...
+    pc.printandlog("Calculating local entropy. Please wait, this make take a while...", theLog)
+    with ins.Stage("entropy ({} engine)".format(engine), theLog, pixels=b.XSize * b.YSize * len(diskRadii)):
+        if tileSize is None:
+            bArr = gdal.Band.ReadAsArray(b)
+            for oBand, ent in zip(oBands, entropyFn(bArr)):
+                oBand.WriteArray(ent)
+        else:
+            pc.printandlog("Using {} by {} tiles on {} threads.".format(tileSize, tileSize, workers), theLog)
+            TiledEntropy(b, oBands, max(diskRadii), tileSize, workers, entropyFn)
+    with ins.Stage("statistics", theLog):
+        for oBand in oBands:
+            oBand.ComputeStatistics(True)
+        for out_ds in out_dss:
+            pc.FinishOutput(out_ds)
+
+    for dst_filename in dst_filenames:
+        pc.printandlog("Written out to: " + dst_filename, theLog)
+
+    return dst_filenames
 
 
 def main():
 
     parser = argparse.ArgumentParser(description="Calculates local entropy by on pixel-by-pixel basis, outputs an image of this.")
-    parser.add_argument('INIMAGE', help="Full path to the input image.")
-    parser.add_argument('OUTIMAGE', help="Full path to the output image.")
-    parser.add_argument('DISKRADIUS', help="Size in pixels of disk structuring element (i.e., kernel) to use.")
+    parser.add_argument('INIMAGE', help="Full path to the input image, or to a directory of GeoTiff tiles to process tile by tile without mosaicking them.")
+    parser.add_argument('OUTIMAGE', help="Full path to the output image, or for tiled input, to a directory to write matching output tiles to, together with a VRT of them.")
+    parser.add_argument('DISKRADIUS', help="Size in pixels of disk structuring element (i.e., kernel) to use. Give several as a comma-separated list (e.g. 4,8,16) to calculate them all in one pass, written as the bands of OUTIMAGE in that order, or see --separate.")
+    parser.add_argument('--mosaic', action="store_true", help="Read an INIMAGE VRT as a list of tiles to process tile by tile, like a directory of them, rather than as one raster. Only the VRT's list of files is used, not its source windows or NoData.")
+    parser.add_argument('--separate', action="store_true", help="With several radii, write each layer to its own file, named OUTIMAGE with _r<radius> added, instead of as bands of one file.")
+    parser.add_argument('--tilesize', type=int, help="Calculate entropy in tiles of this many pixels square, streamed to the output, instead of on the whole raster at once.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of threads to calculate tiles on when --tilesize is given. Default is 1.")
+    parser.add_argument('--engine', choices=["skimage", "histogram"], default="skimage", help="'skimage' uses scikit-image's rank entropy on the raster cast to uint16. 'histogram' quantizes elevations into --bins bins first and uses a sliding histogram, which is much faster and works on float and negative elevations. Default is skimage.")
+    parser.add_argument('--bins', type=int, default=256, help="Number of elevation bins for the histogram engine. Default is 256.")
+    parser.add_argument('--quantization', choices=he.quantizationMethods, default="fixed", help="How the histogram engine bins elevations: 'fixed' width, 'quantile' (equal counts), or the given --breaks. Default is fixed.")
+    parser.add_argument('--breaks', help="Comma-separated bin edges for --quantization breaks.")
+    rc.AddCacheArguments(parser)
+    pc.AddOutputArguments(parser)
+    ins.AddInstrumentationArguments(parser)
     args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
     inIMAGE = args.INIMAGE
     outIMAGE = args.OUTIMAGE
-    diskRadius = int(args.DISKRADIUS)
+    diskRadii = [int(r) for r in args.DISKRADIUS.split(",")]
 
-    NoDataVal = -99999
     gdal.UseExceptions()
 
     # Set up log file location.
@@ -48,46 +226,18 @@ def main():
     theLog              = os.path.join(outPathDir, outFileNoExt + "_log.txt")
 
 
-    # Note and print start time
-    startTime = datetime.datetime.now()
+    # Note and print start time; the stage logs the total time at the end.
     print("")
-    pc.printandlog("Starting " + scriptName + " at " + str(startTime), theLog)
+    pc.printandlog("Starting " + scriptName + " at " + ins.Timestamp(), theLog)
 
     pc.printandlog("Input file:  " + str(inIMAGE), theLog)
     pc.printandlog("Output file: " + str(outIMAGE), theLog)
-    pc.printandlog("diskRadius:  {}".format(str(diskRadius)), theLog)
-
-    # Open and load data, convert to numpy array.
-    ds = gdal.Open(inIMAGE)
-    b = ds.GetRasterBand(1) # Assuming only 1 band.
-    bArr = gdal.Band.ReadAsArray(b)
-    bArr_u16 = bArr.astype(np.uint16) # unsigned 16 bit integer - possibly bad with some input rasters.
+    pc.printandlog("diskRadius:  {}".format(", ".join(str(r) for r in diskRadii)), theLog)
 
-    # Get geotransform and projection information.
-    geoTrans = ds.GetGeoTransform()
-    wktProjection = ds.GetProjection()
-
-    # Calc entropy on disk-shaped kernel of given size...
-    pc.printandlog("Calculating local entropy. Please wait, this make take a while...", theLog)
-    ent = entropy(bArr_u16, disk(diskRadius)) # TODO: change to square? Or later work to disk?
-
-    # Writing to file with tranform info.
-    driver = gdal.GetDriverByName("GTiff")
-    dst_filename = outIMAGE
-    out_ds = driver.Create(dst_filename, b.XSize, b.YSize, 1, gdal.GDT_UInt16) # unsigned 16 bit integer
-    # out_ds = driver.Create(dst_filename, b.XSize, b.YSize, 1, gdal.GDT_Int32) # unsigned 32 bit integer
-    out_ds.SetGeoTransform(geoTrans)
-    out_ds.SetProjection(wktProjection)
-    oBand = out_ds.GetRasterBand(1)
-    oBand.SetNoDataValue(NoDataVal)
-    oBand.WriteArray(ent)
-    oBand.ComputeStatistics(True)
-
-    pc.printandlog("Written out to: " + dst_filename, theLog)
-
-    # Print ending message for script.
-    endTime = datetime.datetime.now()
-    pc.printandlog("Ending at " + str(endTime) + ". Total time: " + str(endTime - startTime) + "\n", theLog)
+    with ins.Stage(scriptName, theLog):
+        CalculateEntropy(inIMAGE, outIMAGE, diskRadii, theLog, args.tilesize, args.workers, args.engine, args.bins, args.quantization, args.breaks and [float(x) for x in args.breaks.split(",")], args.separate, rc.SettingsFromArgs(args), args.mosaic)
+    if args.cache_dir is not None:
+        rc.ReportStats()
 
 
 if __name__ == "__main__":
@@ -11,19 +11,53 @@
 
 
 import numpy as np
-import gdal, os, argparse, datetime, sys
+import gdal, os, argparse
+import processingCommon as pc
+import instrumentation as ins
+import rasterCache as rc
 
-def performscaling(raster_at_scale, raster_to_scale):
+def ScaleParameters(atSMin, atSMax, toSMin, toSMax):
 
-    startTime = datetime.datetime.now()
+    """The shift and scalar performscaling applies to take values in toSMin to toSMax into atSMin to atSMax. The shift is only ever upwards, so is 0 if toSMin is already at or above atSMin."""
+
+    scalar = (atSMax - atSMin) / (toSMax - toSMin)
+    shift = max(0.0, atSMin - toSMin)
+    return shift, scalar
+
+def ScaleArray(toSArray, noDataValues, atSMin, shift, scalar, NoDataVal=-99999.0):
+
+    """Shifts and scales an array of values to scale as performscaling does, as float32, with cells equal to any of noDataValues (or NaN) set to NoDataVal. Returns the scaled array and its NoData mask."""
+
+    toSArray = toSArray.astype("float32")
+    noData = pc.NoDataMask(toSArray, noDataValues)
+    # Shift, then stretch everything above the at-scale minimum away from it,
+    # in one go.
+    toSArray = toSArray + shift
+    toSArray = np.where(toSArray > atSMin, (toSArray - atSMin) * scalar + atSMin, toSArray).astype("float32")
+    toSArray[noData] = NoDataVal
+    return toSArray, noData
+
+def performscaling(raster_at_scale, raster_to_scale, outRast=None, cache=None):
+
+    """Scales the values of raster_to_scale to the range of raster_at_scale, in two passes through it: one for its range (skipped when it has exact statistics stored), and one to shift and scale each block and write it out. NoData cells, -99999 or the rasters' own NoData values, are left out of the ranges and written out as -99999. The output goes next to raster_to_scale unless outRast is given. cache is an optional rasterCache.CacheSettings. Returns the path written to."""
+
+    NoDataVal = -99999.0
+
+    if outRast is None:
+        toSDir, toSFile = os.path.split(raster_to_scale)
+        toSbasename = os.path.splitext( toSFile )[0]
+        atSDir, atSFile = os.path.split(raster_at_scale)
+        atSbasename = os.path.splitext( atSFile )[0]
+        outRast = os.path.join(toSDir, toSbasename + "_scaledto_" + atSbasename + ".tif")
+
+    if cache is not None:
+        rc.CachedRun(cache, "scale", [raster_at_scale, raster_to_scale], {"output": dict(pc.Current(pc.outputSettings))}, [outRast], lambda: performscaling(raster_at_scale, raster_to_scale, outRast))
+        return outRast
 
     print("Reading raster at scale...")
     atSData = gdal.Open(raster_at_scale)
     atSBand = atSData.GetRasterBand(1)
-    atSArray = gdal.Band.ReadAsArray(atSBand).astype("float32")
-    atSMin = np.amin(atSArray)
-    atSMax = np.amax(atSArray)
-    atSRange = atSMax - atSMin
+    atSMin, atSMax = pc.BandRange(atSBand, [NoDataVal])
     print("At-scale min and max: " + str(atSMin) + " " + str(atSMax))
 
     print("Reading raster to scale...")
@@ -31,73 +65,59 @@ def performscaling(raster_at_scale, raster_to_scale):
     toSBand = toSData.GetRasterBand(1)
     toSXSize = toSBand.XSize
     toSYSize = toSBand.YSize
-    GeoTransform = toSData.GetGeoTransform()
-    WKTProjection = toSData.GetProjection()
-    toSArray = gdal.Band.ReadAsArray(toSBand).astype("float32")
-    toSMin = np.amin(toSArray)
-    toSMax = np.amax(toSArray)
-    toSRange = toSMax - toSMin
+    toSNoData = toSBand.GetNoDataValue()
+    toSMin, toSMax = pc.BandRange(toSBand, [NoDataVal])
     print("To-scale min and max: " + str(toSMin) + " " + str(toSMax))
 
-    scalar = atSRange / toSRange
+    shift, scalar = ScaleParameters(atSMin, atSMax, toSMin, toSMax)
     print("Scalar is " + str(scalar))
-    shift = atSMin - toSMin
-    print("Shift is " + str(shift))
+    print("Shift is " + str(atSMin - toSMin))
     if shift > 0.0:
         print("Shifting to-scale array")
-        for x in np.nditer(toSArray, op_flags=["readwrite"]):
-            x[...] = x + shift
-    print("Scaling to-scale array...")
 
-    iterlabel = 1
-    iCount = toSArray.size
-
-    for x in np.nditer(toSArray, op_flags=["readwrite"]):
-
-        # sys.stdout.flush() # Commented progress report out - really slows down the code when run for every array element!
-
-        if x > atSMin:
-            diff = x - atSMin
-            x[...] = (diff * scalar) + atSMin
-
-        # prcnt = round(( float(iterlabel) / float(iCount) ) * 100 , 3)
-        # sys.stdout.write("\r")
-        # sys.stdout.write("Progress: " + str(iterlabel) + " of " + str(iCount) + " | "  + str(prcnt) + r" %... | Elapsed: " + str(datetime.datetime.now() - startTime))
-        # iterlabel += 1
-        # if prcnt == 100.0:
-        #     print("\n")
-
-    print("New min and max of scaled array: " + str(np.amin(toSArray)) + " " + str(np.amax(toSArray)))
-
-    print("Writing out to disk...")
-    toSDir, toSFile = os.path.split(raster_to_scale)
-    toSbasename = os.path.splitext( toSFile )[0]
-    atSDir, atSFile = os.path.split(raster_at_scale)
-    atSbasename = os.path.splitext( atSFile )[0]
-    outRast = os.path.join(toSDir, toSbasename + "_scaledto_" + atSbasename + ".tif")
-
-    driver = gdal.GetDriverByName("GTiff")
-    ds = driver.Create(outRast, toSXSize, toSYSize, 1, gdal.GDT_Float32)
-    ds.SetGeoTransform(GeoTransform)
-    ds.SetProjection(WKTProjection)
+    ds = pc.CreateOutput(outRast, toSXSize, toSYSize, 1, gdal.GDT_Float32, toSData, NoDataVal)
     dsB1 = ds.GetRasterBand(1)
-    dsB1.SetNoDataValue(-99999.0)
-    dsB1.WriteArray(toSArray)
-    ds.FlushCache()
+
+    print("Scaling to-scale array...")
+    newMin = None
+    newMax = None
+    windows = list(pc.StripWindows(toSBand))
+    with ins.Stage("scale", pixels=toSXSize * toSYSize), ins.Progress(len(windows), "Strips") as progress:
+        for window in windows:
+            toSArray, noData = ScaleArray(toSBand.ReadAsArray(*window), [NoDataVal, toSNoData], atSMin, shift, scalar, NoDataVal)
+            dsB1.WriteArray(toSArray, window[0], window[1])
+            if not noData.all():
+                scaled = toSArray[~noData]
+                newMin = scaled.min() if newMin is None else min(newMin, scaled.min())
+                newMax = scaled.max() if newMax is None else max(newMax, scaled.max())
+            progress.update()
+
+    print("New min and max of scaled array: " + str(newMin) + " " + str(newMax))
+
+    pc.FinishOutput(ds)
 
     print("Written out to: " + outRast)
 
+    return outRast
+
 def main():
 
     parser = argparse.ArgumentParser(description="Takes two one-band rasters, and scales the pixel z-values in the second one to match the range of the first one.")
     parser.add_argument('INRAST_ATSCALE')
     parser.add_argument('INRAST_TOSCALE')
+    rc.AddCacheArguments(parser)
+    pc.AddOutputArguments(parser)
+    ins.AddInstrumentationArguments(parser)
     args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
 
     print("Input raster at scale: " + args.INRAST_ATSCALE)
     print("Input raster to scale: " + args.INRAST_TOSCALE)
 
-    performscaling(args.INRAST_ATSCALE, args.INRAST_TOSCALE)
+    performscaling(args.INRAST_ATSCALE, args.INRAST_TOSCALE, cache=rc.SettingsFromArgs(args))
+    if args.cache_dir is not None:
+        rc.ReportStats()
 
     print("Done")
 
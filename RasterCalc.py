@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Raster algebra in one pass. Evaluates an expression over named one-band
+# rasters of the same size, e.g.
+#   RasterCalc.py out.tif "where(mask == 0, 0, dem * 1.5)" --input dem=dem.tif --input mask=coast.tif
+# which does the work of Multiply.py then ZeroBurner.py without the file in
+# between. Uses numexpr if it is installed, which evaluates each block without
+# a temporary array per operation, and falls back on NumPy otherwise.
+
+import numpy as np
+import argparse, ast
+from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor
+import processingCommon as pc
+import instrumentation as ins
+
+try:
+    import numexpr
+    haveNumexpr = True
+except ImportError:
+    haveNumexpr = False
+
+
+# Functions expressions may call, and their NumPy equivalents. All of them are
+# also numexpr functions.
+functions = {
+    "where": np.where,
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "log": np.log,
+    "log10": np.log10,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "arcsin": np.arcsin,
+    "arccos": np.arccos,
+    "arctan": np.arctan,
+    "arctan2": np.arctan2,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+}
+
+allowedNodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+                ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd, ast.Invert,
+                ast.BitAnd, ast.BitOr, ast.BitXor, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+
+def CompileExpression(expression, names):
+
+    """Checks that expression only uses arithmetic, comparisons, & | ~ for logic, numbers, the given raster names and the functions above, and compiles it once for evaluating on every block. Raises ValueError if it doesn't."""
+
+    tree = ast.parse(expression, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, allowedNodes):
+            raise ValueError("Not allowed in a raster expression: " + type(node).__name__)
+        if isinstance(node, ast.Name) and node.id not in names and node.id not in functions:
+            raise ValueError("Unknown name in raster expression: " + node.id)
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in functions):
+            raise ValueError("Only these functions may be called: " + ", ".join(sorted(functions)))
+        if isinstance(node, ast.Compare) and len(node.ops) > 1:
+            raise ValueError("Chained comparisons aren't supported, combine them with & instead.")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("Only numbers may be used as constants in a raster expression.")
+    return compile(tree, "<expression>", "eval")
+
+def EvaluateBlock(code, expression, blocks):
+
+    """Evaluates the compiled expression on a dictionary of same-shaped blocks, one per raster name."""
+
+    if haveNumexpr:
+        return numexpr.evaluate(expression, local_dict=blocks)
+    namespace = dict(functions)
+    namespace.update(blocks)
+    return eval(code, {"__builtins__": {}}, namespace)
+
+def EvaluateStripWithNoData(code, expression, blocks, noDataValues):
+
+    """EvaluateBlock, then sets pixels that are NoData in any input block to -99999.0. noDataValues gives each input's own NoData value, or None."""
+
+    NoDataVal = -99999.0
+    shape = next(iter(blocks.values())).shape
+    result = np.broadcast_to(EvaluateBlock(code, expression, blocks), shape).astype("float32")
+    noData = np.zeros(shape, dtype=bool)
+    for name, block in blocks.items():
+        noData |= pc.NoDataMask(block, [NoDataVal, noDataValues[name]])
+    result[noData] = NoDataVal
+    return result
+
+def RasterCalc(expression, inputs, outRast, workers=1):
+
+    """Evaluates expression over the rasters in inputs, a dictionary of name to path, and writes the result to outRast as a one-band 32-bit float GeoTiff with -99999.0 as NoData, georeferenced like the first input. Works a strip at a time in one pass, reading each strip of every input once. Pixels that are NoData in any input are NoData in the output. With numexpr each strip is evaluated on workers threads; without it, several strips are evaluated at once on a pool of workers threads."""
+
+    NoDataVal = -99999.0
+
+    code = CompileExpression(expression, inputs)
+
+    names = list(inputs)
+    datasets = [gdal.Open(inputs[name]) for name in names]
+    bands = [ds.GetRasterBand(1) for ds in datasets] # One-band rasters assumed.
+    xSize, ySize = bands[0].XSize, bands[0].YSize
+    for name, band in zip(names, bands):
+        if band.XSize != xSize or band.YSize != ySize:
+            raise ValueError("Raster '{}' isn't the same size as '{}'.".format(name, names[0]))
+
+    ds = pc.CreateOutput(outRast, xSize, ySize, 1, gdal.GDT_Float32, datasets[0], NoDataVal)
+    dsB1 = ds.GetRasterBand(1)
+
+    noDataValues = {name: band.GetNoDataValue() for name, band in zip(names, bands)}
+    windows = list(pc.StripWindows(bands[0]))
+
+    def readBlocks():
+        # Read in this thread only, as GDAL handles aren't thread safe.
+        for window in windows:
+            blocks = {name: band.ReadAsArray(*window) for name, band in zip(names, bands)}
+            yield code, expression, blocks, noDataValues
+
+    if haveNumexpr:
+        numexpr.set_num_threads(workers)
+        poolSize = 1
+    else:
+        poolSize = workers
+
+    with ins.Stage("calc", pixels=xSize * ySize), ThreadPoolExecutor(poolSize) as executor, ins.Progress(len(windows), "Strips") as progress:
+        for window, result in zip(windows, pc.BoundedMap(executor, EvaluateStripWithNoData, readBlocks(), 2 * poolSize)):
+            dsB1.WriteArray(result, window[0], window[1])
+            progress.update()
+    pc.FinishOutput(ds)
+
+    print("Written out to: " + outRast)
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Evaluates a raster algebra expression, e.g. \"where(mask == 0, 0, dem * 1.5)\", over named one-band GeoTiffs of the same size in a single pass, replacing chains of Multiply.py, ZeroBurner.py and the like and their intermediate files.")
+    parser.add_argument('OUTRAST', help="Full path to output GeoTiff. Created as a one-band 32-bit Float GeoTiff, with -99999.0 as NoData.")
+    parser.add_argument('EXPRESSION', help="The expression. May use the input names, numbers, + - * / ** %%, comparisons, & | ~ for and, or and not, and the functions " + ", ".join(sorted(functions)) + ".")
+    parser.add_argument('--input', action="append", required=True, metavar="NAME=PATH", help="A named input raster, e.g. dem=/data/dem.tif. Give once per raster.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of threads to evaluate on. Default is 1.")
+    pc.AddOutputArguments(parser)
+    ins.AddInstrumentationArguments(parser)
+    args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+
+    gdal.UseExceptions()
+    inputs = {}
+    for namedInput in args.input:
+        name, path = namedInput.split("=", 1)
+        inputs[name.strip()] = path
+
+    RasterCalc(args.EXPRESSION, inputs, args.OUTRAST, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,44 +10,32 @@
 
 
 import numpy as np
-import gdal, os, argparse, sys, datetime
+import gdal, os, argparse, multiprocessing
+import processingCommon as pc
+import instrumentation as ins
+import rasterCache as rc
+import mosaic
 
-def VariableLowPassFilter(dem, sizingRast):
+try:
+    from numba import njit, prange
+    haveNumba = True
+except ImportError:
+    haveNumba = False
 
-    startTime = datetime.datetime.now()
+def LoopFilter(demArray, sizingArray):
 
-    print("Reading DEM...")
-    demData = gdal.Open(dem)
-    demBand = demData.GetRasterBand(1)
-    demXSize = demBand.XSize
-    demYSize = demBand.YSize
-    demGeoTransform = demData.GetGeoTransform()
-    demWKTProjection = demData.GetProjection()
-    demArray = gdal.Band.ReadAsArray(demBand)
-    print("Reading sizing raster...")
-    sizingData = gdal.Open(sizingRast)
-    sizingBand = sizingData.GetRasterBand(1)
-    sizingXSize = sizingBand.XSize
-    sizingYSize = sizingBand.YSize
-    # Should check to see whether shape and GCS are the same for dem and sizing...
-    sizingArray = gdal.Band.ReadAsArray(sizingBand).astype("Int16")
+    """The original pixel-by-pixel variable kernel low-pass filter. Very slow on large rasters, kept as the reference implementation the faster engines can be checked against."""
 
-    # assert demArray.shape == sizingArray.shape
-
-    newArray = np.copy(demArray)
+    newArray = demArray.astype("float64")
 
     nRows, nCols = demArray.shape
-    print("Performing variable kernel low-pass filter...")
-    iterlabel = 1
-    iCount = demYSize
-
-    for nRow in range(demYSize):
+    progress = ins.Progress(nRows, "Rows")
 
-        sys.stdout.flush()
+    for nRow in range(nRows):
 
-        for nCol in range(demXSize):
+        for nCol in range(nCols):
             size = sizingArray[ nRow, nCol ]
-            shift = size / 2
+            shift = size // 2
             top = max(0, nRow - shift)
             bottom = min(nRows-1, nRow+shift)
             rows = demArray[top:bottom+1]
@@ -57,41 +45,563 @@ def VariableLowPassFilter(dem, sizingRast):
             nR, nC = kernel.shape
             newArray[nRow,nCol] = float(np.sum(kernel)) / nR / nC # the low pass filter
 
-        prcnt = round(( float(iterlabel) / float(iCount) ) * 100 , 3)
-        sys.stdout.write("\r")
-        sys.stdout.write("Progress: " + str(iterlabel) + " of " + str(iCount) + " | "  + str(prcnt) + r" %... | Elapsed: " + str(datetime.datetime.now() - startTime))
-        iterlabel += 1
-        if prcnt == 100.0:
-            print("\n")
+        progress.update()
+
+    progress.close()
+    return newArray
+
+# Fractional bits float DEMs are summed with. Their cells are rounded to
+# multiples of 2^-fixedPointBits and summed as int64, which is exact, so a
+# kernel's sum doesn't depend on the order it was added up in, and filtering
+# in tiles gives the same bits as filtering the whole raster at once. The
+# rounding, at most 2^-17 (under 0.00001), is below Float32's precision for
+# values over 128 in magnitude.
+fixedPointBits = 16
+
+def AccumulatorScale(demArray):
+
+    """The factor every cell of demArray is multiplied by before being rounded to int64 and summed (see FixedPoint), and each sum divided by after: 1 for integer rasters, which are summed exactly as they are, and 2^fixedPointBits for anything else. Raises ValueError if a float raster holds NaN or infinity, or values too big for its sums to fit in int64."""
+
+    if np.issubdtype(demArray.dtype, np.integer):
+        return 1
+    scale = 2 ** fixedPointBits
+    bound = max(float(np.max(np.abs(demArray[rows]))) for rows in pc.RowBands(demArray.shape[0]))
+    if not np.isfinite(bound):
+        raise ValueError("The DEM holds NaN or infinite values, which can't be averaged. Set them to a NoData value first.")
+    if bound * scale * demArray.size >= 2.0 ** 63:
+        raise ValueError("The DEM's values (up to {}) are too big to sum exactly over {} pixels. Filter it in blocks, or rescale it first.".format(bound, demArray.size))
+    return scale
+
+def FixedPoint(values, scale):
+
+    """values as the int64 multiples of 1 / scale they are summed as (see AccumulatorScale)."""
+
+    if scale == 1:
+        return values.astype(np.int64)
+    return np.rint(values * np.float64(scale)).astype(np.int64)
+
+def AccumulatorValues(demArray, scratch=False):
+
+    """Returns demArray as the int64 values running sums are taken in, and the scale they were multiplied by to get there (see AccumulatorScale). Converted a band of rows at a time into a new array, memory-mapped if scratch (see processingCommon.NewArray)."""
+
+    scale = AccumulatorScale(demArray)
+    values = pc.NewArray(demArray.shape, np.int64, scratch)
+    for rows in pc.RowBands(demArray.shape[0]):
+        values[rows] = FixedPoint(demArray[rows], scale)
+    return values, scale
+
+def SummedAreaTable(demArray, scratch=False):
+
+    """Returns the integral image of demArray, with a leading row and column of zeros so that sat[i, j] is the sum of demArray[:i, :j], and the scale every cell was multiplied by before summing (see AccumulatorScale). Built a band of rows at a time in place, each band carrying on from the last row of the one before, so the only full-size array is the table itself, memory-mapped if scratch."""
+
+    scale = AccumulatorScale(demArray)
+
+    nRows, nCols = demArray.shape
+    sat = pc.NewArray((nRows + 1, nCols + 1), np.int64, scratch)
+    sat[0] = 0
+    sat[:, 0] = 0
+    for rows in pc.RowBands(nRows):
+        block = sat[rows.start + 1:rows.stop + 1, 1:]
+        block[...] = FixedPoint(demArray[rows], scale)
+        np.cumsum(block, axis=1, out=block)
+        np.cumsum(block, axis=0, out=block)
+        block += sat[rows.start, 1:]
+
+    return sat, scale
+
+def SummedAreaTableFilter(demArray, sizingArray):
+
+    """Same result as LoopFilter, but every kernel sum is taken from four corners of a summed-area table, so the cost per pixel doesn't depend on kernel size. Kernels are clipped at the raster edges exactly as in LoopFilter. Works a band of rows at a time, so besides the table and the result there are only band-sized temporaries, and puts both in scratch files if they would not fit the memory budget (see processingCommon.UseScratch)."""
+
+    nRows, nCols = demArray.shape
+    scratch = pc.UseScratch(16 * demArray.size)
+    sat, scale = SummedAreaTable(demArray, scratch)
+    newArray = pc.NewArray(demArray.shape, np.float64, scratch)
+
+    colIdx = np.arange(nCols)[np.newaxis, :]
+    for rows in pc.RowBands(nRows):
+        shift = sizingArray[rows].astype(np.int64) // 2
+        rowIdx = np.arange(rows.start, rows.stop)[:, np.newaxis]
+        # Corners of each kernel in sat coordinates, i.e. bottom and right are
+        # one past the last row and column included.
+        top = np.maximum(rowIdx - shift, 0)
+        bottom = np.minimum(rowIdx + shift, nRows - 1) + 1
+        left = np.maximum(colIdx - shift, 0)
+        right = np.minimum(colIdx + shift, nCols - 1) + 1
+
+        kernelSums = sat[bottom, right] - sat[top, right] - sat[bottom, left] + sat[top, left]
+        kernelCounts = (bottom - top) * (right - left)
+        newArray[rows] = kernelSums / (kernelCounts * scale)
+
+    return newArray
+
+def ClippedBoxSum(values, shift, axis):
+
+    """Sums values over windows reaching shift cells either side of each cell along the given axis, clipped at the array edges. Returns the sums and the number of cells in each window."""
+
+    n = values.shape[axis]
+    cumShape = list(values.shape)
+    cumShape[axis] += 1
+    cum = np.zeros(cumShape, dtype=values.dtype)
+    inner = [slice(None)] * values.ndim
+    inner[axis] = slice(1, None)
+    np.cumsum(values, axis=axis, out=cum[tuple(inner)])
+
+    idx = np.arange(n)
+    lo = np.maximum(idx - shift, 0)
+    hi = np.minimum(idx + shift, n - 1) + 1
+    sums = np.take(cum, hi, axis=axis) - np.take(cum, lo, axis=axis)
+
+    return sums, hi - lo
+
+def BandBoxSums(values, shift, rows):
+
+    """Sums of values over the squares reaching shift cells either side of each cell in the band rows, clipped at the array edges, and the number of cells in each. Only the rows those squares reach are read, so every temporary is about the size of the band."""
+
+    nRows = values.shape[0]
+    top = max(0, rows.start - shift)
+    bottom = min(nRows, rows.stop + shift)
+    cum = np.zeros((bottom - top + 1, values.shape[1]), dtype=values.dtype)
+    np.cumsum(values[top:bottom], axis=0, out=cum[1:])
+
+    idx = np.arange(rows.start, rows.stop)
+    lo = np.maximum(idx - shift, 0)
+    hi = np.minimum(idx + shift, nRows - 1) + 1
+    sums, colCounts = ClippedBoxSum(cum[hi - top] - cum[lo - top], shift, 1)
+
+    return sums, (hi - lo)[:, np.newaxis] * colCounts[np.newaxis, :]
+
+def BucketFilter(demArray, sizingArray):
+
+    """Same result as LoopFilter, but runs one fixed-size box filter per distinct kernel size in sizingArray and keeps its result only for the pixels that asked for that size. Sizing rasters usually hold only a few dozen sizes, so this is quick. Buckets are done one at a time, a band of rows at a time (see BandBoxSums), skipping bands without the bucket's size, so besides the accumulated values and the result, both in scratch files if they would not fit the memory budget (see processingCommon.UseScratch), there are only band-sized temporaries whatever the number of sizes."""
+
+    nRows, nCols = demArray.shape
+    scratch = pc.UseScratch(16 * demArray.size)
+    values, scale = AccumulatorValues(demArray, scratch)
+    newArray = pc.NewArray(demArray.shape, np.float64, scratch)
+
+    sizes = np.unique(np.concatenate([np.unique(sizingArray[rows]) for rows in pc.RowBands(nRows)]))
+    print("Filtering {} kernel size buckets...".format(len(sizes)))
+
+    for size in sizes:
+
+        with ins.Stage("kernel size {}".format(size)) as stage:
+
+            shift = int(size) // 2
+            stage.pixels = 0
+            for rows in pc.RowBands(nRows):
+                inBucket = sizingArray[rows] == size
+                if not inBucket.any():
+                    continue
+                sums, counts = BandBoxSums(values, shift, rows)
+                newArray[rows][inBucket] = (sums / (counts * scale))[inBucket]
+                stage.pixels += int(np.count_nonzero(inBucket))
+
+    return newArray
+
+def RowPrefixSums(demArray, scratch=False):
+
+    """Running sums along each row of demArray, with a leading column of zeros so that sums[i, j] is the sum of demArray[i, :j], and the scale every cell was multiplied by first (see AccumulatorScale). Built a band of rows at a time, memory-mapped if scratch."""
+
+    scale = AccumulatorScale(demArray)
+    nRows, nCols = demArray.shape
+    sums = pc.NewArray((nRows, nCols + 1), np.int64, scratch)
+    sums[:, 0] = 0
+    for rows in pc.RowBands(nRows):
+        block = sums[rows, 1:]
+        block[...] = FixedPoint(demArray[rows], scale)
+        np.cumsum(block, axis=1, out=block)
+    return sums, scale
+
+def DiskSpans(radiusArray):
+
+    """The distinct radii in radiusArray, the half-width of every row of a disk of each (see processingCommon.DiskHalfWidths, -1 for rows beyond it) as one table, and a lookup from radius to row of that table."""
+
+    radii = np.unique(radiusArray)
+    maxRadius = int(radii[-1])
+    halfWidths = np.array([pc.DiskHalfWidths(int(r), maxRadius) for r in radii])
+    radiusIndex = np.zeros(maxRadius + 1, dtype=np.int64)
+    radiusIndex[radii] = np.arange(len(radii))
+    return radii, halfWidths, radiusIndex
+
+# Both disk mean implementations sum each row of a pixel's disk as the
+# difference of two row prefix sums, so a disk of radius r costs 2r + 1
+# lookups rather than (2r + 1)^2 additions. Rows and columns off the raster
+# are left out, and the mean is taken over the pixels that remain, as
+# LoopFilter does for square kernels.
+
+if haveNumba:
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def DiskMeanKernel(prefixSums, radiusArray, halfWidths, radiusIndex, scale, out):
+
+        """Compiled variable-radius disk means into out, in parallel over rows."""
+
+        nRows = radiusArray.shape[0]
+        nCols = radiusArray.shape[1]
+        maxRadius = (halfWidths.shape[1] - 1) // 2
+        for row in prange(nRows):
+            for col in range(nCols):
+                spans = halfWidths[radiusIndex[radiusArray[row, col]]]
+                total = prefixSums[0, 0] * 0
+                count = 0
+                for k in range(spans.shape[0]):
+                    w = spans[k]
+                    r = row + k - maxRadius
+                    if w < 0 or r < 0 or r >= nRows:
+                        continue
+                    left = max(0, col - w)
+                    right = min(nCols, col + w + 1)
+                    total += prefixSums[r, right] - prefixSums[r, left]
+                    count += right - left
+                out[row, col] = total / (count * scale)
+        return out
+
+def DiskMeanRows(prefixSums, radiusArray, halfWidths, radiusIndex, scale, radii, out):
+
+    """NumPy variable-radius disk means into out. Works a band of rows and one radius at a time, vectorized over that radius's pixels in the band, so the Python loop runs over disk rows only."""
+
+    nRows, nCols = radiusArray.shape
+    maxRadius = (halfWidths.shape[1] - 1) // 2
+    for rows in pc.RowBands(nRows):
+        bandRadii = radiusArray[rows]
+        for radius in radii:
+            pixRows, pixCols = np.nonzero(bandRadii == radius)
+            if pixRows.size == 0:
+                continue
+            pixRows += rows.start
+            total = np.zeros(pixRows.size, dtype=prefixSums.dtype)
+            count = np.zeros(pixRows.size, dtype=np.int64)
+            for k, w in enumerate(halfWidths[radiusIndex[radius]]):
+                if w < 0:
+                    continue
+                r = pixRows + k - maxRadius
+                inside = (r >= 0) & (r < nRows)
+                left = np.maximum(pixCols[inside] - w, 0)
+                right = np.minimum(pixCols[inside] + w + 1, nCols)
+                total[inside] += prefixSums[r[inside], right] - prefixSums[r[inside], left]
+                count[inside] += right - left
+            out[pixRows, pixCols] = total / (count * scale)
+    return out
+
+def DiskFilter(demArray, sizingArray):
+
+    """Like LoopFilter, but averages over disks rather than squares, of radius half the kernel size (rounded down, as for the squares' half-widths), with the same pixels as the disks LocalEntropy.py measures over. So kernel size 2r + 1 smooths over disk(r), and sizes 0 and 1 leave the pixel as it is. Disks are clipped at the raster edges. Uses numba if it is installed, and falls back on NumPy otherwise."""
 
-    inSizingDir, inSizingFile = os.path.split(sizingRast)
+    radiusArray = sizingArray.astype(np.int64) // 2
+    radii, halfWidths, radiusIndex = DiskSpans(radiusArray)
+    scratch = pc.UseScratch(16 * demArray.size)
+    prefixSums, scale = RowPrefixSums(demArray, scratch)
+    out = pc.NewArray(demArray.shape, np.float64, scratch)
+    if haveNumba:
+        return DiskMeanKernel(prefixSums, radiusArray, halfWidths, radiusIndex, scale, out)
+    return DiskMeanRows(prefixSums, radiusArray, halfWidths, radiusIndex, scale, radii, out)
+
+def PyramidCellSize(size):
+
+    """Pyramid cell size, as a fraction of a level, standing in for a box kernel of the given size. Interpolating bilinearly between cells of size c smooths like a box of c convolved with a tent reaching c either side, whose variance c^2 / 4 matches a box of size s's s^2 / 12 when c = s / sqrt(3)."""
+
+    return np.maximum(size, 1.0) / np.sqrt(3.0)
+
+def PyramidLevels(maxSize):
+
+    """Number of pyramid levels needed for kernels up to maxSize: enough that the coarsest level's cells are at least PyramidCellSize(maxSize) across. This depends only on the kernel sizes, not on the raster's, so a tile's pyramid has the same levels as the whole raster's."""
+
+    return int(np.ceil(np.log2(max(PyramidCellSize(maxSize), 1.0)))) + 1
+
+def BoxPyramid(demArray, nLevels, scratch=False):
+
+    """A box pyramid of demArray: level 0 is the array itself, and each level after is the mean of 2 by 2 blocks of the one before, so a cell of level k covers a 2^k by 2^k block. Blocks cut short by the raster edge are averaged over the cells they have. Returns the levels as one flat float64 array, with the offset of each level in it, and the levels' shapes. Each cell is summed from the same cells in the same order wherever the pyramid starts, so on blocks aligned to its coarsest cells (see PyramidCell) it is the same to the bit as the whole raster's. Takes O(N) time and 4/3 N space in all, plus N / 4 for the sums of the level before, all memory-mapped if scratch (see processingCommon.NewArray), and is built a band of rows at a time so other temporaries are band-sized."""
+
+    shapes = [demArray.shape]
+    for level in range(1, nLevels):
+        shapes.append(((shapes[-1][0] + 1) // 2, (shapes[-1][1] + 1) // 2))
+    sizes = [nRows * nCols for nRows, nCols in shapes]
+    offsets = np.cumsum([0] + sizes[:-1])
+    pyramid = pc.NewArray((sum(sizes),), np.float64, scratch)
+
+    sums = pyramid[:sizes[0]].reshape(shapes[0])
+    for rows in pc.RowBands(shapes[0][0]):
+        sums[rows] = demArray[rows]
+    for level in range(1, nLevels):
+        nRows, nCols = shapes[level]
+        prevRows, prevCols = shapes[level - 1]
+        means = pyramid[offsets[level]:offsets[level] + sizes[level]].reshape(nRows, nCols)
+        levelSums = pc.NewArray((nRows, nCols), np.float64, scratch) if level < nLevels - 1 else None
+        # Cells of this level cover 2^level pixels a side, fewer at the far edges.
+        cell = 2 ** level
+        colCounts = np.minimum(np.arange(1, nCols + 1) * cell, demArray.shape[1]) - np.arange(nCols) * cell
+        for rows in pc.RowBands(nRows):
+            block = sums[2 * rows.start:min(2 * rows.stop, prevRows)]
+            block = np.pad(block, ((0, 2 * (rows.stop - rows.start) - block.shape[0]), (0, prevCols % 2)))
+            blockSums = block[0::2, 0::2] + block[0::2, 1::2] + block[1::2, 0::2] + block[1::2, 1::2]
+            rowCounts = np.minimum(np.arange(rows.start + 1, rows.stop + 1) * cell, demArray.shape[0]) - np.arange(rows.start, rows.stop) * cell
+            means[rows] = blockSums / (rowCounts[:, np.newaxis] * colCounts[np.newaxis, :])
+            if levelSums is not None:
+                levelSums[rows] = blockSums
+        sums = levelSums
+    return pyramid, offsets, np.array(shapes)
+
+def SamplePyramid(pyramid, offsets, shapes, level, rows, cols):
+
+    """Bilinearly interpolates each pixel's own pyramid level at the pixel's centre. level, rows and cols are arrays with one entry per pixel. Samples beyond the outermost cell centres take the edge cells' values."""
+
+    scale = 2.0 ** level
+    heights = shapes[level, 0]
+    widths = shapes[level, 1]
+    # Pixel centre in the level's cell coordinates.
+    y = np.clip((rows + 0.5) / scale - 0.5, 0, heights - 1)
+    x = np.clip((cols + 0.5) / scale - 0.5, 0, widths - 1)
+    y0 = np.floor(y).astype(np.int64)
+    x0 = np.floor(x).astype(np.int64)
+    y1 = np.minimum(y0 + 1, heights - 1)
+    x1 = np.minimum(x0 + 1, widths - 1)
+    ty = y - y0
+    tx = x - x0
+    base = offsets[level]
+    top = pyramid[base + y0 * widths + x0] * (1 - tx) + pyramid[base + y0 * widths + x1] * tx
+    bottom = pyramid[base + y1 * widths + x0] * (1 - tx) + pyramid[base + y1 * widths + x1] * tx
+    return top * (1 - ty) + bottom * ty
+
+def PyramidFilter(demArray, sizingArray):
+
+    """Approximates LoopFilter's box means, mipmap style: each pixel's kernel size s, which may be fractional, gives a cell size c (see PyramidCellSize) falling between two levels of a box pyramid of the DEM (see BoxPyramid), with cells 2^floor(log2 c) and 2^ceil(log2 c) across. Both are bilinearly interpolated at the pixel and blended by where log2 c falls between them, i.e. trilinear interpolation. The cost per pixel is the same whatever the kernel size. Sizes up to sqrt(3) give the pixel itself. Being an approximation its kernels are softer edged than true squares, so results differ from the other engines by a fraction of the smoothing itself, but large fractional kernels are cheap and change continuously with their size."""
+
+    nRows, nCols = demArray.shape
+    nLevels = PyramidLevels(float(np.max(sizingArray)))
+    # The pyramid, the sums it is built from and the result.
+    scratch = pc.UseScratch(21 * demArray.size)
+    pyramid, offsets, shapes = BoxPyramid(demArray, nLevels, scratch)
+    newArray = pc.NewArray(demArray.shape, np.float64, scratch)
+
+    cols = np.arange(nCols)[np.newaxis, :]
+    for rows in pc.RowBands(nRows):
+        logSize = np.clip(np.log2(PyramidCellSize(sizingArray[rows].astype(np.float64))), 0, nLevels - 1)
+        lower = np.floor(logSize).astype(np.int64)
+        upper = np.minimum(lower + 1, nLevels - 1)
+        t = logSize - lower
+        rowIdx = np.broadcast_to(np.arange(rows.start, rows.stop)[:, np.newaxis], logSize.shape)
+        colIdx = np.broadcast_to(cols, logSize.shape)
+        below = SamplePyramid(pyramid, offsets, shapes, lower, rowIdx, colIdx)
+        above = SamplePyramid(pyramid, offsets, shapes, upper, rowIdx, colIdx)
+        newArray[rows] = below * (1 - t) + above * t
+
+    return newArray
+
+def PyramidCell(maxSize):
+
+    """Size in pixels of the coarsest pyramid level's cells for kernels up to maxSize. Tiles must start on multiples of it to match the whole-raster result (see PyramidHalo)."""
+
+    return 2 ** (PyramidLevels(maxSize) - 1)
+
+def PyramidHalo(maxSize):
+
+    """Halo for a tile of the pyramid engine with kernels up to maxSize: two of the coarsest level's cells. Interpolation reaches no further than that, so as long as tiles start on multiples of that cell size (i.e. the block size is a multiple of it), every pyramid cell a tile's pixels sample is built from the same pixels as on the whole raster."""
+
+    return 2 * PyramidCell(maxSize)
+
+def SizingType(filterFn):
+
+    """The type sizing rasters are read as for a filter engine. Only the pyramid engine can use fractional sizes; the others take whole sizes, as int16."""
+
+    return np.float32 if filterFn is PyramidFilter else np.int16
+
+def FilterHalo(filterFn, maxSize):
+
+    """Pixels a tile must be padded by so that filterFn gives the same result on it as on the whole raster, for kernels up to maxSize."""
+
+    if filterFn is PyramidFilter:
+        return PyramidHalo(maxSize)
+    return int(maxSize) // 2
+
+filterEngines = {
+    "loop": LoopFilter,
+    "sat": SummedAreaTableFilter,
+    "bucket": BucketFilter,
+    "disk": DiskFilter,
+    "pyramid": PyramidFilter,
+}
+
+def FilterWindow(demBand, sizingBand, window, filterFn):
+
+    """Filters one (xOff, yOff, xCount, yCount) window of a DEM band with filterFn, reading only that window plus a halo of half the largest kernel size in it (see FilterHalo). Returns the filtered window. Every kernel centred in the window fits inside the halo, or is clipped by the raster edge just as it would be on the whole array, so the result matches filtering the whole raster at once. It is bit-identical for every engine, float DEMs included, since their sums are exact (see AccumulatorScale); for the pyramid engine, on windows starting on multiples of its coarsest cell (see PyramidCell)."""
+
+    xOff, yOff, xCount, yCount = window
+    coreSizing = sizingBand.ReadAsArray(xOff, yOff, xCount, yCount).astype(SizingType(filterFn))
+    halo = max(0, FilterHalo(filterFn, np.ceil(coreSizing.max())))
+    padded, core = pc.PadWindow(window, halo, demBand.XSize, demBand.YSize)
+
+    demBlock = demBand.ReadAsArray(*padded)
+    # Halo pixels are only there to be averaged in, their own results are
+    # thrown away, so give them the cheapest possible kernel.
+    sizingBlock = np.zeros(demBlock.shape, dtype=coreSizing.dtype)
+    sizingBlock[core] = coreSizing
+
+    return filterFn(demBlock, sizingBlock)[core]
+
+# Rasters and output buffer of a ParallelFilter worker process, opened once
+# per process by InitFilterWorker.
+workerState = {}
+
+def InitFilterWorker(dem, sizingRast, scratchFile, engine):
+
+    """Pool initializer for ParallelFilter. Each worker opens the input rasters itself, so only window tuples ever cross process boundaries, and maps the shared output scratch file."""
+
+    workerState["demData"] = gdal.Open(dem)
+    workerState["sizingData"] = gdal.Open(sizingRast)
+    demBand = workerState["demData"].GetRasterBand(1)
+    workerState["out"] = np.memmap(scratchFile, dtype=np.float32, mode="r+", shape=(demBand.YSize, demBand.XSize))
+    workerState["filterFn"] = filterEngines[engine]
+
+def FilterTileWorker(window):
+
+    """Filters one window in a worker process and puts it into the shared output buffer. Returns the window so the writer knows which part of the buffer is ready."""
+
+    xOff, yOff, xCount, yCount = window
+    filtered = FilterWindow(workerState["demData"].GetRasterBand(1), workerState["sizingData"].GetRasterBand(1), window, workerState["filterFn"])
+    workerState["out"][yOff:yOff+yCount, xOff:xOff+xCount] = filtered
+    workerState["out"].flush()
+    return window
+
+def ParallelFilter(dem, sizingRast, outBand, engine, blockSize, workers):
+
+    """Filters dem tile by tile across a pool of worker processes, with this process as the only writer to outBand. Workers read their own halo-padded windows straight from the input files and leave results in a memory-mapped scratch file (see processingCommon.NewSharedArray), which is removed afterwards. Tiles with the largest kernels are the slowest, so they are started first to keep the pool busy to the end."""
+
+    sizingBand = gdal.Open(sizingRast).GetRasterBand(1)
+    xSize, ySize = sizingBand.XSize, sizingBand.YSize
+
+    windows = list(pc.TileWindows(xSize, ySize, blockSize))
+    maxKernels = [int(sizingBand.ReadAsArray(*window).max()) for window in windows]
+    windows = [window for maxKernel, window in sorted(zip(maxKernels, windows), key=lambda pair: -pair[0])]
+
+    out, scratchFile = pc.NewSharedArray((ySize, xSize), np.float32)
+    try:
+        with multiprocessing.Pool(workers, InitFilterWorker, (dem, sizingRast, scratchFile, engine)) as pool:
+            with ins.Progress(len(windows), "Blocks") as progress:
+                for window in pool.imap_unordered(FilterTileWorker, windows):
+                    xOff, yOff, xCount, yCount = window
+                    outBand.WriteArray(out[yOff:yOff+yCount, xOff:xOff+xCount], xOff, yOff)
+                    progress.update()
+        del out
+    finally:
+        os.remove(scratchFile)
+
+def MosaicFilter(dem, sizingRast, outDir, filterFn, vrtTiles=False):
+
+    """Filters a DEM that is a mosaic of tiles (see mosaic.py) with filterFn one source tile at a time, through FilterWindow, so each tile is read with its halo from whichever tiles overlap it and there are no seams. sizingRast may be a mosaic or a single raster, but must be on the same grid. vrtTiles is as for mosaic.Mosaic. Writes a matching output tile for each source tile into outDir, and a VRT of them, whose path is returned. The pyramid engine only gives seamless results on tiles starting on multiples of its coarsest cell (see PyramidCell), so raises ValueError for a mosaic whose tiles don't."""
+
+    demSource = mosaic.Mosaic(dem, vrtTiles)
+    sizingSource = mosaic.Mosaic(sizingRast, vrtTiles)
+    demSource.CheckAligned(sizingSource)
+    if filterFn is PyramidFilter:
+        cell = PyramidCell(pc.BandMinMax(sizingSource)[1])
+        for tile in demSource.tiles:
+            if tile.xOff % cell or tile.yOff % cell:
+                raise ValueError("Tile {} starts at pixel ({}, {}) of the mosaic, not on a multiple of the pyramid engine's {} pixel cells, so would leave seams. Use another engine, or tiles whose sizes are multiples of {}.".format(tile.path, tile.xOff, tile.yOff, cell, cell))
+    os.makedirs(outDir, exist_ok=True)
+    outPaths = mosaic.OutputTilePaths(demSource, outDir)
+    windows = demSource.TileWindows()
+    with ins.Progress(len(windows), "Tiles") as progress:
+        for n, window in enumerate(windows):
+            ds = mosaic.CreateTileOutput(demSource, n, outPaths[n], 1, gdal.GDT_Float32)
+            ds.GetRasterBand(1).WriteArray(FilterWindow(demSource, sizingSource, window, filterFn))
+            pc.FinishOutput(ds)
+            progress.update()
+    mosaic.ReportOpens(demSource)
+    return mosaic.BuildOutputVRT(outDir, outPaths)
+
+def VariableLowPassFilter(dem, sizingRast, engine="sat", blockSize=None, workers=1, outDEM=None, cache=None, vrtTiles=False):
+
+    """Filters dem with kernels sized by sizingRast and writes the result to outDEM, or next to the DEM if it isn't given, returning the path written to. Without a blockSize the rasters are read whole, into memory-mapped scratch files if they would not fit the memory budget (see processingCommon.UseScratch). If blockSize is given the rasters are streamed through in blockSize by blockSize windows (see FilterWindow), so memory depends on the block size rather than the raster size. With more than one worker the windows are spread over a process pool (see ParallelFilter), in blocks of 1024 pixels unless blockSize says otherwise. If dem is a mosaic of tiles (a directory of them, or a VRT of them with vrtTiles True, see mosaic.IsMosaic), it is filtered tile by tile in this process instead (see MosaicFilter), outDEM is a directory for the output tiles, and the path returned is a VRT of them. cache is an optional rasterCache.CacheSettings."""
+
+    isMosaic = mosaic.IsMosaic(dem, vrtTiles)
+    inSizingDir, inSizingFile = os.path.split(os.path.normpath(sizingRast) if mosaic.IsMosaic(sizingRast, vrtTiles) else sizingRast)
     inSizingbasename = os.path.splitext( inSizingFile )[0]
-    inDEMDir, inDEMFile = os.path.split(dem)
+    inDEMDir, inDEMFile = os.path.split(os.path.normpath(dem) if isMosaic else dem)
     inDEMbasename = os.path.splitext( inDEMFile )[0]
-    outDEM = os.path.join(inDEMDir, inDEMbasename + inSizingbasename + ".tif")
-    print("Writing out to disk...")
-    driver = gdal.GetDriverByName("GTiff")
-    ds = driver.Create(outDEM, demXSize, demYSize, 1, gdal.GDT_Float32)
-    ds.SetGeoTransform(demGeoTransform)
-    ds.SetProjection(demWKTProjection)
+    if outDEM is None:
+        outDEM = os.path.join(inDEMDir, inDEMbasename + inSizingbasename + ("" if isMosaic else ".tif"))
+
+    if isMosaic:
+        with ins.Stage("filter ({} engine)".format(engine)):
+            print("Performing variable kernel low-pass filter ({} engine) tile by tile...".format(engine))
+            outDEM = MosaicFilter(dem, sizingRast, outDEM, filterEngines[engine], vrtTiles)
+        print("Written out to: " + outDEM)
+        return outDEM
+
+    if cache is not None:
+        # The number of workers doesn't change the result, so isn't part of the
+        # key. The output profile and overviews change the file, so are.
+        rc.CachedRun(cache, "filter", [dem, sizingRast], {"engine": engine, "blockSize": blockSize, "output": dict(pc.Current(pc.outputSettings))}, [outDEM], lambda: VariableLowPassFilter(dem, sizingRast, engine, blockSize, workers, outDEM))
+        return outDEM
+
+    demData = gdal.Open(dem)
+    demBand = demData.GetRasterBand(1)
+    demXSize = demBand.XSize
+    demYSize = demBand.YSize
+    sizingData = gdal.Open(sizingRast)
+    sizingBand = sizingData.GetRasterBand(1)
+    # Should check to see whether shape and GCS are the same for dem and sizing...
+
+    ds = pc.CreateOutput(outDEM, demXSize, demYSize, 1, gdal.GDT_Float32, demData)
     dsB1 = ds.GetRasterBand(1)
-    dsB1.SetNoDataValue(-99999.0)
-    dsB1.WriteArray(newArray)
-    ds.FlushCache()
+
+    filterFn = filterEngines[engine]
+
+    with ins.Stage("filter ({} engine)".format(engine), pixels=demXSize * demYSize):
+        if workers > 1:
+            blockSize = blockSize or 1024
+            print("Performing variable kernel low-pass filter ({} engine) in {} by {} blocks on {} workers...".format(engine, blockSize, blockSize, workers))
+            ParallelFilter(dem, sizingRast, dsB1, engine, blockSize, workers)
+        elif blockSize is None:
+            # Read strip by strip into (possibly memory-mapped) buffers, the
+            # sizing raster truncated to the engine's sizing type on the way in.
+            scratch = pc.UseScratch(demXSize * demYSize * (demBand.ReadAsArray(0, 0, 1, 1).itemsize + 2))
+            print("Reading DEM...")
+            demArray = pc.ReadBand(demBand, scratch=scratch)
+            print("Reading sizing raster...")
+            sizingArray = pc.ReadBand(sizingBand, SizingType(filterFn), scratch)
+            print("Performing variable kernel low-pass filter ({} engine)...".format(engine))
+            newArray = filterFn(demArray, sizingArray)
+            print("Writing out to disk...")
+            pc.WriteBand(dsB1, newArray)
+        else:
+            print("Performing variable kernel low-pass filter ({} engine) in {} by {} blocks...".format(engine, blockSize, blockSize))
+            windows = list(pc.TileWindows(demXSize, demYSize, blockSize))
+            with ins.Progress(len(windows), "Blocks") as progress:
+                for window in windows:
+                    dsB1.WriteArray(FilterWindow(demBand, sizingBand, window, filterFn), window[0], window[1])
+                    progress.update()
+        pc.FinishOutput(ds)
 
     print("Written out to: " + outDEM)
 
+    return outDEM
+
 def main():
 
     parser = argparse.ArgumentParser(description="Performs a low-pass filter on a DEM or any raster using kernels whose dimensions are defined by the cells of another raster, which must be of the same size and shape.")
-    parser.add_argument('INDEM')
-    parser.add_argument('INSIZINGS')
+    parser.add_argument('INDEM', help="The DEM, or a directory of GeoTiff DEM tiles to filter tile by tile without mosaicking them, writing matching output tiles and a VRT of them to a directory.")
+    parser.add_argument('INSIZINGS', help="The kernel sizing raster, on the same grid as INDEM. May also be a directory of tiles.")
+    parser.add_argument('--mosaic', action="store_true", help="Read an INDEM or INSIZINGS VRT as a list of tiles to process tile by tile, like a directory of them, rather than as one raster. Only the VRT's list of files is used, not its source windows or NoData.")
+    parser.add_argument('--engine', choices=sorted(filterEngines), default="sat", help="How kernel means are computed. 'sat' uses a summed-area table, 'bucket' runs one box filter per distinct kernel size, 'loop' is the original pixel-by-pixel filter. These all average over squares. 'disk' averages over disks of radius half the kernel size instead, the neighbourhood LocalEntropy.py uses. 'pyramid' approximates the square means by interpolating in a box pyramid of the DEM, at the same cost whatever the kernel size, and keeps fractional kernel sizes; with --blocksize, make the block size a multiple of a power of two at least as big as the largest kernel for tiles to match the whole-raster result. Default is sat.")
+    parser.add_argument('--blocksize', type=int, help="Stream the rasters through in blocks of this many pixels square instead of reading them whole. Peak memory then depends on the block size (plus the halo of the largest kernel), not the raster size.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes to filter blocks on. Default is 1.")
+    rc.AddCacheArguments(parser)
+    pc.AddOutputArguments(parser)
+    pc.AddScratchArguments(parser)
+    ins.AddInstrumentationArguments(parser)
     args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+    pc.ConfigureScratch(args)
 
     print("Input DEM: " + args.INDEM)
     print("Input sizing raster: " + args.INSIZINGS)
 
-    VariableLowPassFilter(args.INDEM, args.INSIZINGS)
+    VariableLowPassFilter(args.INDEM, args.INSIZINGS, args.engine, args.blocksize, args.workers, cache=rc.SettingsFromArgs(args), vrtTiles=args.mosaic)
+    if args.cache_dir is not None:
+        rc.ReportStats()
 
     print("Done")
 
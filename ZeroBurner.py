@@ -12,59 +12,74 @@
 import numpy as np
 import os, argparse
 from osgeo import gdal
+import processingCommon as pc
+import instrumentation as ins
 
 
-def main():
+def BurnZeros(zeroedRasts, toBurnRast, outRast):
 
-    parser = argparse.ArgumentParser(description="Takes a one-band GeoTiff assumed to have some zero-valued pixels, and another one-band GeoTiff, and burns zero values into the second raster where the first one has them.")
-    parser.add_argument('IN_ZEROED_RAST', help="Full path to a one-band GeoTiff that contains zero-valued pixels to be replicated in the other raster.")
-    parser.add_argument('IN_TO_BURN_RAST', help="Full path to a one-band GeoTiff to be modified so that it has zero-valued pixels in the same locations as IN_ZEROED_RAST. Must be the same size in rows and columns.")
-    parser.add_argument('OUTRAST', help="Full path to output GeoTIFF, containing the pixel values of IN_TO_BURN_RAST, except where IN_ZEROED_RAST had zero-valued pixels, where the new pixel value is also zero. Created as a one-band 32-bit float GeoTiff, with -99999.0 as NoData.")
-    args = parser.parse_args()
+    """Writes outRast with the values of toBurnRast, except zero wherever any of the rasters in zeroedRasts is zero. Goes through the rasters a strip at a time, reading each strip of every raster once and burning all the masks into it in one pass, so any number of masks (coastline, lakes, glaciers...) take one run and no intermediate files. Returns outRast. Raises ValueError if the rasters aren't all the same size."""
 
-    print("Reading first GeoTiff...")
-    # 0
-    data0 = gdal.Open(args.IN_ZEROED_RAST)
-    band0 = data0.GetRasterBand(1)
-    arr0 = gdal.Band.ReadAsArray(band0).astype("float32")
-    nRowsO, nColsO = arr0.shape
-
-    print("Reading second GeoTiff...")
-    # 1
-    data1 = gdal.Open(args.IN_TO_BURN_RAST)
+    data1 = gdal.Open(toBurnRast)
     band1 = data1.GetRasterBand(1)
-    arr1 = gdal.Band.ReadAsArray(band1).astype("float32")
-    nRows1, nCols1 = arr1.shape
     # Also get information for building the georeferenced output GeoTiff
     # from this raster:
     band1XSize = band1.XSize
     band1YSize = band1.YSize
-    GeoTransform = data1.GetGeoTransform()
-    WKTProjection = data1.GetProjection()
 
-    # We check that both rasters are the same size in terms of rows by
-    # columns, since not being so would crash or array indexing in the
+    # We check that all rasters are the same size in terms of rows by
+    # columns, since not being so would crash our array indexing in the
     # next step.
-    if not ( ( nRows1 == nRowsO ) and ( nCols1 == nColsO ) ):
-        print("Number of rows and columns don't match! Aborting program.")
-        exit()
-
-    print("Burning zeros...")
-    for nRow in range(nRows1):
-        for nCol in range(nCols1):
-            if arr0[ nRow, nCol ] == 0.0:
-                arr1[ nRow, nCol ] = 0.0
-    
-    driver = gdal.GetDriverByName("GTiff")
-    ds = driver.Create(args.OUTRAST, band1XSize, band1YSize, 1, gdal.GDT_Float32)
-    ds.SetGeoTransform(GeoTransform)
-    ds.SetProjection(WKTProjection)
+    zeroedBands = []
+    for zeroedRast in zeroedRasts:
+        data0 = gdal.Open(zeroedRast)
+        band0 = data0.GetRasterBand(1)
+        if not ( ( band0.YSize == band1YSize ) and ( band0.XSize == band1XSize ) ):
+            raise ValueError("Number of rows and columns of '{}' don't match those of '{}'.".format(zeroedRast, toBurnRast))
+        zeroedBands.append((data0, band0))
+
+    # Integer rasters keep an integer type big enough for their values, zero
+    # and NoData, anything else is written as 32-bit float.
+    dataType = gdal.GDT_Float32
+    for intType, typeMin, typeMax in pc.integerDataTypes:
+        if band1.DataType == intType:
+            dataType = pc.SmallestDataType(min(typeMin, -99999), typeMax)
+    outType = "float32" if dataType == gdal.GDT_Float32 else None
+    ds = pc.CreateOutput(outRast, band1XSize, band1YSize, 1, dataType, data1)
     dsB1 = ds.GetRasterBand(1)
-    dsB1.SetNoDataValue(-99999.0)
-    dsB1.WriteArray(arr1)
-    ds.FlushCache()
 
-    print("Written out to: " + args.OUTRAST)
+    print("Burning zeros from {} raster(s)...".format(len(zeroedBands)))
+    windows = list(pc.StripWindows(band1))
+    with ins.Stage("burn", pixels=band1XSize * band1YSize), ins.Progress(len(windows), "Strips") as progress:
+        for window in windows:
+            arr1 = band1.ReadAsArray(*window)
+            if outType is not None:
+                arr1 = arr1.astype(outType)
+            zeroed = np.zeros(arr1.shape, dtype=bool)
+            for data0, band0 in zeroedBands:
+                zeroed |= band0.ReadAsArray(*window) == 0
+            dsB1.WriteArray(np.where(zeroed, arr1.dtype.type(0), arr1), window[0], window[1])
+            progress.update()
+    pc.FinishOutput(ds)
+
+    print("Written out to: " + outRast)
+
+    return outRast
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Takes a one-band GeoTiff assumed to have some zero-valued pixels, and another one-band GeoTiff, and burns zero values into the second raster where the first one has them.")
+    parser.add_argument('IN_ZEROED_RAST', help="Full path to a one-band GeoTiff that contains zero-valued pixels to be replicated in the other raster.")
+    parser.add_argument('IN_TO_BURN_RAST', help="Full path to a one-band GeoTiff to be modified so that it has zero-valued pixels in the same locations as IN_ZEROED_RAST. Must be the same size in rows and columns.")
+    parser.add_argument('OUTRAST', help="Full path to output GeoTIFF, containing the pixel values of IN_TO_BURN_RAST, except where IN_ZEROED_RAST had zero-valued pixels, where the new pixel value is also zero. Created as a one-band GeoTiff of the smallest integer type holding IN_TO_BURN_RAST's values if it is an integer raster, or as 32-bit float otherwise, with -99999.0 as NoData.")
+    parser.add_argument('--mask', action="append", default=[], help="Full path to a further one-band GeoTiff whose zero-valued pixels are burned in too, e.g. lakes or glaciers as well as a coastline. May be given any number of times.")
+    pc.AddOutputArguments(parser)
+    ins.AddInstrumentationArguments(parser)
+    args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+
+    BurnZeros([args.IN_ZEROED_RAST] + args.mask, args.IN_TO_BURN_RAST, args.OUTRAST)
 
 
 if __name__ == '__main__':
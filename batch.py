@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Runs entropy, filter, smooth (or any other pipeline.py stage type) over many
+# DEMs times many parameter values on a pool of worker processes that stay up
+# for the whole batch, so GDAL and scikit-image are imported once per worker
+# rather than once per job. Jobs come from a JSON manifest like:
+#
+# {
+#     "outputDir": "/data/sweep",
+#     "jobs": [
+#         {"tool": "entropy", "dem": "/data/a.tif", "params": {"radius": 8}}
+#     ],
+#     "sweeps": [
+#         {"tool": "entropy", "dems": ["/data/tiles/*.tif"], "grid": {"radius": [4, 8, 16], "engine": ["histogram"]}},
+#         {"tool": "filter", "dems": ["/data/tiles/*.tif"], "inputs": {"sizing": "/data/sizes.tif"}, "grid": {"engine": ["sat", "bucket"]}}
+#     ]
+# }
+#
+# or from the command line, as globs and a grid of parameter values. Each
+# sweep runs every combination of its grid on every DEM its globs match.
+# Outputs are named after the DEM, tool and parameters, in a directory per
+# tool. Each is written under a temporary name and renamed when complete, so
+# rerunning the same batch after a crash skips everything already done.
+#
+# A job's DEM is loaded into memory (GDAL's /vsimem/) by the worker that gets
+# it and kept there for that DEM's later jobs, and a DEM's jobs are handed out
+# in runs so they mostly land on the same worker.
+
+scriptName = "batch.py"
+
+import os, argparse, json, glob, itertools, multiprocessing, re, hashlib
+from osgeo import gdal
+import processingCommon as pc
+import instrumentation as ins
+import rasterCache as rc
+import pipeline
+
+
+# The input each tool takes its DEM as; any others come from the job's
+# "inputs".
+demInputs = {
+    "entropy": "image",
+    "filter": "dem",
+    "smooth": "raster",
+    "invert": "raster",
+    "scale": "toScale",
+}
+
+# DEMs held in memory by a worker process, most recently used last, and how
+# many it may hold at once.
+workerDems = []
+maxWorkerDems = 2
+
+
+def ExpandSweep(sweep):
+
+    """The jobs of one sweep: every combination of its grid's values on every DEM matched by its globs. Raises ValueError if a glob matches nothing."""
+
+    dems = []
+    for pattern in sweep["dems"]:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError("No DEMs match " + pattern)
+        dems.extend(matches)
+    grid = sweep.get("grid", {})
+    names = sorted(grid)
+    jobs = []
+    for dem in dems:
+        for values in itertools.product(*(grid[name] for name in names)):
+            params = dict(sweep.get("params", {}))
+            params.update(zip(names, values))
+            jobs.append({"tool": sweep["tool"], "dem": dem, "inputs": sweep.get("inputs", {}), "params": params})
+    return jobs
+
+def JobOutputPath(job, outputDir):
+
+    """Where a job's output goes: <outputDir>/<tool>/<DEM name>_<param><value>..._in<hash>.tif, with parameters in name order. Parameter values that are paths are given by their file name. The hash is of the job's other inputs' names and absolute paths, and is left off if it has none, so jobs differing only in e.g. their sizing raster don't share an output."""
+
+    parts = [os.path.splitext(os.path.basename(job["dem"]))[0]]
+    for name in sorted(job["params"]):
+        value = job["params"][name]
+        if isinstance(value, list):
+            value = "-".join(str(v) for v in value)
+        elif isinstance(value, str) and os.sep in value:
+            value = os.path.splitext(os.path.basename(value))[0]
+        parts.append("{}{}".format(name, value))
+    inputs = job.get("inputs", {})
+    if inputs:
+        description = json.dumps({name: os.path.abspath(path) for name, path in inputs.items()}, sort_keys=True)
+        parts.append("in" + hashlib.sha1(description.encode("utf-8")).hexdigest()[:8])
+    fileName = re.sub(r"[^\w.\-]", "", "_".join(parts)) + ".tif"
+    return os.path.join(outputDir, job["tool"], fileName)
+
+def ManifestJobs(manifest):
+
+    """All the jobs of a manifest, in order, with their output paths. Raises ValueError for unknown tools."""
+
+    jobs = list(manifest.get("jobs", []))
+    for sweep in manifest.get("sweeps", []):
+        jobs.extend(ExpandSweep(sweep))
+    for job in jobs:
+        if job["tool"] not in demInputs:
+            raise ValueError("Unknown tool '{}', should be one of: {}".format(job["tool"], ", ".join(sorted(demInputs))))
+        job.setdefault("inputs", {})
+        job.setdefault("params", {})
+        job["output"] = JobOutputPath(job, manifest["outputDir"])
+    return jobs
+
+def JobChunks(jobs, workers):
+
+    """Splits jobs into runs of the same DEM, each short enough that the work still spreads over all the workers, so that a worker can reuse the DEM it has loaded for the rest of the run."""
+
+    chunkSize = max(1, -(-len(jobs) // (2 * workers)))
+    chunks = []
+    for dem, demJobs in itertools.groupby(sorted(jobs, key=lambda job: job["dem"]), key=lambda job: job["dem"]):
+        demJobs = list(demJobs)
+        chunks.extend(demJobs[i:i + chunkSize] for i in range(0, len(demJobs), chunkSize))
+    return chunks
+
+def InitBatchWorker(outputSettings, scratchSettings):
+
+    """Pool initializer for the batch workers, passing on the output profile and scratch settings in case workers are spawned rather than forked."""
+
+    gdal.UseExceptions()
+    pc.outputSettings.update(outputSettings)
+    pc.scratchSettings.update(scratchSettings)
+
+def WorkerDem(dem):
+
+    """The in-memory copy of dem held by this worker, loading it first if need be and dropping the least recently used one if the worker already holds maxWorkerDems."""
+
+    for entry in workerDems:
+        if entry[0] == dem:
+            workerDems.remove(entry)
+            workerDems.append(entry)
+            return entry[1]
+    while len(workerDems) >= maxWorkerDems:
+        oldDem, oldPath = workerDems.pop(0)
+        gdal.Unlink(oldPath)
+    memPath = "/vsimem/batch/{}/{}/{}".format(os.getpid(), hashlib.sha1(os.path.abspath(dem).encode("utf-8")).hexdigest()[:12], os.path.basename(dem))
+    rc.CopyFile(dem, memPath)
+    workerDems.append((dem, memPath))
+    return memPath
+
+def RunJob(job):
+
+    """Runs one job into a temporary file next to its output and renames it into place once complete."""
+
+    outPath = job["output"]
+    tempPath = os.path.splitext(outPath)[0] + ".partial.tif"
+    inputs = dict(job["inputs"])
+    inputs[demInputs[job["tool"]]] = WorkerDem(job["dem"])
+    # The batch is already spread over processes, so each job gets one worker.
+    params = dict(job["params"], workers=1)
+    theLog = os.path.splitext(outPath)[0] + "_log.txt"
+    pipeline.stageRunners[job["tool"]](inputs, params, tempPath, theLog, None)
+    if os.path.isfile(tempPath + ".aux.xml"):
+        os.replace(tempPath + ".aux.xml", outPath + ".aux.xml")
+    os.replace(tempPath, outPath)
+
+def RunJobChunk(chunk):
+
+    """Runs a run of jobs in a worker process. Returns (job, error message or None) for each."""
+
+    results = []
+    for job in chunk:
+        try:
+            RunJob(job)
+            results.append((job, None))
+        except Exception as e:
+            results.append((job, "{}: {}".format(type(e).__name__, e)))
+        # Pool workers are terminated rather than exiting, so nothing is
+        # flushed for them at exit.
+        ins.Flush()
+    return results
+
+def RunBatch(jobs, workers, theLog):
+
+    """Runs the jobs whose outputs don't exist yet on a pool of workers processes. Returns the number of jobs that failed."""
+
+    todo = [job for job in jobs if not os.path.isfile(job["output"])]
+    pc.printandlog("{} job(s), {} already done, {} to run on {} worker(s).".format(len(jobs), len(jobs) - len(todo), len(todo), workers), theLog)
+    for outDir in set(os.path.dirname(job["output"]) for job in todo):
+        os.makedirs(outDir, exist_ok=True)
+
+    failures = 0
+    with ins.Stage("batch", theLog), multiprocessing.Pool(workers, InitBatchWorker, (pc.outputSettings, pc.scratchSettings)) as pool, ins.Progress(len(todo), "Jobs") as progress:
+        for results in pool.imap_unordered(RunJobChunk, JobChunks(todo, workers)):
+            for job, error in results:
+                if error is not None:
+                    failures += 1
+                    ins.Emit("job_failed", output=job["output"], error=error)
+                    pc.printandlog("\nFAILED: {} ({})".format(job["output"], error), theLog)
+                progress.update()
+    return failures
+
+def ParseGridValue(text):
+
+    """A grid value from the command line: JSON if it parses (numbers, lists), otherwise the string itself."""
+
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Runs " + ", ".join(sorted(demInputs)) + " jobs over many DEMs and parameter values on a pool of persistent worker processes, from a JSON manifest or from globs and a parameter grid given here. Outputs that already exist are skipped, so an interrupted batch can be resumed by running it again.")
+    parser.add_argument('OUTDIR', help="Directory to write outputs to, in a subdirectory per tool. Overrides the manifest's outputDir.")
+    parser.add_argument('--manifest', help="Full path to a JSON manifest of jobs and sweeps.")
+    parser.add_argument('--tool', choices=sorted(demInputs), help="Tool to sweep over --dems, in addition to any manifest.")
+    parser.add_argument('--dems', nargs="+", default=[], help="DEM paths or glob patterns for --tool.")
+    parser.add_argument('--grid', action="append", default=[], metavar="NAME=V1,V2,...", help="Values of a parameter to sweep for --tool, e.g. radius=4,8,16. Give once per parameter; every combination is run.")
+    parser.add_argument('--input', action="append", default=[], metavar="NAME=PATH", help="A further named input for --tool, e.g. sizing=/data/sizes.tif for filter.")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Number of worker processes. Default is the number of CPUs.")
+    pc.AddOutputArguments(parser)
+    pc.AddScratchArguments(parser)
+    ins.AddInstrumentationArguments(parser)
+    args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+    pc.ConfigureScratch(args)
+
+    gdal.UseExceptions()
+
+    manifest = {}
+    if args.manifest:
+        with open(args.manifest) as manifestFile:
+            manifest = json.load(manifestFile)
+    manifest["outputDir"] = args.OUTDIR
+    if args.tool:
+        grid = {}
+        for gridArg in args.grid:
+            name, values = gridArg.split("=", 1)
+            grid[name.strip()] = [ParseGridValue(v) for v in values.split(",")]
+        inputs = dict(namedInput.split("=", 1) for namedInput in args.input)
+        manifest.setdefault("sweeps", []).append({"tool": args.tool, "dems": args.dems, "grid": grid, "inputs": inputs})
+    elif not args.manifest:
+        parser.error("give a --manifest, or a --tool with --dems")
+
+    os.makedirs(args.OUTDIR, exist_ok=True)
+    theLog = os.path.join(args.OUTDIR, "batch_log.txt")
+    pc.printandlog("\nStarting {} at {}".format(scriptName, ins.Timestamp()), theLog)
+
+    failures = RunBatch(ManifestJobs(manifest), args.workers, theLog)
+    if failures:
+        pc.printandlog("{} job(s) failed, rerun to retry them.".format(failures), theLog)
+        ins.Flush()
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
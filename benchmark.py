@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Benchmarks every script here on seeded synthetic terrain. For each DEM size
+# it generates a diamond-square DEM with NoData holes, a kernel sizing raster
+# and a zero mask, runs each script on them as its own process, and records
+# wall time, pixels per second and peak resident memory. Results are written
+# to JSON, and can be checked against an earlier run's JSON with a threshold
+# for flagging regressions.
+
+scriptName = "benchmark.py"
+
+import os, sys, argparse, datetime, json, subprocess, time, tempfile, shutil, platform, socket
+import numpy as np
+from osgeo import gdal
+
+
+NoDataVal = -99999
+
+# Each entry point, as a function of the benchmark files giving the script and
+# its arguments.
+entryPoints = {
+    "entropy":    lambda f: ["LocalEntropy.py", f["dem"], os.path.join(f["dir"], "entropy.tif"), "5"],
+    "filter":     lambda f: ["VariableKernelLowPassFilter.py", f["dem"], f["sizing"]],
+    "scaler":     lambda f: ["PixelScaler.py", f["sizing"], f["dem"]],
+    "inverter":   lambda f: ["Inverter.py", f["dem"], os.path.join(f["dir"], "inverted.tif")],
+    "multiply":   lambda f: ["Multiply.py", f["dem"], "1.5", os.path.join(f["dir"], "multiplied.tif")],
+    "zeroburner": lambda f: ["ZeroBurner.py", f["mask"], f["dem"], os.path.join(f["dir"], "burned.tif")],
+    "smoother":   lambda f: ["smoother.py", f["dem"], "5"],
+}
+
+
+def DiamondSquare(size, roughness, rng):
+
+    """Fractal terrain of size by size cells from the diamond-square algorithm, scaled to 0-1, as float32. Generated on the next 2^n + 1 grid and cropped. Each step is vectorized over all the squares or diamonds at that scale."""
+
+    n = 1
+    while n + 1 < size:
+        n *= 2
+    grid = np.zeros((n + 1, n + 1), dtype=np.float32)
+    grid[::n, ::n] = rng.random((2, 2))
+    step = n
+    scale = 1.0
+    while step > 1:
+        half = step // 2
+        # Diamond step: centres of squares from their four corners.
+        corners = grid[0:n:step, 0:n:step] + grid[0:n:step, step::step] + grid[step::step, 0:n:step] + grid[step::step, step::step]
+        grid[half::step, half::step] = corners / 4.0 + (rng.random(corners.shape) - 0.5) * scale
+        # Square step: edge midpoints from their in-grid neighbours.
+        for rowStart, colStart in ((0, half), (half, 0)):
+            rows = np.arange(rowStart, n + 1, step)
+            cols = np.arange(colStart, n + 1, step)
+            total = np.zeros((len(rows), len(cols)), dtype=np.float32)
+            count = np.zeros((len(rows), len(cols)), dtype=np.float32)
+            for dy, dx in ((-half, 0), (half, 0), (0, -half), (0, half)):
+                r = rows + dy
+                c = cols + dx
+                rOk = (r >= 0) & (r <= n)
+                cOk = (c >= 0) & (c <= n)
+                total[np.ix_(rOk, cOk)] += grid[np.ix_(r[rOk], c[cOk])]
+                count[np.ix_(rOk, cOk)] += 1
+            grid[np.ix_(rows, cols)] = total / count + (rng.random(total.shape) - 0.5) * scale
+        step = half
+        scale *= 2.0 ** -roughness
+    grid = grid[:size, :size]
+    grid -= grid.min()
+    grid /= max(grid.max(), 1e-12)
+    return grid
+
+def NoDataHoles(size, nHoles, rng):
+
+    """Mask of nHoles random elliptical NoData regions in a size by size raster."""
+
+    rows, cols = np.ogrid[:size, :size]
+    holes = np.zeros((size, size), dtype=bool)
+    for n in range(nHoles):
+        cy, cx = rng.random(2) * size
+        ry, rx = (rng.random(2) * 0.05 + 0.01) * size
+        holes |= ((rows - cy) / ry) ** 2 + ((cols - cx) / rx) ** 2 <= 1.0
+    return holes
+
+def WriteRaster(path, array, dataType):
+
+    """Writes array as a one-band GeoTiff with a made-up 30 m UTM georeference and -99999 as NoData."""
+
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(path, array.shape[1], array.shape[0], 1, dataType)
+    ds.SetGeoTransform((500000.0, 30.0, 0.0, 4500000.0, 0.0, -30.0))
+    ds.SetProjection('PROJCS["WGS 84 / UTM zone 17N",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["latitude_of_origin",0],PARAMETER["central_meridian",-81],PARAMETER["scale_factor",0.9996],PARAMETER["false_easting",500000],PARAMETER["false_northing",0],UNIT["metre",1]]')
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NoDataVal)
+    band.WriteArray(array)
+    ds.FlushCache()
+
+def MakeBenchmarkFiles(workDir, size, seed, maxKernel=31):
+
+    """Generates the synthetic DEM (Int32 metres, with NoData holes), a kernel sizing raster (Int16, 1 to maxKernel) and a zero mask (sea below 15% of relief) for one size. Returns a dictionary of their paths and the directory."""
+
+    rng = np.random.default_rng(seed)
+    terrain = DiamondSquare(size, 0.9, rng)
+    dem = np.rint(terrain * 3000.0).astype(np.int32)
+    dem[NoDataHoles(size, 5, rng)] = NoDataVal
+    sizing = np.rint(1 + DiamondSquare(size, 1.2, rng) * (maxKernel - 1)).astype(np.int16)
+    mask = (terrain > 0.15).astype(np.int16)
+
+    files = {"dir": workDir}
+    for name, array, dataType in (("dem", dem, gdal.GDT_Int32), ("sizing", sizing, gdal.GDT_Int16), ("mask", mask, gdal.GDT_Int16)):
+        files[name] = os.path.join(workDir, "synthetic_{}_{}.tif".format(size, name))
+        WriteRaster(files[name], array, dataType)
+    return files
+
+def RunEntryPoint(command, timeout):
+
+    """Runs a script as its own process. Returns its wall time in seconds, peak resident memory in MB and return code (None if it timed out and was killed)."""
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = start + timeout if timeout else None
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if deadline is not None and time.perf_counter() > deadline:
+            proc.kill()
+            pid, status, usage = os.wait4(proc.pid, 0)
+            status = None
+            break
+        time.sleep(0.01)
+    wall = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peakRSSMB = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+    returnCode = None if status is None else os.waitstatus_to_exitcode(status)
+    return wall, peakRSSMB, returnCode
+
+def RunBenchmarks(sizes, entries, seed, timeout, workRoot, keep=False):
+
+    """Runs the chosen entry points on synthetic terrain of each size. Returns a list of result dictionaries. Each size's data and outputs are removed once its runs finish unless keep is set."""
+
+    scriptDir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for size in sizes:
+        workDir = tempfile.mkdtemp(prefix="bench{}_".format(size), dir=workRoot)
+        try:
+            print("Generating {0} by {0} synthetic DEM in {1}...".format(size, workDir))
+            files = MakeBenchmarkFiles(workDir, size, seed)
+            for entry in entries:
+                args = entryPoints[entry](files)
+                command = [sys.executable, os.path.join(scriptDir, args[0])] + args[1:]
+                wall, peakRSSMB, returnCode = RunEntryPoint(command, timeout)
+                result = {
+                    "entry": entry,
+                    "size": size,
+                    "pixels": size * size,
+                    "wallSeconds": wall,
+                    "pixelsPerSecond": size * size / wall,
+                    "peakRSSMB": peakRSSMB,
+                    "returnCode": returnCode,
+                }
+                results.append(result)
+                status = "ok" if returnCode == 0 else ("TIMED OUT" if returnCode is None else "FAILED ({})".format(returnCode))
+                print("  {:<11} {:>10.2f} s {:>14,.0f} px/s {:>9.1f} MB  {}".format(entry, wall, result["pixelsPerSecond"], peakRSSMB, status))
+        finally:
+            if not keep:
+                shutil.rmtree(workDir, ignore_errors=True)
+    return results
+
+def CompareToBaseline(results, baseline, threshold):
+
+    """Compares wall times with a baseline run's results. Returns a list of (entry, size, baseline seconds, seconds) for those more than threshold (a fraction) slower."""
+
+    baselineTimes = {(r["entry"], r["size"]): r["wallSeconds"] for r in baseline["results"] if r["returnCode"] == 0}
+    regressions = []
+    for r in results:
+        key = (r["entry"], r["size"])
+        if key in baselineTimes and (r["returnCode"] != 0 or r["wallSeconds"] > baselineTimes[key] * (1.0 + threshold)):
+            regressions.append((r["entry"], r["size"], baselineTimes[key], r["wallSeconds"]))
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks the scripts here on seeded synthetic diamond-square DEMs, recording wall time, pixels per second and peak memory per script and size to JSON, optionally flagging regressions against a baseline JSON.")
+    parser.add_argument('OUTJSON', help="Full path to the JSON results file to write.")
+    parser.add_argument('--sizes', default="1024,4096,16384", help="Comma-separated DEM sizes in pixels per side. Default is 1024,4096,16384.")
+    parser.add_argument('--entries', default=",".join(entryPoints), help="Comma-separated entry points to run, from: " + ", ".join(entryPoints) + ". Default is all of them.")
+    parser.add_argument('--seed', type=int, default=2019, help="Seed for the synthetic terrain. Default is 2019.")
+    parser.add_argument('--timeout', type=float, default=3600, help="Seconds after which a run is killed and marked as timed out. Default is 3600.")
+    parser.add_argument('--workdir', help="Directory to generate data and outputs in. Default is the system temp directory.")
+    parser.add_argument('--keep', action='store_true', help="Keep each size's generated data and outputs instead of removing them once its runs finish. Always the case with --workdir.")
+    parser.add_argument('--baseline', help="Full path to an earlier results JSON to compare against.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Fraction by which a run may be slower than the baseline before it is flagged as a regression. Default is 0.1.")
+    args = parser.parse_args()
+
+    gdal.UseExceptions()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    entries = args.entries.split(",")
+    for entry in entries:
+        if entry not in entryPoints:
+            parser.error("unknown entry point: " + entry)
+
+    startTime = datetime.datetime.now()
+    results = RunBenchmarks(sizes, entries, args.seed, args.timeout, args.workdir, args.keep or args.workdir is not None)
+
+    report = {
+        "started": str(startTime),
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.OUTJSON, "w") as outFile:
+        json.dump(report, outFile, indent=2)
+    print("Results written to: " + args.OUTJSON)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = CompareToBaseline(results, baseline, args.threshold)
+        for entry, size, before, after in regressions:
+            print("REGRESSION: {} at {} px: {:.2f} s -> {:.2f} s".format(entry, size, before, after))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Local entropy on a disk-shaped kernel from a sliding histogram, as an
+# alternative to scikit-image's rank filters. Elevations are first quantized
+# into a chosen number of bins, so float DEMs and negative elevations work, and
+# the histogram cost follows the number of bins rather than a 16-bit range.
+# Uses numba if it is installed, and falls back on NumPy otherwise.
+
+import numpy as np
+import processingCommon as pc
+
+try:
+    from numba import njit, prange
+    haveNumba = True
+except ImportError:
+    haveNumba = False
+
+
+quantizationMethods = ["fixed", "quantile", "breaks"]
+
+# The NoData sentinel used throughout, left out whether or not a raster is
+# tagged with it.
+NoDataVal = -99999
+
+
+def QuantizationBreaks(values, nBins, method="fixed", breaks=None):
+
+    """Returns the sorted inner bin edges for quantizing values into nBins bins. 'fixed' gives bins of equal width between the minimum and maximum, 'quantile' gives bins holding roughly equal numbers of pixels, and 'breaks' uses the given edges as they are. values should already have NoData removed."""
+
+    if method == "breaks":
+        return np.unique(np.asarray(breaks, dtype=np.float64))
+    if method == "quantile":
+        return np.unique(np.quantile(values, np.linspace(0.0, 1.0, nBins + 1)[1:-1]))
+    if method == "fixed":
+        return np.linspace(np.min(values), np.max(values), nBins + 1)[1:-1]
+    raise ValueError("Unknown quantization method: " + str(method))
+
+def BandBreaks(band, nBins, method="fixed", breaks=None, noData=None, maxSample=1000000):
+
+    """QuantizationBreaks for a whole GDAL band without reading it all in. Fixed-width bins come from the band's minimum and maximum, and quantiles from a decimated read of at most about maxSample pixels, both leaving out NoData (see ValidMask)."""
+
+    if method == "breaks":
+        return QuantizationBreaks(None, nBins, method, breaks)
+    if method == "fixed":
+        bandMin, bandMax = pc.BandMinMax(band, [NoDataVal, noData])
+        if bandMin is None:
+            raise ValueError("The raster is all NoData")
+        return np.linspace(bandMin, bandMax, nBins + 1)[1:-1]
+    step = max(1, int(np.sqrt(band.XSize * band.YSize / float(maxSample))))
+    sample = band.ReadAsArray(buf_xsize=max(1, band.XSize // step), buf_ysize=max(1, band.YSize // step))
+    return QuantizationBreaks(sample[ValidMask(sample, noData)], nBins, method)
+
+def ValidMask(values, noData=None):
+
+    """True where values hold data, i.e. aren't NaN, -99999 or the given NoData value."""
+
+    return ~pc.NoDataMask(values, [NoDataVal, noData])
+
+def Quantize(values, breaks, noData=None):
+
+    """Returns the bin number of every pixel in values, as int32, with -1 for NoData."""
+
+    bins = np.digitize(values, breaks).astype(np.int32)
+    bins[~ValidMask(values, noData)] = -1
+    return bins
+
+def XLogXTable(maxCount):
+
+    """c * log2(c) for every count c up to maxCount, with 0 for c = 0."""
+
+    counts = np.arange(maxCount + 1, dtype=np.float64)
+    table = np.zeros(maxCount + 1)
+    table[1:] = counts[1:] * np.log2(counts[1:])
+    return table
+
+def PadBins(bins, radius, nBins):
+
+    """Pads a bin array by radius pixels on every side with the out-of-range bin nBins, which the sliding histograms count but leave out of the entropy, and maps NoData (-1) to the same bin."""
+
+    padded = np.pad(bins, radius, mode="constant", constant_values=nBins)
+    padded[padded < 0] = nBins
+    return padded
+
+
+# Both sliding histogram implementations keep, for each pixel in a row and
+# each radius, the histogram of its disk, the number n of valid pixels in it
+# and S = sum(c * log2(c)) over its bin counts c. Entropy is then
+# log2(n) - S / n. As the disks slide one column right only the pixels at
+# each end of their rows change, and each changes S by a difference of two
+# table entries, so nothing is ever summed over the whole histogram. All the
+# radii are slid together over the same padded rows. Their histograms can't
+# share updates, since nested disks gain and lose pixels at different
+# columns, but the raster is only read, quantized and walked once.
+
+if haveNumba:
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def SlidingEntropyKernel(padded, halfWidths, nBins, xlogx, nRows, nCols):
+
+        """Compiled sliding histogram entropy for every row of halfWidths (one per radius), in parallel over rows of output pixels."""
+
+        nRadii, nDiskRows = halfWidths.shape
+        maxRadius = (nDiskRows - 1) // 2
+        out = np.zeros((nRadii, nRows, nCols))
+        for row in prange(nRows):
+            hist = np.zeros((nRadii, nBins + 1), dtype=np.int64)
+            s = np.zeros(nRadii)
+            n = np.zeros(nRadii, dtype=np.int64)
+            for col in range(nCols):
+                for j in range(nRadii):
+                    for k in range(nDiskRows):
+                        w = halfWidths[j, k]
+                        if w < 0:
+                            continue
+                        if col == 0:
+                            entering = maxRadius - w
+                            last = maxRadius + w
+                        else:
+                            entering = col + maxRadius + w
+                            last = entering
+                            b = padded[row + k, col - 1 + maxRadius - w]
+                            c = hist[j, b]
+                            if b < nBins:
+                                s[j] += xlogx[c - 1] - xlogx[c]
+                                n[j] -= 1
+                            hist[j, b] = c - 1
+                        for x in range(entering, last + 1):
+                            b = padded[row + k, x]
+                            c = hist[j, b]
+                            if b < nBins:
+                                s[j] += xlogx[c + 1] - xlogx[c]
+                                n[j] += 1
+                            hist[j, b] = c + 1
+                    if n[j] > 0:
+                        out[j, row, col] = np.log2(n[j]) - s[j] / n[j]
+        return out
+
+def SlidingEntropyRows(padded, halfWidths, nBins, xlogx, nRows, nCols):
+
+    """NumPy sliding histogram entropy for every row of halfWidths (one per radius). Slides the disks of a whole column of output pixels at once, so the Python loop runs over columns and disk rows only."""
+
+    nRadii, nDiskRows = halfWidths.shape
+    maxRadius = (nDiskRows - 1) // 2
+    rows = np.arange(nRows)
+    hist = np.zeros((nRadii, nRows, nBins + 1), dtype=np.int64)
+    s = np.zeros((nRadii, nRows))
+    n = np.zeros((nRadii, nRows), dtype=np.int64)
+    out = np.zeros((nRadii, nRows, nCols))
+
+    def update(j, bins, step):
+        counts = hist[j, rows, bins]
+        valid = bins < nBins
+        s[j, valid] += xlogx[counts[valid] + step] - xlogx[counts[valid]]
+        n[j, valid] += step
+        hist[j, rows, bins] = counts + step
+
+    for col in range(nCols):
+        for j in range(nRadii):
+            for k, w in enumerate(halfWidths[j]):
+                if w < 0:
+                    continue
+                rowBins = padded[k:k + nRows]
+                if col == 0:
+                    for x in range(maxRadius - w, maxRadius + w + 1):
+                        update(j, rowBins[:, x], 1)
+                else:
+                    update(j, rowBins[:, col - 1 + maxRadius - w], -1)
+                    update(j, rowBins[:, col + maxRadius + w], 1)
+            hasData = n[j] > 0
+            out[j, hasData, col] = np.log2(n[j, hasData]) - s[j, hasData] / n[j, hasData]
+
+    return out
+
+def SlidingEntropyStack(bins, radii, nBins):
+
+    """Local entropy, in bits, of a quantized raster (see Quantize) over disks of each of the given radii, in one pass. Returns an array of shape (len(radii), rows, columns). Like scikit-image, pixels off the raster edge are left out of the disks, as are NoData pixels."""
+
+    nRows, nCols = bins.shape
+    maxRadius = max(radii)
+    halfWidths = np.array([pc.DiskHalfWidths(radius, maxRadius) for radius in radii])
+    xlogx = XLogXTable(int(np.sum(2 * pc.DiskHalfWidths(maxRadius) + 1)))
+    padded = PadBins(bins, maxRadius, nBins)
+    if haveNumba:
+        return SlidingEntropyKernel(padded, halfWidths, nBins, xlogx, nRows, nCols)
+    return SlidingEntropyRows(padded, halfWidths, nBins, xlogx, nRows, nCols)
+
+def HistogramEntropyStack(block, radii, breaks, noData=None):
+
+    """Quantizes one block of elevations with breaks once and returns a list of its local entropy over a disk of each of the given radii."""
+
+    return list(SlidingEntropyStack(Quantize(block, breaks, noData), radii, len(breaks) + 1))
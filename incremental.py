@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Brings the outputs of an entropy -> scale -> variable filter run up to date
+# after a local edit to the DEM (a lake hydro-flattened, a void patched), by
+# recomputing only the pixels the edit can reach and patching them into the
+# existing outputs in place:
+#  - entropy, within the entropy disk radius of the edited pixels,
+#  - the scaled kernel sizes, on those same pixels, as scaling is per pixel,
+#  - the filtered DEM, on those pixels and within half the largest kernel of
+#    the edited pixels.
+# The edited region is given as a bounding box, or found by comparing the
+# edited DEM with the old one. Scaling depends on the entropy raster's
+# minimum and maximum, so if the edit changes them every scaled size changes,
+# and the scaling and filter are rerun in full instead.
+#
+# The outputs must be the full run's, on the same grid as the DEM, from the
+# same radius and engines as given here. The histogram entropy engine bins
+# elevations by the whole DEM's range unless given fixed --breaks, so only
+# those runs can be patched. Cloud Optimized GeoTiffs can't be updated in
+# place, so outputs written with --profile cog can't be patched either.
+
+scriptName = "incremental.py"
+
+import os, argparse, functools
+import numpy as np
+from osgeo import gdal
+import processingCommon as pc
+import instrumentation as ins
+import LocalEntropy
+import PixelScaler
+import VariableKernelLowPassFilter as vk
+import histogramEntropy as he
+
+
+NoDataVal = -99999.0
+
+
+def WindowFromBBox(ds, bbox):
+
+    """The (xOff, yOff, xCount, yCount) window of ds's pixels touching a (xMin, yMin, xMax, yMax) box in its map coordinates, clipped to the raster. Raises ValueError if the box misses the raster."""
+
+    gt = ds.GetGeoTransform()
+    xMin, yMin, xMax, yMax = bbox
+    cols = sorted([(xMin - gt[0]) / gt[1], (xMax - gt[0]) / gt[1]])
+    rows = sorted([(yMax - gt[3]) / gt[5], (yMin - gt[3]) / gt[5]])
+    left = max(0, int(np.floor(cols[0])))
+    top = max(0, int(np.floor(rows[0])))
+    right = min(ds.RasterXSize, int(np.ceil(cols[1])))
+    bottom = min(ds.RasterYSize, int(np.ceil(rows[1])))
+    if right <= left or bottom <= top:
+        raise ValueError("The box {} is outside the DEM".format(bbox))
+    return left, top, right - left, bottom - top
+
+def WindowFromDiff(oldBand, newBand):
+
+    """The smallest window holding every pixel that differs between two bands of the same size, found strip by strip. Returns None if they are identical."""
+
+    if (oldBand.XSize, oldBand.YSize) != (newBand.XSize, newBand.YSize):
+        raise ValueError("The old and edited DEMs aren't the same size")
+    rows = []
+    cols = []
+    for window in pc.StripWindows(newBand):
+        oldValues = oldBand.ReadAsArray(*window)
+        newValues = newBand.ReadAsArray(*window)
+        changed = (oldValues != newValues) & ~(pc.NoDataMask(oldValues, []) & pc.NoDataMask(newValues, []))
+        changedRows = np.flatnonzero(changed.any(axis=1))
+        if len(changedRows):
+            changedCols = np.flatnonzero(changed.any(axis=0))
+            rows.extend([window[1] + changedRows[0], window[1] + changedRows[-1]])
+            cols.extend([changedCols[0], changedCols[-1]])
+    if not rows:
+        return None
+    return int(min(cols)), int(min(rows)), int(max(cols) - min(cols) + 1), int(max(rows) - min(rows) + 1)
+
+def UnionWindow(a, b):
+
+    """The smallest window covering two windows."""
+
+    left = min(a[0], b[0])
+    top = min(a[1], b[1])
+    right = max(a[0] + a[2], b[0] + b[2])
+    bottom = max(a[1] + a[3], b[1] + b[3])
+    return left, top, right - left, bottom - top
+
+def SnapWindow(window, cell, xSize, ySize):
+
+    """The smallest window covering window whose edges fall on multiples of cell, or on the raster's edges."""
+
+    left = window[0] // cell * cell
+    top = window[1] // cell * cell
+    right = min(xSize, -(-(window[0] + window[2]) // cell) * cell)
+    bottom = min(ySize, -(-(window[1] + window[3]) // cell) * cell)
+    return left, top, right - left, bottom - top
+
+def FilterTileSize(filterFn, maxSize, tileSize):
+
+    """tileSize, or for the pyramid engine tileSize rounded up to a multiple of its coarsest cell for kernels up to maxSize, as its blocks must start on multiples of that to match the whole-raster result (see vk.PyramidHalo)."""
+
+    if filterFn is not vk.PyramidFilter:
+        return tileSize
+    cell = vk.PyramidCell(maxSize)
+    return -(-tileSize // cell) * cell
+
+def SubWindows(window, tileSize):
+
+    """pc.TileWindows over a window rather than a whole raster."""
+
+    return [(window[0] + x, window[1] + y, xCount, yCount) for x, y, xCount, yCount in pc.TileWindows(window[2], window[3], tileSize)]
+
+def OpenForPatching(path):
+
+    """Opens an earlier output for updating in place. Raises ValueError for Cloud Optimized GeoTiffs, whose layout updates would break."""
+
+    ds = gdal.Open(path, gdal.GA_Update)
+    if ds.GetMetadataItem("LAYOUT", "IMAGE_STRUCTURE") == "COG":
+        raise ValueError(path + " is a Cloud Optimized GeoTiff, which can't be patched in place; rerun it in full, or write it with another --profile")
+    return ds
+
+def NewRange(oldMin, oldMax, oldWindow, newWindow):
+
+    """The minimum and maximum of a band after the values in one window changed from oldWindow to newWindow, given its old minimum and maximum, where that can be told without reading the rest of the band. Either is None where it can't: when the old extreme may only have been in the window, and the window no longer reaches it."""
+
+    newMin = None
+    if newWindow.min() <= oldMin:
+        newMin = newWindow.min().item()
+    elif oldWindow.min() > oldMin: # The old minimum is outside the window, and still there.
+        newMin = oldMin
+    newMax = None
+    if newWindow.max() >= oldMax:
+        newMax = newWindow.max().item()
+    elif oldWindow.max() < oldMax:
+        newMax = oldMax
+    return newMin, newMax
+
+def EntropyFunction(demBand, radius, engine, breaks):
+
+    """The function LocalEntropy.CalculateEntropy would calculate entropy with, for one radius."""
+
+    if engine == "histogram":
+        return functools.partial(he.HistogramEntropyStack, radii=[radius], breaks=np.asarray(breaks), noData=demBand.GetNoDataValue())
+    return functools.partial(LocalEntropy.EntropyStack, radii=[radius])
+
+def PatchEntropy(demBand, entBand, window, radius, entropyFn, tileSize, workers):
+
+    """Recalculates entropy over a window, reading the DEM with the radius as a halo as LocalEntropy does, and writes it into entBand. Returns the window's entropy before and after, as written."""
+
+    before = entBand.ReadAsArray(*window)
+    with ins.Progress(len(SubWindows(window, tileSize)), "Entropy tiles") as progress:
+        for subWindow, ents in LocalEntropy.EntropyTiles(demBand, SubWindows(window, tileSize), radius, workers, entropyFn):
+            entBand.WriteArray(ents[0], subWindow[0], subWindow[1])
+            progress.update()
+    return before, entBand.ReadAsArray(*window)
+
+def PatchScaling(entBand, sizeBand, window, atSMin, shift, scalar, tileSize):
+
+    """Rescales the entropy in a window into the scaled kernel sizes, as PixelScaler does."""
+
+    for subWindow in SubWindows(window, tileSize):
+        scaled, noData = PixelScaler.ScaleArray(entBand.ReadAsArray(*subWindow), [NoDataVal, entBand.GetNoDataValue()], atSMin, shift, scalar, NoDataVal)
+        sizeBand.WriteArray(scaled, subWindow[0], subWindow[1])
+
+def PatchFilter(demBand, sizeBand, filteredBand, window, filterFn, tileSize):
+
+    """Refilters a window of the DEM through VariableKernelLowPassFilter.FilterWindow and writes it into filteredBand."""
+
+    subWindows = SubWindows(window, tileSize)
+    with ins.Progress(len(subWindows), "Filter blocks") as progress:
+        for subWindow in subWindows:
+            filteredBand.WriteArray(vk.FilterWindow(demBand, sizeBand, subWindow, filterFn), subWindow[0], subWindow[1])
+            progress.update()
+
+def UpdateOutputs(dem, kernelRange, entropyRast, sizesRast, filteredRast, radius, dirtyWindow, theLog, entropyEngine="skimage", breaks=None, filterEngine="sat", tileSize=1024, workers=1):
+
+    """Patches the entropy, scaled sizes and filtered rasters of an earlier run for an edit to dem within dirtyWindow, falling back on rescaling and refiltering in full if the entropy's range changes. kernelRange is the raster the sizes were scaled to. Returns the number of pixels recomputed in each output, by name."""
+
+    demData = gdal.Open(dem)
+    demBand = demData.GetRasterBand(1)
+    xSize, ySize = demBand.XSize, demBand.YSize
+    entData = OpenForPatching(entropyRast)
+    entBand = entData.GetRasterBand(1)
+    for path, ds in ((entropyRast, entData), (sizesRast, gdal.Open(sizesRast)), (filteredRast, gdal.Open(filteredRast))):
+        if (ds.RasterXSize, ds.RasterYSize) != (xSize, ySize):
+            raise ValueError("{} isn't the same size as {}".format(path, dem))
+    filterFn = vk.filterEngines[filterEngine]
+    recomputed = {}
+
+    # The old entropy range, before any of it is patched.
+    entMin, entMax = pc.BandRange(entBand, [NoDataVal])
+    atSMin, atSMax = pc.BandRange(gdal.Open(kernelRange).GetRasterBand(1), [NoDataVal])
+
+    entWindow = pc.PadWindow(dirtyWindow, radius, xSize, ySize)[0]
+    pc.printandlog("Edited window {}, entropy window {}.".format(dirtyWindow, entWindow), theLog)
+    with ins.Stage("entropy", theLog, pixels=entWindow[2] * entWindow[3]):
+        before, after = PatchEntropy(demBand, entBand, entWindow, radius, EntropyFunction(demBand, radius, entropyEngine, breaks), tileSize, workers)
+    recomputed["entropy"] = entWindow[2] * entWindow[3]
+
+    newMin, newMax = NewRange(entMin, entMax, before, after)
+    if newMin is None or newMax is None:
+        pc.printandlog("The edit reached the entropy's old extremes, checking its range...", theLog)
+        newMin, newMax = pc.BandMinMax(entBand, [NoDataVal])
+
+    if (newMin, newMax) != (entMin, entMax):
+        pc.printandlog("Entropy range changed from {}-{} to {}-{}, so every scaled size changes. Rescaling and refiltering in full.".format(entMin, entMax, newMin, newMax), theLog)
+        # Exact statistics for PixelScaler to take the new range from.
+        entBand.ComputeStatistics(False)
+        entData = entBand = None
+        with ins.Stage("scale (full)", theLog):
+            PixelScaler.performscaling(kernelRange, entropyRast, sizesRast)
+        with ins.Stage("filter (full)", theLog):
+            maxSize = pc.BandRange(gdal.Open(sizesRast).GetRasterBand(1), [NoDataVal])[1]
+            vk.VariableLowPassFilter(dem, sizesRast, filterEngine, FilterTileSize(filterFn, maxSize, tileSize), 1, filteredRast)
+        recomputed["scale"] = recomputed["filter"] = xSize * ySize
+        return recomputed
+    entData.FlushCache()
+
+    shift, scalar = PixelScaler.ScaleParameters(atSMin, atSMax, entMin, entMax)
+    sizeData = OpenForPatching(sizesRast)
+    sizeBand = sizeData.GetRasterBand(1)
+    with ins.Stage("scale", theLog, pixels=entWindow[2] * entWindow[3]):
+        PatchScaling(entBand, sizeBand, entWindow, atSMin, shift, scalar, tileSize)
+    recomputed["scale"] = entWindow[2] * entWindow[3]
+
+    # Pixels whose kernel size changed, and those whose kernel reaches the
+    # edit, for kernels up to the largest scaled size.
+    maxSize = PixelScaler.ScaleArray(np.array([entMax]), [], atSMin, shift, scalar)[0][0]
+    filterWindow = UnionWindow(entWindow, pc.PadWindow(dirtyWindow, vk.FilterHalo(filterFn, np.ceil(maxSize)), xSize, ySize)[0])
+    if filterFn is vk.PyramidFilter:
+        # So the blocks it is split into start on multiples of the pyramid's
+        # coarsest cell too.
+        filterWindow = SnapWindow(filterWindow, vk.PyramidCell(maxSize), xSize, ySize)
+    pc.printandlog("Filter window {}.".format(filterWindow), theLog)
+    filteredData = OpenForPatching(filteredRast)
+    with ins.Stage("filter", theLog, pixels=filterWindow[2] * filterWindow[3]):
+        PatchFilter(demBand, sizeBand, filteredData.GetRasterBand(1), filterWindow, filterFn, FilterTileSize(filterFn, maxSize, tileSize))
+    recomputed["filter"] = filterWindow[2] * filterWindow[3]
+    filteredData.FlushCache()
+    sizeData.FlushCache()
+    return recomputed
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Updates the entropy, scaled kernel size and filtered DEM outputs of an earlier entropy -> scale -> variable filter run after a local edit to the DEM, recomputing only the pixels the edit reaches and patching them into the outputs in place. Falls back on rescaling and refiltering in full if the edit changes the entropy's range.")
+    parser.add_argument('INDEM', help="Full path to the edited DEM.")
+    parser.add_argument('KERNELRANGE', help="Full path to the raster the kernel sizes were scaled to (PixelScaler.py's INRAST_ATSCALE).")
+    parser.add_argument('ENTROPY', help="Full path to the earlier run's entropy raster.")
+    parser.add_argument('SIZES', help="Full path to the earlier run's scaled kernel size raster.")
+    parser.add_argument('FILTERED', help="Full path to the earlier run's filtered DEM.")
+    parser.add_argument('DISKRADIUS', type=int, help="Entropy disk radius the earlier run used.")
+    edit = parser.add_mutually_exclusive_group(required=True)
+    edit.add_argument('--bbox', help="The edited region as XMIN,YMIN,XMAX,YMAX in the DEM's coordinates.")
+    edit.add_argument('--old-dem', help="Full path to the DEM before the edit, to find the edited region by comparing them.")
+    parser.add_argument('--entropy-engine', choices=["skimage", "histogram"], default="skimage", help="Entropy engine the earlier run used. Default is skimage.")
+    parser.add_argument('--breaks', help="Comma-separated bin edges the earlier run's histogram engine used. Required with --entropy-engine histogram.")
+    parser.add_argument('--filter-engine', choices=sorted(vk.filterEngines), default="sat", help="Filter engine the earlier run used. Default is sat.")
+    parser.add_argument('--tilesize', type=int, default=1024, help="Pixels square to work through the recomputed windows in. Default is 1024.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of threads to calculate entropy tiles on. Default is 1.")
+    pc.AddOutputArguments(parser)
+    pc.AddScratchArguments(parser)
+    ins.AddInstrumentationArguments(parser)
+    args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+    pc.ConfigureScratch(args)
+    if args.entropy_engine == "histogram" and not args.breaks:
+        parser.error("the histogram engine bins elevations by the whole DEM's range unless given --breaks, so only runs with fixed --breaks can be patched")
+
+    gdal.UseExceptions()
+
+    outPathDir, outFile = os.path.split(args.FILTERED)
+    theLog = os.path.join(outPathDir, os.path.splitext(outFile)[0] + "_incremental_log.txt")
+    pc.printandlog("\nStarting {} at {}".format(scriptName, ins.Timestamp()), theLog)
+    pc.printandlog("Edited DEM: " + args.INDEM, theLog)
+
+    demData = gdal.Open(args.INDEM)
+    if args.bbox:
+        dirtyWindow = WindowFromBBox(demData, [float(v) for v in args.bbox.split(",")])
+    else:
+        with ins.Stage("diff", theLog):
+            dirtyWindow = WindowFromDiff(gdal.Open(args.old_dem).GetRasterBand(1), demData.GetRasterBand(1))
+        if dirtyWindow is None:
+            pc.printandlog("The DEMs are identical, nothing to do.", theLog)
+            return
+    demData = None
+
+    with ins.Stage(scriptName, theLog):
+        recomputed = UpdateOutputs(args.INDEM, args.KERNELRANGE, args.ENTROPY, args.SIZES, args.FILTERED, args.DISKRADIUS, dirtyWindow, theLog,
+                                   args.entropy_engine, args.breaks and [float(x) for x in args.breaks.split(",")], args.filter_engine, args.tilesize, args.workers)
+    demData = gdal.Open(args.INDEM)
+    totalPixels = demData.RasterXSize * demData.RasterYSize
+    for name, pixels in recomputed.items():
+        pc.printandlog("{:<8} recomputed {:,} pixels ({:.2f} % of the raster)".format(name, pixels, 100.0 * pixels / totalPixels), theLog)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Shared logging, timing and progress reporting for the scripts here:
+#  - Log() prints a message and appends it to a log file kept open and
+#    buffered for the life of the process, rather than reopened per message.
+#  - Stage is a context manager timing a named piece of work. Stages nest, and
+#    each reports its wall time, peak memory and, if told how many pixels it
+#    covered, pixels per second.
+#  - Progress is a progress bar with an ETA, redrawn at most every half second.
+#  - With a metrics file set (--metrics on the command line), stage and
+#    progress events are also written to it as JSON lines, for job schedulers
+#    to collect.
+
+import os, sys, time, json, atexit, threading, datetime, collections
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+bufferSize = 64 * 1024
+
+# How many log files may be held open at once. Batch and service runs log
+# every job to its own file, so the least recently written to are closed
+# (and reopened to append if written to again) beyond this.
+maxOpenLogs = 16
+
+# Open log files by path, least recently written to first, the metrics file
+# if any, and the names of the stages currently running in each thread,
+# outermost first (see StageStack).
+logFiles = collections.OrderedDict()
+metricsFile = None
+stageStacks = threading.local()
+lock = threading.Lock()
+
+
+def StageStack():
+
+    """The names of the stages running in this thread, outermost first, so that jobs run side by side in threads each nest their own stages."""
+
+    if not hasattr(stageStacks, "stack"):
+        stageStacks.stack = []
+    return stageStacks.stack
+
+def Log(message, logFilePath=None):
+
+    """Prints message to STDOUT and, if a log file path is given, appends it with a newline to that file through a buffered handle kept open until exit or until maxOpenLogs other log files have been written to since."""
+
+    print(message)
+    if logFilePath is None:
+        return
+    with lock:
+        logFile = logFiles.get(logFilePath)
+        if logFile is None:
+            logFile = logFiles[logFilePath] = open(logFilePath, "a", buffering=bufferSize)
+            while len(logFiles) > maxOpenLogs:
+                logFiles.popitem(last=False)[1].close()
+        else:
+            logFiles.move_to_end(logFilePath)
+        logFile.write(message + "\n")
+
+def SetMetricsFile(path):
+
+    """Starts appending JSON-lines metrics to path."""
+
+    global metricsFile
+    with lock:
+        metricsFile = open(path, "a", buffering=bufferSize)
+
+def Emit(event, **fields):
+
+    """Writes one JSON-lines metrics record, if a metrics file is set."""
+
+    if metricsFile is None:
+        return
+    record = {"time": time.time(), "pid": os.getpid(), "event": event}
+    record.update(fields)
+    with lock:
+        metricsFile.write(json.dumps(record) + "\n")
+
+def Flush():
+
+    """Flushes the log and metrics files to disk."""
+
+    with lock:
+        for logFile in logFiles.values():
+            logFile.flush()
+        if metricsFile is not None:
+            metricsFile.flush()
+
+def CloseAll():
+
+    """Flushes and closes the log files, at exit."""
+
+    Flush()
+    for logFile in logFiles.values():
+        logFile.close()
+    logFiles.clear()
+
+atexit.register(CloseAll)
+
+def PeakMemoryMB():
+
+    """Peak resident memory of this process so far in MB, or None where it can't be had."""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+def Timestamp():
+
+    """The current local date and time, for log messages."""
+
+    return str(datetime.datetime.now())
+
+def FormatSeconds(seconds):
+
+    """Seconds as h:mm:ss.ss."""
+
+    minutes, seconds = divmod(seconds, 60.0)
+    hours, minutes = divmod(int(minutes), 60)
+    return "{}:{:02d}:{:05.2f}".format(hours, minutes, seconds)
+
+
+class Stage(object):
+
+    """Times the work done inside a with block as a named stage, nested within any stage already running. On the way out, logs its wall time, peak memory and pixels per second (if pixels is set, here or on the stage as it runs) and emits them as metrics."""
+
+    def __init__(self, name, logFilePath=None, pixels=None):
+        self.name = name
+        self.logFilePath = logFilePath
+        self.pixels = pixels
+
+    def __enter__(self):
+        StageStack().append(self.name)
+        self.path = "/".join(StageStack())
+        self.start = time.perf_counter()
+        Emit("stage_start", stage=self.path)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.elapsed = time.perf_counter() - self.start
+        StageStack().pop()
+        fields = {"stage": self.path, "seconds": self.elapsed, "peakMemoryMB": PeakMemoryMB(), "ok": excType is None}
+        message = "Stage {} took {}".format(self.path, FormatSeconds(self.elapsed))
+        if self.pixels:
+            fields["pixels"] = self.pixels
+            fields["pixelsPerSecond"] = self.pixels / max(self.elapsed, 1e-9)
+            message += " ({:,.0f} pixels/s)".format(fields["pixelsPerSecond"])
+        if fields["peakMemoryMB"] is not None:
+            message += ", peak memory {:,.0f} MB".format(fields["peakMemoryMB"])
+        Log(message, self.logFilePath)
+        Emit("stage_end", **fields)
+        return False
+
+
+class Progress(object):
+
+    """A progress bar for total steps of work, with elapsed time and ETA, redrawn on one line at most every minInterval seconds however often update() is called. Use as a context manager, or call close() when done."""
+
+    def __init__(self, total, label="Progress", minInterval=0.5, stream=None):
+        self.total = max(1, total)
+        self.label = label
+        self.minInterval = minInterval
+        self.stream = stream or sys.stdout
+        self.done = 0
+        self.start = time.perf_counter()
+        self.lastDraw = None
+        self.stage = "/".join(StageStack())
+
+    def update(self, steps=1):
+        self.done += steps
+        now = time.perf_counter()
+        if self.lastDraw is None or now - self.lastDraw >= self.minInterval or self.done >= self.total:
+            self.lastDraw = now
+            self.draw(now)
+
+    def draw(self, now):
+        elapsed = now - self.start
+        fraction = min(1.0, float(self.done) / self.total)
+        eta = elapsed / fraction - elapsed if fraction > 0 else 0.0
+        filled = int(round(30 * fraction))
+        self.stream.write("\r{}: [{}{}] {} of {} | {:.1f} % | Elapsed: {} | ETA: {}".format(
+            self.label, "#" * filled, "-" * (30 - filled), self.done, self.total, 100.0 * fraction, FormatSeconds(elapsed), FormatSeconds(eta)))
+        self.stream.flush()
+        Emit("progress", stage=self.stage, label=self.label, done=self.done, total=self.total, seconds=elapsed)
+
+    def close(self):
+        if self.lastDraw is not None:
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+def AddInstrumentationArguments(parser):
+
+    """Adds the --metrics option to an argparse parser."""
+
+    parser.add_argument('--metrics', help="Full path to a file to append JSON-lines timing, memory and progress metrics to.")
+
+def ConfigureFromArgs(args):
+
+    """Acts on the options added by AddInstrumentationArguments."""
+
+    if args.metrics:
+        SetMetricsFile(args.metrics)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Reading a DEM that comes as many GeoTiff tiles, kept in one directory or
+# listed in a VRT, as if it were one raster, without ever mosaicking it. A
+# directory is always read as tiles; a VRT only when asked to (--mosaic on the
+# command line), as a VRT is otherwise just a raster, and then only its list
+# of files is used: the tiles are placed by their own georeferencing, whole,
+# with the first tile's NoData value, not by the VRT's source windows, order
+# or NoData. The tiles' footprints go into an R-tree (from the rtree package
+# if it is installed, otherwise a simple grid of buckets), so a window reads
+# only from the tiles it overlaps. Tiles are opened as they are needed and kept open,
+# up to maxOpenTiles of them, least recently used closed first.
+#
+# A Mosaic has the parts of a GDAL band's interface the scripts read through
+# (XSize, YSize, ReadAsArray, GetNoDataValue, GetBlockSize), so the
+# existing windowed code can run over one. Outputs are written as one tile per
+# source tile, with the same name and footprint, into an output directory,
+# together with a VRT of them.
+
+import os, glob, collections
+import numpy as np
+from osgeo import gdal, gdal_array
+import processingCommon as pc
+
+try:
+    from rtree import index as rtreeIndex
+    haveRtree = True
+except ImportError:
+    haveRtree = False
+
+
+maxOpenTiles = 32
+
+tileExtensions = [".tif", ".tiff"]
+
+# Name of the VRT written alongside output tiles.
+outputVRTName = "mosaic.vrt"
+
+Tile = collections.namedtuple("Tile", ["path", "xOff", "yOff", "xSize", "ySize"])
+Tile.__doc__ = """A source tile and where it sits in the mosaic, in mosaic pixels."""
+
+
+def IsVRT(path):
+
+    """Whether path is a VRT, by its extension."""
+
+    return os.path.splitext(path)[1].lower() == ".vrt"
+
+def IsMosaic(path, vrtTiles=False):
+
+    """Whether path is to be read as a tile mosaic rather than a single raster: if it is a directory of tiles, or a VRT and vrtTiles is True."""
+
+    return os.path.isdir(path) or (vrtTiles and IsVRT(path))
+
+def MosaicTilePaths(path, vrtTiles=False):
+
+    """The tiles of a mosaic: the GeoTiffs in a directory, the source files of a VRT if vrtTiles is True, or the file itself for a single raster. Raises ValueError if there are none."""
+
+    if os.path.isdir(path):
+        paths = sorted(p for p in glob.glob(os.path.join(path, "*")) if os.path.splitext(p)[1].lower() in tileExtensions)
+    elif vrtTiles and IsVRT(path):
+        vrt = gdal.Open(path)
+        paths = [p for p in vrt.GetFileList() if os.path.abspath(p) != os.path.abspath(path)]
+        vrt = None
+    else:
+        paths = [path]
+    if not paths:
+        raise ValueError("No tiles found in " + path)
+    return paths
+
+
+class GridIndex(object):
+
+    """Stand-in for an rtree index of tile footprints when the rtree package isn't installed: buckets of cellSize by cellSize pixels, each listing the tiles overlapping it."""
+
+    def __init__(self, cellSize):
+        self.cellSize = max(1, int(cellSize))
+        self.buckets = collections.defaultdict(list)
+
+    def cells(self, bounds):
+        x0, y0, x1, y1 = (int(v) // self.cellSize for v in bounds)
+        for by in range(y0, y1 + 1):
+            for bx in range(x0, x1 + 1):
+                yield bx, by
+
+    def insert(self, n, bounds):
+        for cell in self.cells(bounds):
+            self.buckets[cell].append(n)
+
+    def intersection(self, bounds):
+        found = set()
+        for cell in self.cells(bounds):
+            found.update(self.buckets.get(cell, ()))
+        return found
+
+
+class Mosaic(object):
+
+    """A mosaic of tiles on a common grid (same pixel size, no rotation, offsets a whole number of pixels), read as one raster band. Gaps between tiles read as NoData, the first tile's NoData value, or 0 if it has none."""
+
+    def __init__(self, path, vrtTiles=False, maxOpen=None):
+        self.path = path
+        self.maxOpen = maxOpen or maxOpenTiles
+        self.openTiles = collections.OrderedDict()
+        # Times each tile has been opened to read from, for ReportOpens.
+        self.opens = collections.Counter()
+
+        footprints = []
+        dataTypes = set()
+        self.projection = None
+        self.noData = None
+        for tilePath in MosaicTilePaths(path, vrtTiles):
+            ds = gdal.Open(tilePath)
+            gt = ds.GetGeoTransform()
+            if gt[2] != 0 or gt[4] != 0:
+                raise ValueError("Rotated tiles aren't supported: " + tilePath)
+            if self.projection is None:
+                self.projection = ds.GetProjection()
+                self.noData = ds.GetRasterBand(1).GetNoDataValue()
+                self.pixelWidth, self.pixelHeight = gt[1], gt[5]
+            elif abs(gt[1] - self.pixelWidth) > 1e-9 * abs(self.pixelWidth) or abs(gt[5] - self.pixelHeight) > 1e-9 * abs(self.pixelHeight):
+                raise ValueError("Tiles have different pixel sizes: " + tilePath)
+            footprints.append((tilePath, gt[0], gt[3], ds.RasterXSize, ds.RasterYSize))
+            dataTypes.add(ds.GetRasterBand(1).DataType)
+            ds = None
+
+        self.originX = min(f[1] for f in footprints)
+        self.originY = max(f[2] for f in footprints) if self.pixelHeight < 0 else min(f[2] for f in footprints)
+        self.tiles = []
+        for tilePath, x, y, xSize, ySize in footprints:
+            xOff = (x - self.originX) / self.pixelWidth
+            yOff = (y - self.originY) / self.pixelHeight
+            if abs(xOff - round(xOff)) > 1e-6 or abs(yOff - round(yOff)) > 1e-6:
+                raise ValueError("Tile isn't on the mosaic's pixel grid: " + tilePath)
+            self.tiles.append(Tile(tilePath, int(round(xOff)), int(round(yOff)), xSize, ySize))
+        # Row of tiles by row of tiles, so neighbouring tiles are read close
+        # together and are still open.
+        self.tiles.sort(key=lambda tile: (tile.yOff, tile.xOff))
+        self.XSize = max(tile.xOff + tile.xSize for tile in self.tiles)
+        self.YSize = max(tile.yOff + tile.ySize for tile in self.tiles)
+        self.dtype = np.result_type(*[gdal_array.GDALTypeCodeToNumericTypeCode(t) for t in dataTypes])
+
+        if haveRtree:
+            self.index = rtreeIndex.Index()
+        else:
+            self.index = GridIndex(np.median([max(tile.xSize, tile.ySize) for tile in self.tiles]))
+        for n, tile in enumerate(self.tiles):
+            self.index.insert(n, (tile.xOff, tile.yOff, tile.xOff + tile.xSize - 1, tile.yOff + tile.ySize - 1))
+
+    def GetGeoTransform(self):
+        return (self.originX, self.pixelWidth, 0.0, self.originY, 0.0, self.pixelHeight)
+
+    def GetProjection(self):
+        return self.projection
+
+    def GetNoDataValue(self):
+        return self.noData
+
+    def GetBlockSize(self):
+        # Rows of the whole mosaic at a time, for pc.StripWindows.
+        return self.XSize, 1
+
+    def TileWindows(self):
+
+        """The (xOff, yOff, xCount, yCount) window of each tile, in tile order."""
+
+        return [(tile.xOff, tile.yOff, tile.xSize, tile.ySize) for tile in self.tiles]
+
+    def Intersecting(self, window):
+
+        """Numbers of the tiles overlapping an (xOff, yOff, xCount, yCount) window, in tile order."""
+
+        xOff, yOff, xCount, yCount = window
+        found = self.index.intersection((xOff, yOff, xOff + xCount - 1, yOff + yCount - 1))
+        return sorted(n for n in found
+                      if self.tiles[n].xOff < xOff + xCount and xOff < self.tiles[n].xOff + self.tiles[n].xSize
+                      and self.tiles[n].yOff < yOff + yCount and yOff < self.tiles[n].yOff + self.tiles[n].ySize)
+
+    def TileDataset(self, n):
+
+        """Tile n's dataset, opened if it isn't already, closing the least recently used open tile if maxOpen are open."""
+
+        ds = self.openTiles.pop(n, None)
+        if ds is None:
+            while len(self.openTiles) >= self.maxOpen:
+                self.openTiles.popitem(last=False)
+            ds = gdal.Open(self.tiles[n].path)
+            self.opens[n] += 1
+        self.openTiles[n] = ds
+        return ds
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None, buf_xsize=None, buf_ysize=None):
+
+        """Reads a window of the mosaic from the tiles overlapping it, like gdal.Band.ReadAsArray. With a buffer size smaller than the window, takes the nearest pixel, for sampling."""
+
+        win_xsize = self.XSize - xoff if win_xsize is None else win_xsize
+        win_ysize = self.YSize - yoff if win_ysize is None else win_ysize
+        buf_xsize = win_xsize if buf_xsize is None else buf_xsize
+        buf_ysize = win_ysize if buf_ysize is None else buf_ysize
+        decimated = (buf_xsize, buf_ysize) != (win_xsize, win_ysize)
+        # Mosaic row and column of each pixel of the buffer.
+        rows = yoff + ((np.arange(buf_ysize) + 0.5) * win_ysize / buf_ysize).astype(np.int64)
+        cols = xoff + ((np.arange(buf_xsize) + 0.5) * win_xsize / buf_xsize).astype(np.int64)
+
+        out = np.full((buf_ysize, buf_xsize), 0 if self.noData is None else self.noData, dtype=self.dtype)
+        for n in self.Intersecting((xoff, yoff, win_xsize, win_ysize)):
+            tile = self.tiles[n]
+            rowIndex = np.flatnonzero((rows >= tile.yOff) & (rows < tile.yOff + tile.ySize))
+            colIndex = np.flatnonzero((cols >= tile.xOff) & (cols < tile.xOff + tile.xSize))
+            if len(rowIndex) == 0 or len(colIndex) == 0:
+                continue
+            tileRows = rows[rowIndex] - tile.yOff
+            tileCols = cols[colIndex] - tile.xOff
+            block = self.TileDataset(n).GetRasterBand(1).ReadAsArray(int(tileCols[0]), int(tileRows[0]), int(tileCols[-1] - tileCols[0] + 1), int(tileRows[-1] - tileRows[0] + 1))
+            if decimated:
+                block = block[np.ix_(tileRows - tileRows[0], tileCols - tileCols[0])]
+            out[rowIndex[0]:rowIndex[-1] + 1, colIndex[0]:colIndex[-1] + 1] = block
+        return out
+
+    def CheckAligned(self, other):
+
+        """Raises ValueError unless other (a Mosaic) covers the same pixels on the same grid."""
+
+        if (self.XSize, self.YSize) != (other.XSize, other.YSize) or any(abs(a - b) > 1e-6 * max(1.0, abs(a)) for a, b in zip(self.GetGeoTransform(), other.GetGeoTransform())):
+            raise ValueError("{} and {} aren't on the same grid".format(self.path, other.path))
+
+
+def OutputTilePaths(mosaic, outDir):
+
+    """Paths of the output tiles matching each of mosaic's tiles, in outDir under the same names. Raises ValueError if two tiles share a name."""
+
+    paths = [os.path.join(outDir, os.path.splitext(os.path.basename(tile.path))[0] + ".tif") for tile in mosaic.tiles]
+    if len(set(paths)) != len(paths):
+        raise ValueError("Tiles of {} share file names, so can't be written to one directory".format(mosaic.path))
+    return paths
+
+def CreateTileOutput(mosaic, n, path, nBands, dataType, noData=-99999.0):
+
+    """processingCommon.CreateOutput for the output tile matching tile n: the same size, georeferenced like it."""
+
+    tile = mosaic.tiles[n]
+    return pc.CreateOutput(path, tile.xSize, tile.ySize, nBands, dataType, mosaic.TileDataset(n), noData)
+
+def BuildOutputVRT(outDir, paths):
+
+    """Writes a VRT of the output tiles in outDir, for reading them as one raster. Returns its path."""
+
+    vrtPath = os.path.join(outDir, outputVRTName)
+    gdal.BuildVRT(vrtPath, paths)
+    return vrtPath
+
+def ReportOpens(mosaic, theLog=None):
+
+    """Logs how many of mosaic's tiles were read from and the most times any one was opened."""
+
+    pc.printandlog("Read from {} of {} tiles, each opened at most {} time(s), using {} index.".format(
+        len(mosaic.opens), len(mosaic.tiles), max(mosaic.opens.values(), default=0), "an rtree" if haveRtree else "a grid"), theLog)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# Runs a chain of the scripts here (entropy -> scale -> variable filter -> burn,
+# say) in one process, from a JSON config like:
+#
+# {
+#     "outputDir": "/data/out",
+#     "stages": [
+#         {"name": "entropy", "type": "entropy", "inputs": {"image": "/data/dem.tif"}, "params": {"radius": 10}},
+#         {"name": "sizes", "type": "scale", "inputs": {"atScale": "/data/kernelrange.tif", "toScale": "entropy"}},
+#         {"name": "smoothed", "type": "filter", "inputs": {"dem": "/data/dem.tif", "sizing": "sizes"}, "params": {"engine": "bucket"}},
+#         {"name": "final", "type": "burn", "inputs": {"toBurn": "smoothed", "zeroed": ["/data/coast.tif"]}}
+#     ]
+# }
+#
+# An input naming another stage gets that stage's output, anything else is a
+# file path. Stages run in dependency order. Intermediate outputs live in
+# GDAL's in-memory file system (/vsimem/) and are freed as soon as nothing
+# else needs them. Only stages nothing depends on, and those marked
+# "keep": true, are written to outputDir, as <name>.tif. An optional
+# "cache": {"dir": ..., "sizeMB": ..., "key": "mtime" or "content"} caches
+# entropy, scale and filter outputs between runs (see rasterCache.py).
+
+scriptName = "pipeline.py"
+
+import os, argparse, json
+from osgeo import gdal
+import processingCommon as pc
+import instrumentation as ins
+import LocalEntropy
+import PixelScaler
+import VariableKernelLowPassFilter
+import ZeroBurner
+import Inverter
+import smoother
+import RasterCalc
+import rasterCache as rc
+
+
+def RunEntropy(inputs, params, outPath, theLog, cache):
+    radius = params["radius"]
+    radii = radius if isinstance(radius, list) else [radius]
+    LocalEntropy.CalculateEntropy(inputs["image"], outPath, radii, theLog, params.get("tileSize"), params.get("workers", 1), params.get("engine", "skimage"), params.get("bins", 256), params.get("quantization", "fixed"), params.get("breaks"), cache=cache)
+
+def RunScale(inputs, params, outPath, theLog, cache):
+    PixelScaler.performscaling(inputs["atScale"], inputs["toScale"], outPath, cache)
+
+def RunFilter(inputs, params, outPath, theLog, cache):
+    VariableKernelLowPassFilter.VariableLowPassFilter(inputs["dem"], inputs["sizing"], params.get("engine", "sat"), params.get("blockSize"), params.get("workers", 1), outPath, cache)
+
+def RunBurn(inputs, params, outPath, theLog, cache):
+    zeroed = inputs["zeroed"]
+    ZeroBurner.BurnZeros(zeroed if isinstance(zeroed, list) else [zeroed], inputs["toBurn"], outPath)
+
+def RunInvert(inputs, params, outPath, theLog, cache):
+    Inverter.Invert(inputs["raster"], outPath, theLog)
+
+def RunSmooth(inputs, params, outPath, theLog, cache):
+    smoother.NativeSmooth(inputs["raster"], outPath, int(params["radius"]), params.get("tileSize", 1024))
+
+def RunCalc(inputs, params, outPath, theLog, cache):
+    RasterCalc.RasterCalc(params["expression"], inputs, outPath, params.get("workers", 1))
+
+# Stage types, and the function that runs each as
+# fn(inputs, params, outPath, theLog, cache), with inputs resolved to paths
+# and cache a rasterCache.CacheSettings or None. Only the entropy, scale and
+# filter stages use the cache.
+stageRunners = {
+    "entropy": RunEntropy,
+    "scale": RunScale,
+    "filter": RunFilter,
+    "burn": RunBurn,
+    "invert": RunInvert,
+    "smooth": RunSmooth,
+    "calc": RunCalc,
+}
+
+
+def StageDependencies(stage, stageNames):
+
+    """Names of the stages whose outputs a stage takes as inputs."""
+
+    deps = []
+    for value in stage["inputs"].values():
+        for ref in (value if isinstance(value, list) else [value]):
+            if ref in stageNames and ref not in deps:
+                deps.append(ref)
+    return deps
+
+def StageOrder(stages):
+
+    """Orders stages so each comes after every stage it depends on, keeping the config's order otherwise. Raises ValueError on duplicate names, unknown types or a cycle."""
+
+    stageNames = [stage["name"] for stage in stages]
+    if len(set(stageNames)) != len(stageNames):
+        raise ValueError("Stage names must be unique.")
+    for stage in stages:
+        if stage["type"] not in stageRunners:
+            raise ValueError("Unknown stage type '{}', should be one of: {}".format(stage["type"], ", ".join(sorted(stageRunners))))
+
+    deps = {stage["name"]: StageDependencies(stage, stageNames) for stage in stages}
+    order = []
+    while len(order) < len(stages):
+        ready = [name for name in stageNames if name not in order and all(dep in order for dep in deps[name])]
+        if not ready:
+            raise ValueError("Stages depend on each other in a cycle: " + ", ".join(name for name in stageNames if name not in order))
+        order.append(ready[0])
+    return order
+
+def ResolveInputs(inputs, outputs):
+
+    """Replaces stage names among a stage's inputs with the paths of those stages' outputs."""
+
+    resolved = {}
+    for key, value in inputs.items():
+        if isinstance(value, list):
+            resolved[key] = [outputs.get(ref, ref) for ref in value]
+        else:
+            resolved[key] = outputs.get(value, value)
+    return resolved
+
+def RunPipeline(config, theLog):
+
+    """Runs the stages of a pipeline config (see above), passing intermediates between them in memory. Returns a list of (stage name, output path, elapsed seconds)."""
+
+    cache = None
+    if "cache" in config:
+        cacheConfig = config["cache"]
+        cache = rc.CacheSettings(cacheConfig["dir"], int(cacheConfig.get("sizeMB", 10240) * 1024 * 1024), cacheConfig.get("key", "mtime"))
+
+    stages = {stage["name"]: stage for stage in config["stages"]}
+    order = StageOrder(config["stages"])
+    deps = {name: StageDependencies(stages[name], stages) for name in order}
+    usesLeft = {name: sum(name in deps[other] for other in order) for name in order}
+
+    outputs = {}
+    kept = set()
+    report = []
+    for name in order:
+        stage = stages[name]
+        if stage.get("keep", False) or usesLeft[name] == 0:
+            outPath = os.path.join(config["outputDir"], name + ".tif")
+            kept.add(name)
+        else:
+            outPath = "/vsimem/pipeline/" + name + ".tif"
+
+        pc.printandlog("Stage '{}' ({}) -> {}".format(name, stage["type"], outPath), theLog)
+        with ins.Stage(name, theLog) as timer:
+            stageRunners[stage["type"]](ResolveInputs(stage["inputs"], outputs), stage.get("params", {}), outPath, theLog, cache)
+        outputs[name] = outPath
+        report.append((name, outPath, timer.elapsed))
+
+        # Free in-memory intermediates nothing else needs.
+        for dep in deps[name]:
+            usesLeft[dep] -= 1
+            if usesLeft[dep] == 0 and dep not in kept:
+                for memFile in (outputs[dep], outputs[dep] + ".aux.xml"):
+                    if gdal.VSIStatL(memFile) is not None:
+                        gdal.Unlink(memFile)
+
+    return report
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Runs a chain of processing stages (entropy, scale, filter, burn, invert, smooth, calc) described in a JSON config file in one process, passing intermediate rasters between stages in memory and writing only the final products and any intermediates marked to keep.")
+    parser.add_argument('CONFIG', help="Full path to the JSON pipeline config.")
+    pc.AddOutputArguments(parser)
+    pc.AddScratchArguments(parser)
+    ins.AddInstrumentationArguments(parser)
+    args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
+    pc.ConfigureScratch(args)
+
+    gdal.UseExceptions()
+
+    with open(args.CONFIG) as configFile:
+        config = json.load(configFile)
+
+    if not os.path.isdir(config["outputDir"]):
+        os.makedirs(config["outputDir"])
+    configNoExt = os.path.splitext(os.path.basename(args.CONFIG))[0]
+    theLog = os.path.join(config["outputDir"], configNoExt + "_log.txt")
+
+    pc.printandlog("\nStarting {} at {}".format(scriptName, ins.Timestamp()), theLog)
+    pc.printandlog("Config: " + args.CONFIG, theLog)
+
+    with ins.Stage(scriptName, theLog):
+        report = RunPipeline(config, theLog)
+
+        pc.printandlog("\nStage timings", theLog)
+        for name, outPath, elapsed in report:
+            pc.printandlog("{:<20} {}".format(name, ins.FormatSeconds(elapsed)), theLog)
+        if "cache" in config:
+            rc.ReportStats()
+
+
+if __name__ == "__main__":
+    main()
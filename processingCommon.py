@@ -11,15 +11,15 @@
 
 # Some common functions used across several scripts here.
 
-import platform, socket, os
+import platform, socket, os, collections, tempfile, atexit, hashlib, threading, contextlib
 import gdal
+import numpy as np
+import instrumentation as ins
 
 
 def printandlog(aMessage, logFilePath):
-    """Prints to STOUT, and appends with a newline-ending to a text file to write a log of messages."""
-    print(aMessage)
-    with open(logFilePath, "a") as theFile:
-        theFile.write(aMessage + "\n")
+    """Prints to STOUT, and appends with a newline-ending to a text file to write a log of messages. The file is kept open and buffered (see instrumentation.Log)."""
+    ins.Log(aMessage, logFilePath)
 
 def OSandHost(theLogFile):
     """Check whether Linux or Windows, and what machine by name. Returns 'Windows' or 'Linux' on my machines for platform."""
@@ -28,35 +28,45 @@ def OSandHost(theLogFile):
     printandlog("Running on " + theHostName + ", " + currentPlatform, theLogFile)
     return theHostName, currentPlatform
 
-def GeoTiffToSAGA(pathtoGeoTiff):
+def VirtualCopy(pathtoRaster, NoData):
 
-    """Takes the full path of a one-band GeoTiff file and saves it in the same directory in 32-bit float SAGA raster format. Sets NoData to -99999.0. Returns full path to SAGA sdat file."""
+    """Writes a VRT over pathtoRaster, with NoData set, to GDAL's in-memory file system and returns its /vsimem/ path, which is unique to the raster's absolute path. Nothing is copied or written to disk; readers of the VRT read straight from the original raster. Remove it with ReleaseVirtualCopy when done with it."""
+
+    absPath = os.path.abspath(pathtoRaster)
+    basename = os.path.splitext(os.path.basename(absPath))[0]
+    vrtFile = "/vsimem/virtualcopy/{}/{}.vrt".format(hashlib.sha1(absPath.encode("utf-8")).hexdigest()[:12], basename)
+    ds = gdal.Translate(vrtFile, absPath, format="VRT", noData=NoData)
+    ds = None # Closes and writes the VRT.
+    return vrtFile
+
+def ReleaseVirtualCopy(vrtFile):
+
+    """Removes a VRT made by VirtualCopy (or GeoTiffToSAGA or SAGAtoGeoTiff with virtual=True) from GDAL's in-memory file system."""
+
+    gdal.Unlink(vrtFile)
+
+def GeoTiffToSAGA(pathtoGeoTiff, virtual=False):
+
+    """Takes the full path of a one-band GeoTiff file and saves it in the same directory in SAGA raster format, keeping its data type. Sets NoData to -99999.0. Returns full path to SAGA sdat file. GDAL copies the data block by block, so memory use doesn't grow with the raster. With virtual=True nothing touches disk, and the /vsimem/ path of a VRT over the GeoTiff is returned instead, for consumers that can read GDAL virtual files (see VirtualCopy)."""
 
     NoData = -99999.0
 
+    if virtual:
+        return VirtualCopy(pathtoGeoTiff, NoData)
+
     GTiffDir, GTiffFile = os.path.split(pathtoGeoTiff)
     GTiffbasename = os.path.splitext( GTiffFile )[0]
     SAGAFile = os.path.join(GTiffDir, GTiffbasename + ".sdat") # not .sgrd in GDAL
 
-    GTiffData = gdal.Open(pathtoGeoTiff)
-    band = GTiffData.GetRasterBand(1)
-    a = gdal.Band.ReadAsArray(band).astype("float32")
-
-    driver = gdal.GetDriverByName('SAGA')
-    ds = driver.Create(SAGAFile, band.XSize, band.YSize, 1, gdal.GDT_Int32)
-    ds.SetGeoTransform(GTiffData.GetGeoTransform())
-    ds.SetProjection(GTiffData.GetProjection())
-    band = ds.GetRasterBand(1)
-    band.SetNoDataValue(NoData)
-    band.WriteArray(a)
-    ds.FlushCache() # Write raster to disk.
+    ds = gdal.Translate(SAGAFile, pathtoGeoTiff, format="SAGA", noData=NoData)
+    ds = None # Closes and writes raster to disk.
 
     return SAGAFile
 
 
-def SAGAtoGeoTiff(pathtoSAGAfile):
+def SAGAtoGeoTiff(pathtoSAGAfile, virtual=False):
 
-    """Takes the full path of a one-band SAGA raster file and saves it in the same directory in 32-bit float GeoTiff raster format. Sets NoData to -99999.0. Returns full path to GeoTiff file."""
+    """Takes the full path of a one-band SAGA raster file and saves it in the same directory in GeoTiff raster format, keeping its data type. Sets NoData to -99999.0. Returns full path to GeoTiff file. GDAL copies the data block by block, so memory use doesn't grow with the raster. With virtual=True nothing touches disk, and the /vsimem/ path of a VRT over the SAGA file is returned instead, for consumers that can read GDAL virtual files (see VirtualCopy)."""
 
     NoData = -99999.0
 
@@ -70,17 +80,358 @@ def SAGAtoGeoTiff(pathtoSAGAfile):
     else:
         correctedFile = pathtoSAGAfile
 
-    SAGAData = gdal.Open(correctedFile)
-    band = SAGAData.GetRasterBand(1)
-    a = gdal.Band.ReadAsArray(band).astype("float32")
+    if virtual:
+        return VirtualCopy(correctedFile, NoData)
 
-    driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(GeoTiffFile, band.XSize, band.YSize, 1, gdal.GDT_Int32)
-    ds.SetGeoTransform(SAGAData.GetGeoTransform())
-    ds.SetProjection(SAGAData.GetProjection())
-    band = ds.GetRasterBand(1)
-    band.SetNoDataValue(NoData)
-    band.WriteArray(a)
-    ds.FlushCache() # Write raster to disk.
+    ds = gdal.Translate(GeoTiffFile, correctedFile, format="GTiff", noData=NoData)
+    ds = None # Closes and writes raster to disk.
 
     return GeoTiffFile
+
+def TileWindows(xSize, ySize, tileSize):
+
+    """Yields (xOff, yOff, xCount, yCount) windows covering a raster of xSize by ySize pixels in tiles of at most tileSize by tileSize, row of tiles by row of tiles."""
+
+    for yOff in range(0, ySize, tileSize):
+        for xOff in range(0, xSize, tileSize):
+            yield xOff, yOff, min(tileSize, xSize - xOff), min(tileSize, ySize - yOff)
+
+def PadWindow(window, halo, xSize, ySize):
+
+    """Grows an (xOff, yOff, xCount, yCount) window by halo pixels on every side, clipped to a raster of xSize by ySize pixels. Returns the padded window, and the (rows, columns) slices of an array read over it that hold the original window."""
+
+    xOff, yOff, xCount, yCount = window
+    left = max(0, xOff - halo)
+    top = max(0, yOff - halo)
+    right = min(xSize, xOff + xCount + halo)
+    bottom = min(ySize, yOff + yCount + halo)
+    padded = (left, top, right - left, bottom - top)
+    core = (slice(yOff - top, yOff - top + yCount), slice(xOff - left, xOff - left + xCount))
+    return padded, core
+
+def BoundedMap(executor, fn, argTuples, maxPending):
+
+    """Like executor.map(fn, ...), but takes one tuple of arguments per call and never has more than maxPending calls submitted and unfinished. argTuples is only drawn from as calls finish, so it can read blocks from disk lazily without them all being held at once. Results are yielded in order."""
+
+    pending = collections.deque()
+    for args in argTuples:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= maxPending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def StripWindows(band, targetPixels=4194304):
+
+    """Yields (xOff, yOff, xCount, yCount) windows of whole rows covering band, each a whole number of the band's natural blocks high and about targetPixels in size, for streaming through a raster in the order it is stored."""
+
+    blockYSize = band.GetBlockSize()[1]
+    stripHeight = max(1, targetPixels // (band.XSize * blockYSize)) * blockYSize
+    for yOff in range(0, band.YSize, stripHeight):
+        yield 0, yOff, band.XSize, min(stripHeight, band.YSize - yOff)
+
+def NoDataMask(values, noDataValues):
+
+    """True where values equal any of noDataValues (None entries are skipped) or are NaN."""
+
+    mask = np.isnan(values) if np.issubdtype(values.dtype, np.floating) else np.zeros(values.shape, dtype=bool)
+    for noData in noDataValues:
+        if noData is not None:
+            mask |= values == noData
+    return mask
+
+def BandMinMax(band, noDataValues=()):
+
+    """Exact minimum and maximum of band, ignoring noDataValues and the band's own NoData value, read strip by strip so memory stays bounded. Returns (None, None) if there is nothing but NoData."""
+
+    noDataValues = list(noDataValues) + [band.GetNoDataValue()]
+    bandMin = None
+    bandMax = None
+    for window in StripWindows(band):
+        values = band.ReadAsArray(*window)
+        values = values[~NoDataMask(values, noDataValues)]
+        if values.size == 0:
+            continue
+        stripMin = values.min().item()
+        stripMax = values.max().item()
+        bandMin = stripMin if bandMin is None else min(bandMin, stripMin)
+        bandMax = stripMax if bandMax is None else max(bandMax, stripMax)
+    return bandMin, bandMax
+
+def BandRange(band, noDataValues=()):
+
+    """Minimum and maximum of band, from the statistics stored with it when there are exact ones (e.g. from ComputeStatistics(False)), otherwise from a BandMinMax pass. Stored statistics only leave out the band's own NoData value, so if either end is one of noDataValues they are not used."""
+
+    mdata = band.GetMetadata()
+    if "STATISTICS_MINIMUM" in mdata and "STATISTICS_MAXIMUM" in mdata and mdata.get("STATISTICS_APPROXIMATE") != "YES":
+        stored = float(mdata["STATISTICS_MINIMUM"]), float(mdata["STATISTICS_MAXIMUM"])
+        if not any(noData is not None and value == noData for value in stored for noData in noDataValues):
+            return stored
+    return BandMinMax(band, noDataValues)
+
+def DiskHalfWidths(radius, maxRadius=None):
+
+    """Half-widths of each row of a disk of the given radius, top to bottom, with the same pixels as skimage.morphology.disk and SAGA's circle neighbourhood (those within radius of the centre). If maxRadius is given the list covers the rows of a disk that size, with -1 for rows this disk doesn't reach."""
+
+    maxRadius = radius if maxRadius is None else maxRadius
+    return np.array([int(np.sqrt(radius * radius - dy * dy)) if abs(dy) <= radius else -1 for dy in range(-maxRadius, maxRadius + 1)], dtype=np.int64)
+
+# GeoTiff creation options for each output profile. CreateOutput adds the
+# predictor suiting the data type (2, horizontal differencing, for integers; 3,
+# floating point, for floats) to compressed profiles, and BIGTIFF=IF_SAFER to
+# all of them. "plain" is the uncompressed, striped GeoTiff GDAL writes by
+# default. "cog" writes a deflate GeoTiff and rewrites it as a Cloud Optimized
+# GeoTiff once finished (see FinishOutput).
+outputProfiles = {
+    "plain": [],
+    "deflate": ["TILED=YES", "COMPRESS=DEFLATE", "ZLEVEL=6"],
+    "zstd": ["TILED=YES", "COMPRESS=ZSTD", "ZSTD_LEVEL=9"],
+    "lzw": ["TILED=YES", "COMPRESS=LZW"],
+    "cog": ["TILED=YES", "COMPRESS=DEFLATE", "ZLEVEL=1"],
+}
+
+# The profile every CreateOutput call uses, and whether internal overviews are
+# built. Set from the command line by ConfigureOutput.
+outputSettings = {"profile": "deflate", "overviews": False}
+
+# Settings dictionaries (outputSettings, scratchSettings) replaced for the
+# current thread only, by ThreadSettings, so jobs running side by side in one
+# process can each have their own.
+threadSettings = threading.local()
+
+def Current(settings):
+
+    """settings, outputSettings or scratchSettings, as the current thread sees them: the ones given to ThreadSettings if it is inside one, otherwise the module's."""
+
+    return getattr(threadSettings, "overrides", {}).get(id(settings), settings)
+
+@contextlib.contextmanager
+def ThreadSettings(output=None, scratch=None):
+
+    """Within the with block, the current thread uses the dictionaries output and scratch (where given) in place of outputSettings and scratchSettings. Other threads are unaffected."""
+
+    previous = getattr(threadSettings, "overrides", {})
+    overrides = dict(previous)
+    if output is not None:
+        overrides[id(outputSettings)] = output
+    if scratch is not None:
+        overrides[id(scratchSettings)] = scratch
+    threadSettings.overrides = overrides
+    try:
+        yield
+    finally:
+        threadSettings.overrides = previous
+
+# Outputs created but not yet finished, by the path GDAL is writing to, as
+# (final path, profile, overviews).
+pendingOutputs = {}
+
+# Integer GDAL data types from smallest to largest, with their ranges.
+integerDataTypes = [
+    (gdal.GDT_Byte, 0, 255),
+    (gdal.GDT_Int16, -32768, 32767),
+    (gdal.GDT_UInt16, 0, 65535),
+    (gdal.GDT_Int32, -2147483648, 2147483647),
+    (gdal.GDT_UInt32, 0, 4294967295),
+]
+
+def SmallestDataType(minValue, maxValue, integer=True):
+
+    """The smallest GDAL data type holding every value from minValue to maxValue: an integer type if integer is True and one is big enough, otherwise Float32, or Float64 beyond Float32's range. Remember to include the NoData value in the range."""
+
+    if integer:
+        for dataType, typeMin, typeMax in integerDataTypes:
+            if typeMin <= minValue and maxValue <= typeMax:
+                return dataType
+    if max(abs(minValue), abs(maxValue)) <= np.finfo(np.float32).max:
+        return gdal.GDT_Float32
+    return gdal.GDT_Float64
+
+def IsIntegerDataType(dataType):
+
+    """Whether dataType is one of GDAL's integer data types."""
+
+    return dataType in [t[0] for t in integerDataTypes]
+
+def CreationOptions(profile, dataType):
+
+    """GeoTiff creation options for a profile and data type, with multithreaded compression and the predictor suiting the data type for compressed profiles."""
+
+    options = list(outputProfiles[profile])
+    if any(option.startswith("COMPRESS=") for option in options):
+        options.append("PREDICTOR=" + ("2" if IsIntegerDataType(dataType) else "3"))
+        options.append("NUM_THREADS=ALL_CPUS")
+    options.append("BIGTIFF=IF_SAFER")
+    return options
+
+def CreateOutput(path, xSize, ySize, nBands, dataType, like, noData=-99999.0):
+
+    """Creates a GeoTiff of nBands bands at path for writing, with the current output profile (see outputSettings), georeferenced like the dataset like and with noData set on every band (unless it is None). Returns the dataset. Call FinishOutput on it once everything is written. Outputs in GDAL's in-memory file system are pipeline intermediates and are never compressed."""
+
+    settings = Current(outputSettings)
+    profile = settings["profile"]
+    if path.startswith("/vsimem/"):
+        profile = "plain"
+    writePath = path + ".tmp.tif" if profile == "cog" else path
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(writePath, xSize, ySize, nBands, dataType, options=CreationOptions(profile, dataType))
+    ds.SetGeoTransform(like.GetGeoTransform())
+    ds.SetProjection(like.GetProjection())
+    if noData is not None:
+        for nBand in range(1, nBands + 1):
+            ds.GetRasterBand(nBand).SetNoDataValue(noData)
+    pendingOutputs[writePath] = (path, profile, settings["overviews"] and profile != "plain")
+    return ds
+
+def OverviewLevels(xSize, ySize, minSize=256):
+
+    """Overview decimation factors 2, 4, 8... until the smallest overview is under minSize pixels across."""
+
+    levels = []
+    factor = 2
+    while max(xSize, ySize) // factor >= minSize:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def FinishOutput(ds):
+
+    """Flushes a dataset made by CreateOutput to disk, builds its overviews if asked for, and for the cog profile rewrites it as a Cloud Optimized GeoTiff at the path it was created for. Returns that path. Don't use ds afterwards."""
+
+    writePath = ds.GetDescription()
+    path, profile, overviews = pendingOutputs.pop(writePath, (writePath, "plain", False))
+    ds.FlushCache()
+    if profile == "cog":
+        dataType = ds.GetRasterBand(1).DataType
+        options = ["COMPRESS=DEFLATE", "PREDICTOR=" + ("2" if IsIntegerDataType(dataType) else "3"), "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER", "OVERVIEWS=" + ("AUTO" if overviews else "NONE")]
+        gdal.Translate(path, ds, format="COG", creationOptions=options)
+        # The temporary file mustn't be removed while ds still has it open.
+        # Before GDAL 3.8 a dataset can't be closed while the caller still
+        # holds it, so then it is removed when the script exits.
+        if hasattr(ds, "Close"):
+            ds.Close()
+            gdal.Unlink(writePath)
+        else:
+            atexit.register(gdal.Unlink, writePath)
+    elif overviews:
+        levels = OverviewLevels(ds.RasterXSize, ds.RasterYSize)
+        if levels:
+            ds.BuildOverviews("AVERAGE", levels)
+            ds.FlushCache()
+    return path
+
+def AddOutputArguments(parser):
+
+    """Adds the --profile and --overviews options to an argparse parser."""
+
+    parser.add_argument('--profile', choices=sorted(outputProfiles), default=outputSettings["profile"], help="How output GeoTiffs are written: tiled and compressed with 'deflate', 'zstd' or 'lzw', as a Cloud Optimized GeoTiff ('cog'), or uncompressed and striped ('plain'). Default is " + outputSettings["profile"] + ".")
+    parser.add_argument('--overviews', action="store_true", help="Build internal overviews in output GeoTiffs.")
+
+def OutputSettingsFromArgs(args):
+
+    """An outputSettings dictionary from the options added by AddOutputArguments."""
+
+    return {"profile": args.profile, "overviews": args.overviews}
+
+def ConfigureOutput(args):
+
+    """Acts on the options added by AddOutputArguments."""
+
+    outputSettings.update(OutputSettingsFromArgs(args))
+
+# Where working arrays too big for the memory budget are memory-mapped, and the
+# budget in bytes. Set from the command line by ConfigureScratch. With neither
+# set everything stays in RAM; with only a scratch directory the budget is half
+# the machine's physical memory; with only a budget, arrays over it are mapped
+# in the system temp directory.
+scratchSettings = {"dir": None, "budget": None}
+
+# Rows per band when working through whole-raster arrays a band at a time.
+bandRows = 1024
+
+def MemoryBudget():
+
+    """The memory budget in bytes: the one set, or else half of physical memory (4 GB where that can't be found)."""
+
+    budget = Current(scratchSettings)["budget"]
+    if budget is not None:
+        return budget
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+def UseScratch(workingSetBytes):
+
+    """Whether an operation needing workingSetBytes of working arrays should memory-map them rather than hold them in RAM."""
+
+    settings = Current(scratchSettings)
+    if settings["dir"] is None and settings["budget"] is None:
+        return False
+    return workingSetBytes > MemoryBudget()
+
+def NewArray(shape, dtype, scratch=False):
+
+    """An uninitialized array, or with scratch=True a zeroed numpy.memmap over an anonymous temporary file in the scratch directory, removed as soon as the array is freed. Memory-mapped arrays are paged in and out by the OS, so they may be far bigger than RAM."""
+
+    if not scratch:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(tempfile.TemporaryFile(dir=Current(scratchSettings)["dir"], suffix=".scratch"), dtype=dtype, mode="w+", shape=shape)
+
+def NewSharedArray(shape, dtype):
+
+    """A zeroed numpy.memmap over a named temporary file in the scratch directory (the system temp directory if none is set), which other processes can map too. Returns the array and the file's path. Remove the file once every process is done with it."""
+
+    handle, path = tempfile.mkstemp(dir=Current(scratchSettings)["dir"], suffix=".scratch")
+    os.close(handle)
+    return np.memmap(path, dtype=dtype, mode="w+", shape=shape), path
+
+def RowBands(nRows, rows=None):
+
+    """Yields slices of at most rows (default bandRows) rows covering nRows rows, for working through big arrays a band at a time so temporaries stay small."""
+
+    rows = rows or bandRows
+    for top in range(0, nRows, rows):
+        yield slice(top, min(nRows, top + rows))
+
+def ReadBand(band, dtype=None, scratch=False):
+
+    """Reads a whole band into a new array (see NewArray) of dtype, or the band's own type, strip by strip, so there is never a second full-size copy. Strips are converted to dtype by numpy, which truncates floats to integers where GDAL would round them, so the result matches ReadAsArray().astype(dtype)."""
+
+    bandType = band.ReadAsArray(0, 0, 1, 1).dtype
+    dtype = bandType if dtype is None else np.dtype(dtype)
+    values = NewArray((band.YSize, band.XSize), dtype, scratch)
+    for window in StripWindows(band):
+        xOff, yOff, xCount, yCount = window
+        if dtype == bandType:
+            band.ReadAsArray(xOff, yOff, xCount, yCount, buf_obj=values[yOff:yOff+yCount])
+        else:
+            values[yOff:yOff+yCount] = band.ReadAsArray(xOff, yOff, xCount, yCount)
+    return values
+
+def WriteBand(band, values):
+
+    """Writes a whole-raster array to band strip by strip, so memory-mapped arrays are paged through rather than all at once."""
+
+    for window in StripWindows(band):
+        xOff, yOff, xCount, yCount = window
+        band.WriteArray(values[yOff:yOff+yCount], xOff, yOff)
+
+def AddScratchArguments(parser):
+
+    """Adds the --scratch-dir and --memory-budget options to an argparse parser."""
+
+    parser.add_argument('--scratch-dir', help="Directory on fast local disk to memory-map working arrays in when they would not fit the memory budget.")
+    parser.add_argument('--memory-budget', type=float, help="Memory in MB working arrays may take in RAM before they are memory-mapped instead. Default is half of physical memory when --scratch-dir is given, otherwise unlimited.")
+
+def ScratchSettingsFromArgs(args):
+
+    """A scratchSettings dictionary from the options added by AddScratchArguments."""
+
+    return {"dir": args.scratch_dir, "budget": None if args.memory_budget is None else int(args.memory_budget * 1024 * 1024)}
+
+def ConfigureScratch(args):
+
+    """Acts on the options added by AddScratchArguments."""
+
+    scratchSettings.update(ScratchSettingsFromArgs(args))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# A content-addressed on-disk cache of stage outputs, so parameter sweeps
+# don't recompute entropy or scaled sizing rasters whose inputs haven't
+# changed. Entries are keyed by a hash of the stage, its parameters and its
+# inputs (their content, or their path, size and modification time), kept in
+# one directory per key, and evicted least recently used first once the cache
+# outgrows its size limit.
+
+import os, json, hashlib, shutil, collections
+from osgeo import gdal
+
+
+CacheSettings = collections.namedtuple("CacheSettings", ["cacheDir", "maxBytes", "keyMethod"])
+CacheSettings.__doc__ = """Where the cache lives, how big it may get in bytes, and whether inputs are keyed by 'content' or by path, size and 'mtime'."""
+
+keyMethods = ["mtime", "content"]
+
+# Hits and misses in this process, for reporting.
+cacheStats = {"hits": 0, "misses": 0}
+
+copyChunkSize = 16 * 1024 * 1024
+
+
+def CopyFile(src, dst):
+
+    """Copies src to dst through GDAL's virtual file functions, in chunks, so either may be a /vsimem/ path."""
+
+    inFile = gdal.VSIFOpenL(src, "rb")
+    outFile = gdal.VSIFOpenL(dst, "wb")
+    try:
+        while True:
+            chunk = gdal.VSIFReadL(1, copyChunkSize, inFile)
+            if not chunk:
+                break
+            gdal.VSIFWriteL(chunk, 1, len(chunk), outFile)
+    finally:
+        gdal.VSIFCloseL(inFile)
+        gdal.VSIFCloseL(outFile)
+
+def CopyModificationTime(src, dst):
+
+    """Gives dst the modification time of src, so that a file copied into or out of the cache fingerprints (with 'mtime') the same as the one it was copied from, and a later stage reading it can hit too. /vsimem/ files are skipped; they are always hashed."""
+
+    if src.startswith("/vsi") or dst.startswith("/vsi"):
+        return
+    stat = os.stat(src)
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def FileFingerprint(path, keyMethod="mtime"):
+
+    """A string identifying the state of a file: its absolute path, size and modification time for 'mtime', or a SHA-256 of its bytes for 'content'. /vsimem/ files have no meaningful modification time, so they are always hashed."""
+
+    if keyMethod == "mtime" and not path.startswith("/vsi"):
+        stat = os.stat(path)
+        return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = hashlib.sha256()
+    inFile = gdal.VSIFOpenL(path, "rb")
+    try:
+        while True:
+            chunk = gdal.VSIFReadL(1, copyChunkSize, inFile)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        gdal.VSIFCloseL(inFile)
+    return "sha256:" + digest.hexdigest()
+
+def CacheKey(stage, inputPaths, params, keyMethod="mtime"):
+
+    """Hash of a stage name, its input files (see FileFingerprint) and its parameters, which must be JSON serializable."""
+
+    description = {
+        "stage": stage,
+        "inputs": [FileFingerprint(path, keyMethod) for path in inputPaths],
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+def EntryFiles(entryDir, nOutputs):
+
+    """Paths of the files holding an entry's outputs, in order."""
+
+    return [os.path.join(entryDir, "out{}.tif".format(n)) for n in range(nOutputs)]
+
+def DirectorySize(path):
+
+    """Total size in bytes of the files under path."""
+
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+def Evict(settings):
+
+    """Removes least recently used entries until the cache is no bigger than settings.maxBytes."""
+
+    if not os.path.isdir(settings.cacheDir):
+        return
+    entries = []
+    for key in os.listdir(settings.cacheDir):
+        entryDir = os.path.join(settings.cacheDir, key)
+        if os.path.isdir(entryDir):
+            entries.append((os.path.getmtime(entryDir), DirectorySize(entryDir), entryDir))
+    total = sum(size for used, size, entryDir in entries)
+    for used, size, entryDir in sorted(entries):
+        if total <= settings.maxBytes:
+            break
+        shutil.rmtree(entryDir, ignore_errors=True)
+        total -= size
+        print("Cache: evicted " + os.path.basename(entryDir))
+
+def CachedRun(settings, stage, inputPaths, params, outPaths, computeFn):
+
+    """Fills outPaths with a stage's outputs: copied from the cache if it holds an entry for the same stage, inputs and params, or else by calling computeFn() and then storing what it wrote. With no settings (None) just calls computeFn()."""
+
+    if settings is None:
+        return computeFn()
+
+    key = CacheKey(stage, inputPaths, params, settings.keyMethod)
+    entryDir = os.path.join(settings.cacheDir, key)
+    cachedFiles = EntryFiles(entryDir, len(outPaths))
+
+    if all(os.path.isfile(cachedFile) for cachedFile in cachedFiles):
+        cacheStats["hits"] += 1
+        print("Cache hit for {} ({})".format(stage, key[:12]))
+        for cachedFile, outPath in zip(cachedFiles, outPaths):
+            CopyFile(cachedFile, outPath)
+            CopyModificationTime(cachedFile, outPath)
+        os.utime(entryDir) # Most recently used.
+        return
+
+    cacheStats["misses"] += 1
+    print("Cache miss for {} ({})".format(stage, key[:12]))
+    computeFn()
+
+    # Write the entry under a temporary name and rename it into place, so a
+    # crash never leaves a partial entry that looks complete.
+    tempDir = entryDir + ".partial"
+    shutil.rmtree(tempDir, ignore_errors=True)
+    os.makedirs(tempDir)
+    for outPath, tempFile in zip(outPaths, EntryFiles(tempDir, len(outPaths))):
+        CopyFile(outPath, tempFile)
+        CopyModificationTime(outPath, tempFile)
+    shutil.rmtree(entryDir, ignore_errors=True)
+    os.rename(tempDir, entryDir)
+    Evict(settings)
+
+def ReportStats():
+
+    """Prints the numbers of cache hits and misses so far."""
+
+    print("Cache: {} hit(s), {} miss(es)".format(cacheStats["hits"], cacheStats["misses"]))
+
+def AddCacheArguments(parser):
+
+    """Adds the --cache-dir, --cache-size and --cache-key options to an argparse parser."""
+
+    parser.add_argument('--cache-dir', help="Directory to cache outputs in. A later run with the same inputs and parameters copies its output from the cache instead of recomputing it.")
+    parser.add_argument('--cache-size', type=float, default=10240, help="Cache size limit in MB, beyond which the least recently used outputs are evicted. Default is 10240.")
+    parser.add_argument('--cache-key', choices=keyMethods, default="mtime", help="Identify inputs by path, size and modification time ('mtime', fast) or by hashing their content ('content'). Default is mtime.")
+
+def SettingsFromArgs(args):
+
+    """CacheSettings from the options added by AddCacheArguments, or None if --cache-dir wasn't given."""
+
+    if args.cache_dir is None:
+        return None
+    return CacheSettings(args.cache_dir, int(args.cache_size * 1024 * 1024), args.cache_key)
@@ -10,13 +10,112 @@
 
 
 
-# Requires saga_cmd to be in the system PATH already.
+# Smooths with a circular mean filter, natively by default. The original SAGA
+# round trip is still there as --engine saga, for comparison, and requires
+# saga_cmd to be in the system PATH already.
 
 import numpy as np
 import gdal, os, argparse, subprocess, socket
 import processingCommon as pc
+import instrumentation as ins
+
+# Radius in cells above which the circular mean is taken by FFT convolution
+# rather than by summing disk rows.
+fftRadius = 24
+
+
+def NextFastLength(n):
+
+    """Smallest length of at least n with no prime factors above 5, which FFTs handle quickly."""
+
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+def RowSpanDiskSums(values, radius):
+
+    """Sums of values over a disk of the given radius around every cell, leaving out cells off the array edge. Each disk is split into its rows, and each row's sum taken from running sums along the rows, so the cost per cell grows with the radius rather than the disk area."""
+
+    nRows, nCols = values.shape
+    rowCum = np.zeros((nRows, nCols + 1))
+    np.cumsum(values, axis=1, out=rowCum[:, 1:])
+    colIdx = np.arange(nCols)
+    sums = np.zeros((nRows, nCols))
+    for dy, w in zip(range(-radius, radius + 1), pc.DiskHalfWidths(radius)):
+        if abs(dy) >= nRows:
+            continue
+        spans = rowCum[:, np.minimum(colIdx + w + 1, nCols)] - rowCum[:, np.maximum(colIdx - w, 0)]
+        if dy >= 0:
+            sums[:nRows - dy] += spans[dy:]
+        else:
+            sums[-dy:] += spans[:nRows + dy]
+    return sums
+
+def FFTDiskSums(values, radius):
+
+    """Same as RowSpanDiskSums, by FFT convolution with the disk, which costs the same whatever the radius."""
+
+    nRows, nCols = values.shape
+    halfWidths = pc.DiskHalfWidths(radius)
+    kernel = np.abs(np.arange(-radius, radius + 1))[np.newaxis, :] <= halfWidths[:, np.newaxis]
+    fftShape = (NextFastLength(nRows + 2 * radius), NextFastLength(nCols + 2 * radius))
+    product = np.fft.rfft2(values, fftShape) * np.fft.rfft2(kernel, fftShape)
+    return np.fft.irfft2(product, fftShape)[radius:radius + nRows, radius:radius + nCols]
+
+def CircularMean(values, radius, noDataValues=()):
+
+    """Mean of the valid cells within radius cells of each cell, as SAGA's simple filter does with -MODE 1 -METHOD 0. NoData cells are left out of the means and stay NoData, written out as -99999.0."""
+
+    NoDataVal = -99999.0
+
+    valid = ~pc.NoDataMask(values, [NoDataVal] + list(noDataValues))
+    # Summed about the mean, to keep FFT rounding small next to the values.
+    offset = float(np.mean(values[valid])) if valid.any() else 0.0
+    filled = np.where(valid, values - offset, 0.0)
+
+    diskSums = FFTDiskSums if radius > fftRadius else RowSpanDiskSums
+    sums = diskSums(filled, radius)
+    counts = np.rint(diskSums(valid.astype(np.float64), radius))
+
+    means = np.full(values.shape, NoDataVal)
+    means[valid] = sums[valid] / counts[valid] + offset
+    return means
+
+def NativeSmooth(inGeoTiff, outGeoTiff, radius, tileSize=1024):
+
+    """Circular mean filter of inGeoTiff written to outGeoTiff as a 32-bit float GeoTiff, in tiles padded by radius cells so memory depends on the tile size. Nothing is written but the output, and no external program is needed."""
+
+    inData = gdal.Open(inGeoTiff)
+    inBand = inData.GetRasterBand(1)
+    inNoData = inBand.GetNoDataValue()
+
+    ds = pc.CreateOutput(outGeoTiff, inBand.XSize, inBand.YSize, 1, gdal.GDT_Float32, inData)
+    dsB1 = ds.GetRasterBand(1)
+
+    windows = list(pc.TileWindows(inBand.XSize, inBand.YSize, tileSize))
+    with ins.Stage("smooth", pixels=inBand.XSize * inBand.YSize), ins.Progress(len(windows), "Tiles") as progress:
+        for window in windows:
+            padded, core = pc.PadWindow(window, radius, inBand.XSize, inBand.YSize)
+            means = CircularMean(inBand.ReadAsArray(*padded).astype(np.float64), radius, [inNoData])
+            dsB1.WriteArray(means[core], window[0], window[1])
+            progress.update()
+    pc.FinishOutput(ds)
+
+def smooth(inGeoTiff, radius, engine="native"):
+
+    if engine == "native":
+        inDir, inFile = os.path.split(inGeoTiff)
+        GeoTiff = os.path.join(inDir, os.path.splitext(inFile)[0] + "_smooth_rad" + str(radius) + ".tif")
+        print("Smoothing")
+        NativeSmooth(inGeoTiff, GeoTiff, int(radius))
+        print("Smoothed output saved to: " + GeoTiff)
+        return
 
-def smooth(inGeoTiff, radius):
 
     print("Converting to SAGA")
     SAGA = pc.GeoTiffToSAGA(inGeoTiff)
@@ -61,15 +160,20 @@ def smooth(inGeoTiff, radius):
 
 def main():
 
-    parser = argparse.ArgumentParser(description="Takes a GeoTiff and runs the SAGA simple filter on it, using smooth, a circle neighborhood, and a given radius in cells. Makes a SAGA version of the raster in the interim and converts back again.")
+    parser = argparse.ArgumentParser(description="Takes a GeoTiff and smooths it with a circular mean filter of a given radius in cells, like the SAGA simple filter using smooth and a circle neighborhood. With --engine saga, actually runs the SAGA filter, making a SAGA version of the raster in the interim and converting back again.")
     parser.add_argument('INGEOTIFF')
     parser.add_argument('RADIUS')
+    parser.add_argument('--engine', choices=["native", "saga"], default="native", help="'native' filters in-process, 'saga' calls saga_cmd. Default is native.")
+    pc.AddOutputArguments(parser)
+    ins.AddInstrumentationArguments(parser)
     args = parser.parse_args()
+    ins.ConfigureFromArgs(args)
+    pc.ConfigureOutput(args)
 
     print("Input GeoTiff: " + args.INGEOTIFF)
     print("Input radius: " + args.RADIUS)
 
-    smooth(args.INGEOTIFF, args.RADIUS)
+    smooth(args.INGEOTIFF, args.RADIUS, args.engine)
 
     print("Done")
 
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#   .-.                              _____                                  __
+#   /v\    L   I   N   U   X       / ____/__   ___   ___   ____ ___   ___  / /_  __  __
+#  // \\                          / / __/ _ \/ __ \/ __ `/ ___/ __ `/ __ \/ __ \/ / / /
+# /(   )\                        / /_/ /  __/ /_/ / /_/ / /  / /_/ / /_/ / / / / /_/ /
+#  ^^-^^                         \____/\___/\____/\__, /_/   \__,_/ .___/_/ /_/\__, /
+#                                                /____/          /_/          /____/
+
+
+# A long-running local worker for many small jobs, so each job doesn't pay
+# for starting Python and importing GDAL and scikit-image. Start it with
+#   workerService.py serve [--port 8765 | --socket /tmp/dem.sock] [--threads 4]
+# and send it jobs with the same arguments as the scripts themselves:
+#   workerService.py entropy dem.tif entropy.tif 8 --engine histogram
+#   workerService.py filter dem.tif sizes.tif --engine bucket --profile zstd
+#   workerService.py scale kernelrange.tif entropy.tif
+#   workerService.py invert dem.tif inverted.tif
+#   workerService.py burn coast.tif smoothed.tif burned.tif --mask lakes.tif
+#   workerService.py status
+# Jobs go as JSON over HTTP, on a local port or a Unix socket, to a queue
+# served by a pool of threads in the service. The processing modules are
+# imported once, and LocalEntropy.py's disk footprints are kept per radius for
+# the life of the service. Each job's output and scratch options apply to its
+# own runner thread only. The client imports nothing heavy and waits for
+# its job to finish. GET /status reports the queue depth and job latencies.
+
+scriptName = "workerService.py"
+
+import os, sys, argparse, json, time, threading, queue, socket, socketserver, collections
+import http.client, http.server
+import instrumentation as ins
+
+
+defaultPort = 8765
+
+# Jobs finished, for latency statistics.
+recentJobs = 1000
+
+
+# Choices of the scripts' options, copied here so the client can check them
+# without importing GDAL: processingCommon.outputProfiles,
+# VariableKernelLowPassFilter.filterEngines, rasterCache.keyMethods and
+# histogramEntropy.quantizationMethods. Keep them in step.
+outputProfiles = ["cog", "deflate", "lzw", "plain", "zstd"]
+filterEngines = ["bucket", "disk", "loop", "pyramid", "sat"]
+cacheKeyMethods = ["mtime", "content"]
+quantizationMethods = ["fixed", "quantile", "breaks"]
+
+
+def JobSettings(args):
+
+    """A context in which the current runner thread writes outputs and scratch files as a job's --profile, --overviews, --scratch-dir and --memory-budget say, without affecting jobs on other threads (see processingCommon.ThreadSettings)."""
+
+    import processingCommon as pc
+    options = argparse.Namespace(**args)
+    scratch = pc.ScratchSettingsFromArgs(options) if "scratch_dir" in args else None
+    return pc.ThreadSettings(pc.OutputSettingsFromArgs(options), scratch)
+
+def JobCache(args):
+
+    """A job's rasterCache.CacheSettings, as the scripts make them from their --cache-* options."""
+
+    import rasterCache
+    return rasterCache.SettingsFromArgs(argparse.Namespace(**args))
+
+def EntropyJob(args):
+    import LocalEntropy
+    outPathDir, outFile = os.path.split(args["OUTIMAGE"])
+    theLog = os.path.join(outPathDir, os.path.splitext(outFile)[0] + "_log.txt")
+    breaks = args["breaks"]
+    with JobSettings(args):
+        return LocalEntropy.CalculateEntropy(args["INIMAGE"], args["OUTIMAGE"], [int(r) for r in str(args["DISKRADIUS"]).split(",")], theLog,
+                                             args["tilesize"], args["workers"], args["engine"], args["bins"], args["quantization"],
+                                             breaks and [float(x) for x in breaks.split(",")], args["separate"], JobCache(args), args["mosaic"])
+
+def FilterJob(args):
+    import VariableKernelLowPassFilter
+    with JobSettings(args):
+        return [VariableKernelLowPassFilter.VariableLowPassFilter(args["INDEM"], args["INSIZINGS"], args["engine"], args["blocksize"], args["workers"], args["out"], JobCache(args), args["mosaic"])]
+
+def ScaleJob(args):
+    import PixelScaler
+    with JobSettings(args):
+        return [PixelScaler.performscaling(args["INRAST_ATSCALE"], args["INRAST_TOSCALE"], args["out"], JobCache(args))]
+
+def InvertJob(args):
+    import Inverter
+    outPathDir, outFile = os.path.split(args["OUTPUTRAST"])
+    with JobSettings(args):
+        Inverter.Invert(args["INPUTRAST"], args["OUTPUTRAST"], os.path.join(outPathDir, os.path.splitext(outFile)[0] + "_log.txt"))
+    return [args["OUTPUTRAST"]]
+
+def BurnJob(args):
+    import ZeroBurner
+    with JobSettings(args):
+        return [ZeroBurner.BurnZeros([args["IN_ZEROED_RAST"]] + args["mask"], args["IN_TO_BURN_RAST"], args["OUTRAST"])]
+
+# Job types, the function that runs each on a dictionary of the arguments its
+# script takes (named as the script's argparse destinations) and returns the
+# paths written, and the arguments that are paths, to be made absolute by the
+# client.
+jobTypes = {
+    "entropy": (EntropyJob, ["INIMAGE", "OUTIMAGE", "cache_dir"]),
+    "filter": (FilterJob, ["INDEM", "INSIZINGS", "out", "cache_dir", "scratch_dir"]),
+    "scale": (ScaleJob, ["INRAST_ATSCALE", "INRAST_TOSCALE", "out", "cache_dir"]),
+    "invert": (InvertJob, ["INPUTRAST", "OUTPUTRAST"]),
+    "burn": (BurnJob, ["IN_ZEROED_RAST", "IN_TO_BURN_RAST", "OUTRAST", "mask"]),
+}
+
+
+class JobQueue(object):
+
+    """The service's job queue, the threads working through it, and statistics on the jobs done."""
+
+    def __init__(self, nThreads):
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=recentJobs)
+        self.started = time.time()
+        for n in range(nThreads):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, job):
+
+        """Queues a job, a dictionary with "type" and "args", and returns a record of it whose "finished" event is set once it has run."""
+
+        if job.get("type") not in jobTypes:
+            raise ValueError("Unknown job type '{}', should be one of: {}".format(job.get("type"), ", ".join(sorted(jobTypes))))
+        record = {"job": job, "queued": time.perf_counter(), "finished": threading.Event()}
+        self.jobs.put(record)
+        return record
+
+    def work(self):
+        while True:
+            record = self.jobs.get()
+            with self.lock:
+                self.running += 1
+            record["started"] = time.perf_counter()
+            record["error"] = "job didn't finish"
+            try:
+                try:
+                    record["outputs"] = jobTypes[record["job"]["type"]][0](record["job"]["args"])
+                    record["error"] = None
+                except (Exception, SystemExit) as e:
+                    # SystemExit too, so a script calling exit() fails its
+                    # job rather than ending this runner thread.
+                    record["error"] = "{}: {}".format(type(e).__name__, e)
+                record["ended"] = time.perf_counter()
+                queueSeconds = record["started"] - record["queued"]
+                runSeconds = record["ended"] - record["started"]
+                with self.lock:
+                    self.running -= 1
+                    if record["error"] is None:
+                        self.done += 1
+                    else:
+                        self.failed += 1
+                    self.latencies.append((queueSeconds, runSeconds))
+                ins.Emit("job", type=record["job"]["type"], queueSeconds=queueSeconds, runSeconds=runSeconds, error=record["error"])
+                ins.Flush()
+            finally:
+                # Whatever happens, never leave a client waiting forever.
+                record.setdefault("ended", time.perf_counter())
+                record["finished"].set()
+
+    def status(self):
+
+        """Queue depth, jobs running, done and failed, and the mean and 95th percentile of the time recent jobs spent queued, running and in all."""
+
+        with self.lock:
+            latencies = list(self.latencies)
+            report = {"queueDepth": self.jobs.qsize(), "running": self.running, "done": self.done, "failed": self.failed, "uptimeSeconds": time.time() - self.started}
+        for n, name in enumerate(["queueSeconds", "runSeconds"]):
+            values = sorted(latency[n] for latency in latencies)
+            report[name] = {"mean": sum(values) / len(values), "p95": values[int(0.95 * (len(values) - 1))]} if values else None
+        totals = sorted(sum(latency) for latency in latencies)
+        report["latencySeconds"] = {"mean": sum(totals) / len(totals), "p95": totals[int(0.95 * (len(totals) - 1))]} if totals else None
+        return report
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+
+    """POST /jobs runs a job and replies once it's done, with the paths written and how long it queued and ran. GET /status replies with JobQueue.status()."""
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(200, self.server.jobQueue.status())
+        else:
+            self.reply(404, {"error": "Not found: " + self.path})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.reply(404, {"error": "Not found: " + self.path})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            record = self.server.jobQueue.submit(job)
+        except ValueError as e:
+            self.reply(400, {"error": str(e)})
+            return
+        record["finished"].wait()
+        body = {
+            "outputs": record.get("outputs"),
+            "error": record["error"],
+            "queueSeconds": record["started"] - record["queued"],
+            "runSeconds": record["ended"] - record["started"],
+        }
+        self.reply(500 if record["error"] else 200, body)
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address to log.
+        ins.Log("{} {}".format(self.log_date_time_string(), format % args))
+
+
+class TCPService(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+class UnixService(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    """An HTTP client connection over a Unix socket."""
+
+    def __init__(self, socketPath, timeout=None):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socketPath)
+
+
+def Serve(port, socketPath, nThreads):
+
+    """Imports the processing modules and serves jobs until interrupted."""
+
+    from osgeo import gdal
+    import LocalEntropy, VariableKernelLowPassFilter, PixelScaler, Inverter, ZeroBurner # Imported once, here.
+    gdal.UseExceptions()
+
+    if socketPath:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = UnixService(socketPath, ServiceHandler)
+        where = socketPath
+    else:
+        server = TCPService(("127.0.0.1", port), ServiceHandler)
+        where = "http://127.0.0.1:{}".format(port)
+    server.jobQueue = JobQueue(nThreads)
+    ins.Log("{} serving on {} with {} thread(s).".format(scriptName, where, nThreads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketPath and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def Request(method, path, body, port, socketPath):
+
+    """Sends a request to the service and returns the HTTP status and decoded JSON reply. Exits with a message if the service isn't running."""
+
+    connection = UnixHTTPConnection(socketPath) if socketPath else http.client.HTTPConnection("127.0.0.1", port)
+    try:
+        connection.request(method, path, body=None if body is None else json.dumps(body), headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    except (ConnectionRefusedError, FileNotFoundError):
+        sys.exit("No service on {}, start one with: {} serve".format(socketPath or "port {}".format(port), scriptName))
+    finally:
+        connection.close()
+
+def AddCacheArguments(parser):
+
+    """The options rasterCache.AddCacheArguments adds to a script."""
+
+    parser.add_argument('--cache-dir', help="Directory to cache outputs in, as for the script.")
+    parser.add_argument('--cache-size', type=float, default=10240, help="Cache size limit in MB. Default is 10240.")
+    parser.add_argument('--cache-key', choices=cacheKeyMethods, default="mtime", help="Identify inputs by modification time or content. Default is mtime.")
+
+def AddOutputArguments(parser):
+
+    """The options processingCommon.AddOutputArguments adds to a script."""
+
+    parser.add_argument('--profile', choices=outputProfiles, default="deflate", help="How output GeoTiffs are written, as for the script. Default is deflate.")
+    parser.add_argument('--overviews', action="store_true", help="Build internal overviews in output GeoTiffs.")
+
+def AddScratchArguments(parser):
+
+    """The options processingCommon.AddScratchArguments adds to a script."""
+
+    parser.add_argument('--scratch-dir', help="Directory to memory-map working arrays in, on the service's machine.")
+    parser.add_argument('--memory-budget', type=float, help="Memory in MB working arrays may take in RAM before they are memory-mapped instead.")
+
+def AddJobParsers(subparsers):
+
+    """Client subcommands for each job type, taking the same arguments, with the same choices and defaults, as the scripts (less the instrumentation options, which are the service's own)."""
+
+    p = subparsers.add_parser("entropy", help="LocalEntropy.py")
+    p.add_argument('INIMAGE')
+    p.add_argument('OUTIMAGE')
+    p.add_argument('DISKRADIUS')
+    p.add_argument('--mosaic', action="store_true")
+    p.add_argument('--separate', action="store_true")
+    p.add_argument('--tilesize', type=int)
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--engine', choices=["skimage", "histogram"], default="skimage")
+    p.add_argument('--bins', type=int, default=256)
+    p.add_argument('--quantization', choices=quantizationMethods, default="fixed")
+    p.add_argument('--breaks')
+    AddCacheArguments(p)
+    AddOutputArguments(p)
+
+    p = subparsers.add_parser("filter", help="VariableKernelLowPassFilter.py")
+    p.add_argument('INDEM')
+    p.add_argument('INSIZINGS')
+    p.add_argument('--mosaic', action="store_true")
+    p.add_argument('--engine', choices=filterEngines, default="sat")
+    p.add_argument('--blocksize', type=int)
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--out', help="Output path. Default is next to the DEM, as the script does.")
+    AddCacheArguments(p)
+    AddOutputArguments(p)
+    AddScratchArguments(p)
+
+    p = subparsers.add_parser("scale", help="PixelScaler.py")
+    p.add_argument('INRAST_ATSCALE')
+    p.add_argument('INRAST_TOSCALE')
+    p.add_argument('--out', help="Output path. Default is next to INRAST_TOSCALE, as the script does.")
+    AddCacheArguments(p)
+    AddOutputArguments(p)
+
+    p = subparsers.add_parser("invert", help="Inverter.py")
+    p.add_argument('INPUTRAST')
+    p.add_argument('OUTPUTRAST')
+    AddOutputArguments(p)
+
+    p = subparsers.add_parser("burn", help="ZeroBurner.py")
+    p.add_argument('IN_ZEROED_RAST')
+    p.add_argument('IN_TO_BURN_RAST')
+    p.add_argument('OUTRAST')
+    p.add_argument('--mask', action="append", default=[])
+    AddOutputArguments(p)
+
+def main():
+
+    parser = argparse.ArgumentParser(description="A persistent local worker service for entropy, filter, scale, invert and burn jobs, keeping GDAL, scikit-image and the processing modules loaded between jobs, and a client for it taking the same arguments as the scripts.")
+    parser.add_argument('--port', type=int, default=defaultPort, help="Local TCP port the service listens on. Default is {}.".format(defaultPort))
+    parser.add_argument('--socket', help="Unix socket path to use instead of a TCP port.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serveParser = subparsers.add_parser("serve", help="Run the service.")
+    serveParser.add_argument('--threads', type=int, default=1, help="Number of jobs to run at once. Default is 1.")
+    serveParser.add_argument('--metrics', help="Full path to a file to append JSON-lines job metrics to.")
+    subparsers.add_parser("status", help="Print the service's queue depth and job latencies.")
+    AddJobParsers(subparsers)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        ins.ConfigureFromArgs(args)
+        Serve(args.port, args.socket, args.threads)
+        return
+
+    if args.command == "status":
+        status, reply = Request("GET", "/status", None, args.port, args.socket)
+        print(json.dumps(reply, indent=2))
+        return
+
+    jobArgs = {key: value for key, value in vars(args).items() if key not in ("port", "socket", "command")}
+    for key in jobTypes[args.command][1]:
+        if isinstance(jobArgs.get(key), list):
+            jobArgs[key] = [os.path.abspath(path) for path in jobArgs[key]]
+        elif jobArgs.get(key) is not None:
+            jobArgs[key] = os.path.abspath(jobArgs[key])
+    status, reply = Request("POST", "/jobs", {"type": args.command, "args": jobArgs}, args.port, args.socket)
+    if reply.get("error"):
+        print("Job failed: " + reply["error"])
+        sys.exit(1)
+    for path in reply["outputs"] or []:
+        print("Written out to: " + path)
+    print("Queued {:.3f} s, ran {:.3f} s".format(reply["queueSeconds"], reply["runSeconds"]))
+
+
+if __name__ == "__main__":
+    main()